@@ -0,0 +1,229 @@
+"""
+Benchmark di ingest, query ed export su dati sintetici.
+
+    python -m benchmarks.run --size-mb 200 --out benchmarks/results/base.json
+    python -m benchmarks.run --size-mb 200 --out new.json --compare benchmarks/results/base.json
+
+Ogni fase gira in un processo separato, così il picco di RSS misurato è
+quello della sola fase. Il risultato è un file JSON confrontabile tra esecuzioni:
+con --compare le metriche peggiorate oltre la soglia sono segnalate e il
+comando termina con codice 1.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import platform
+import resource
+import statistics
+import subprocess
+from datetime import datetime, timezone
+from pathlib import Path
+import click
+
+STAGES = ("sanitize", "parse", "query", "export_aggregated")
+READ_CHUNK = 1024 * 1024
+QUERY_REPEAT = 5
+QUERIES = {
+    "count_by_year": "SELECT ANNO, count(*) FROM aiuti GROUP BY ANNO ORDER BY ANNO",
+    "top_regions": ("SELECT REGIONE_BENEFICIARIO, sum(IMPORTO_NOMINALE) AS tot FROM aiuti_completi "
+                    "GROUP BY 1 ORDER BY tot DESC LIMIT 10"),
+    "point_lookup": "SELECT * FROM aiuti WHERE CODICE_FISCALE_BENEFICIARIO = '00000000001'",
+}
+# Metriche confrontate con --compare: nome -> True se un valore più alto è migliore
+HIGHER_IS_BETTER = {"mb_s": True, "records_s": True, "seconds": False, "ms": False, "peak_rss_mb": False}
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss è in KB su Linux, in byte su macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / 1024 if sys.platform == "darwin" else rss / 1024
+
+def _mb(path: Path) -> float:
+    return path.stat().st_size / 1024 / 1024
+
+# --- Fasi: eseguite nel processo figlio, restituiscono un dizionario di metriche ---
+
+def stage_sanitize(xml: Path, work: Path) -> dict:
+    from src.parser import CleanFileInputStream
+    start = time.perf_counter()
+    with CleanFileInputStream(str(xml)) as stream:
+        while stream.read(READ_CHUNK):
+            pass
+        stripped = stream.bytes_stripped
+    seconds = time.perf_counter() - start
+    return {"seconds": seconds, "mb_s": _mb(xml) / seconds, "bytes_stripped": stripped}
+
+def stage_parse(xml: Path, work: Path) -> dict:
+    from src import parser
+    from src.dimensions import merge_dimensions
+    from src.catalog import refresh_catalog
+
+    out = work / "parquet"
+    shutil.rmtree(out, ignore_errors=True)
+    # Tempo di flush_batches misurato avvolgendo la funzione usata da _process_xml_context
+    flush = parser.flush_batches
+    flush_times = []
+
+    def timed_flush(*args, **kwargs):
+        t = time.perf_counter()
+        try:
+            return flush(*args, **kwargs)
+        finally:
+            flush_times.append(time.perf_counter() - t)
+
+    parser.flush_batches = timed_flush
+    start = time.perf_counter()
+    stats = parser.process_file(str(xml), str(out))
+    seconds = time.perf_counter() - start
+    parser.flush_batches = flush
+    if stats.get("error"):
+        raise RuntimeError(f"process_file failed on {xml}")
+
+    merge_dimensions(out, stats["dimensions"])
+    refresh_catalog(out)
+    records = stats["aiuti"] + stats["componenti"] + stats["strumenti"]
+    return {
+        "seconds": seconds, "mb_s": _mb(xml) / seconds, "records_s": records / seconds,
+        "aiuti": stats["aiuti"], "componenti": stats["componenti"], "strumenti": stats["strumenti"],
+        "flush_calls": len(flush_times), "flush_seconds": sum(flush_times),
+        "output_mb": sum(f.stat().st_size for f in out.rglob("*.parquet")) / 1024 / 1024,
+    }
+
+def stage_query(xml: Path, work: Path) -> dict:
+    from src import exporter
+    from src.catalog import build_query
+    from src.snapshots import Snapshot
+    exporter.DATA_DIR = work / "parquet"
+    result = work / "query.parquet"
+    metrics = {}
+    for name, sql in QUERIES.items():
+        query = build_query("aiuti", sql, 10)
+        times = []
+        for _ in range(QUERY_REPEAT):
+            t = time.perf_counter()
+            # Stessi passi di run_query, ma un errore interrompe la fase invece di essere solo loggato
+            with Snapshot(exporter.DATA_DIR) as snapshot:
+                exporter._run_query(snapshot.path, query, str(result), None, exporter.PAGE_SIZE, None, False)
+            times.append((time.perf_counter() - t) * 1000)
+        metrics[f"{name}_first_ms"] = times[0]
+        metrics[f"{name}_median_ms"] = statistics.median(times)
+    return metrics
+
+def stage_export_aggregated(xml: Path, work: Path) -> dict:
+    from src import exporter
+    exporter.DATA_DIR = work / "parquet"
+    out = work / "aggregated.csv"
+    start = time.perf_counter()
+    exporter.export_aggregated_dataset(str(out))
+    seconds = time.perf_counter() - start
+    written = list(work.glob("aggregated*.csv"))
+    return {"seconds": seconds, "output_mb": sum(f.stat().st_size for f in written) / 1024 / 1024}
+
+# --- Processo principale ---
+
+def _dataset(work: Path, params: dict) -> Path:
+    """XML sintetico per params, rigenerato solo se i parametri cambiano"""
+    from src.synthetic import generate_xml
+    key = hashlib.blake2b(json.dumps(params, sort_keys=True).encode(), digest_size=6).hexdigest()
+    xml = work / f"synthetic-{key}.xml"
+    if not xml.exists():
+        generate_xml(xml, **params)
+    return xml
+
+def _run_stage(stage: str, xml: Path, work: Path) -> dict:
+    proc = subprocess.run(
+        [sys.executable, "-m", "benchmarks.run", "--stage", stage, "--xml", str(xml), "--work", str(work)],
+        capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        raise click.ClickException(f"Stage {stage} failed:\n{proc.stderr}")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+def _direction(metric: str):
+    for suffix, higher in HIGHER_IS_BETTER.items():
+        if metric == suffix or metric.endswith("_" + suffix):
+            return higher
+    return None
+
+def compare(current: dict, baseline: dict, threshold: float = 0.1) -> list:
+    """Metriche peggiorate oltre threshold (frazione) rispetto a baseline: (fase, metrica, prima, dopo)"""
+    regressions = []
+    for stage, metrics in current["stages"].items():
+        for metric, value in metrics.items():
+            higher = _direction(metric)
+            before = baseline.get("stages", {}).get(stage, {}).get(metric)
+            if higher is None or not before:
+                continue
+            change = (value - before) / before
+            if (-change if higher else change) > threshold:
+                regressions.append((stage, metric, before, value))
+    return regressions
+
+@click.command()
+@click.option('--size-mb', default=50.0, show_default=True, help='Size of the synthetic XML file')
+@click.option('--components', default="1-3", show_default=True, help='Components per aid (min-max)')
+@click.option('--instruments', default="1-2", show_default=True, help='Instruments per component (min-max)')
+@click.option('--years', default="2018-2023", show_default=True, help='Years of the grant dates (first-last)')
+@click.option('--text-length', default=300, show_default=True, help='Characters of DESCRIZIONE_PROGETTO')
+@click.option('--invalid-rate', default=0.001, show_default=True, help='Fraction of fields with invalid control characters')
+@click.option('--seed', default=0, show_default=True)
+@click.option('--stages', default=",".join(STAGES), show_default=True, help='Comma-separated stages to run')
+@click.option('--work', default="benchmarks/work", show_default=True, help='Working directory (XML and Parquet)')
+@click.option('--out', default=None, help='Write the results JSON here')
+@click.option('--compare', 'baseline', default=None, type=click.Path(exists=True), help='Results JSON to compare against')
+@click.option('--threshold', default=0.1, show_default=True, help='Relative change reported as a regression')
+@click.option('--stage', hidden=True, default=None)
+@click.option('--xml', hidden=True, default=None)
+def main(size_mb, components, instruments, years, text_length, invalid_rate, seed, stages, work, out,
+         baseline, threshold, stage, xml):
+    """Benchmark parse, sanitizer, queries and aggregated export on synthetic RNA XML"""
+    work = Path(work)
+    if stage:
+        # Processo figlio: una sola fase, metriche su stdout
+        metrics = globals()[f"stage_{stage}"](Path(xml), work)
+        metrics["peak_rss_mb"] = _peak_rss_mb()
+        print(json.dumps(metrics))
+        return
+
+    def span(value):
+        first, last = (int(v) for v in value.split("-", 1))
+        return first, last
+
+    work.mkdir(parents=True, exist_ok=True)
+    params = {"size_mb": size_mb, "components": span(components), "instruments": span(instruments),
+              "years": span(years), "text_length": text_length, "invalid_rate": invalid_rate, "seed": seed}
+    xml_path = _dataset(work, params)
+    selected = [s.strip() for s in stages.split(",") if s.strip()]
+    # query ed export leggono il dataset prodotto dal parse
+    if any(s in ("query", "export_aggregated") for s in selected) and "parse" not in selected \
+            and not (work / "parquet").exists():
+        selected.insert(0, "parse")
+
+    results = {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "host": platform.node(), "python": platform.python_version(), "cpus": os.cpu_count(),
+        "params": params, "input_mb": _mb(xml_path), "stages": {},
+    }
+    for name in STAGES:
+        if name in selected:
+            click.echo(f"Running {name}...", err=True)
+            results["stages"][name] = _run_stage(name, xml_path, work)
+
+    text = json.dumps(results, indent=1)
+    if out:
+        Path(out).parent.mkdir(parents=True, exist_ok=True)
+        Path(out).write_text(text)
+    click.echo(text)
+
+    if baseline:
+        regressions = compare(results, json.loads(Path(baseline).read_text()), threshold)
+        for name, metric, before, after in regressions:
+            click.echo(f"REGRESSION {name}.{metric}: {before:.3f} -> {after:.3f}", err=True)
+        if regressions:
+            sys.exit(1)
+        click.echo(f"No regressions over {threshold:.0%} against {baseline}", err=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+import os
+import re
+import json
+import hashlib
+import logging
+import threading
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterator, Optional
+import duckdb
+import pyarrow as pa
+import pyarrow.parquet as pq
+from .writer import PARTITION_COL
+from .dimensions import DIMENSIONS_DIR
+from .catalog import CATALOG_VIEWS
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = "_cache"
+# Dimensione massima della cache: oltre, vengono rimossi i risultati usati meno di recente
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+_QUOTED_RE = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")")
+# Funzioni con risultato diverso a ogni esecuzione: le query che le usano non vengono salvate
+_VOLATILE_RE = re.compile(r"\b(random|uuid|gen_random_uuid|now|current_date|current_time|current_timestamp|"
+                          r"today|get_current_time|setseed)\b", re.IGNORECASE)
+# Funzioni tabella che generano righe senza leggere file o impostazioni: ammesse nelle query salvate
+PURE_TABLE_FUNCTIONS = {"range", "generate_series", "unnest"}
+
+def normalize_sql(sql: str) -> str:
+    """SQL con spazi compattati (fuori dalle stringhe) e senza ';' finale"""
+    parts = _QUOTED_RE.split(sql.strip())
+    # Le parti dispari sono stringhe o identificatori tra virgolette: restano invariate
+    text = "".join(p if i % 2 else re.sub(r"\s+", " ", p) for i, p in enumerate(parts))
+    return text.strip().rstrip(";").strip()
+
+def _references(node, tables: set, functions: set, ctes: set):
+    """Raccoglie dall'albero JSON di una SELECT tabelle lette, funzioni tabella e nomi delle CTE"""
+    if isinstance(node, dict):
+        if node.get("type") == "BASE_TABLE":
+            tables.add((node.get("catalog_name") or "", node.get("schema_name") or "", node["table_name"].lower()))
+        elif node.get("type") == "TABLE_FUNCTION":
+            functions.add(node["function"].get("function_name", "").lower())
+        for entry in (node.get("cte_map") or {}).get("map", []):
+            ctes.add(entry["key"].lower())
+        for value in node.values():
+            _references(value, tables, functions, ctes)
+    elif isinstance(node, list):
+        for value in node:
+            _references(value, tables, functions, ctes)
+
+@lru_cache(maxsize=256)
+def reads_only_catalog(sql: str) -> bool:
+    """
+    True se sql è una sola SELECT che legge solo le viste del catalogo (o sue CTE):
+    il risultato dipende solo dalla versione del dataset. COPY, SET, ATTACH e
+    letture di file (read_csv('...'), FROM 'file.parquet') non lo sono.
+    """
+    try:
+        statements = duckdb.extract_statements(sql)
+    except duckdb.Error:
+        return False
+    if len(statements) != 1 or statements[0].type != duckdb.StatementType.SELECT:
+        return False
+    con = duckdb.connect()
+    try:
+        tree = json.loads(con.execute("SELECT json_serialize_sql(?)", [sql]).fetchone()[0])
+    except duckdb.Error:
+        return False
+    finally:
+        con.close()
+    if tree.get("error"):
+        return False
+    tables, functions, ctes = set(), set(), set()
+    _references(tree, tables, functions, ctes)
+    views = {v.lower() for v in CATALOG_VIEWS}
+    return functions <= PURE_TABLE_FUNCTIONS and all(
+        catalog == "" and schema in ("", "main") and (name in views or (schema == "" and name in ctes))
+        for catalog, schema, name in tables
+    )
+
+def dataset_version(data_dir) -> str:
+    """
+    Versione del dataset: hash di percorso, dimensione e mtime dei file Parquet
+    delle tabelle e delle dimensioni. Cambia a ogni parse o compact che
+    aggiunge, sostituisce o rimuove file.
+    """
+    base = Path(data_dir)
+    files = sorted(list(base.glob(f"*/{PARTITION_COL}=*/*.parquet")) + list(base.glob(f"{DIMENSIONS_DIR}/*.parquet")))
+    h = hashlib.blake2b(digest_size=8)
+    for f in files:
+        st = f.stat()
+        h.update(f"{f.relative_to(base)}\x1f{st.st_size}\x1f{st.st_mtime_ns}\n".encode())
+    return h.hexdigest()
+
+class ResultCache:
+    """
+    Cache su disco dei risultati delle query (un file Parquet per risultato),
+    nella cartella _cache del dataset. La chiave è l'SQL normalizzato; il nome
+    del file inizia con la versione del dataset, così i risultati di una
+    versione precedente vengono scartati al primo accesso dopo un parse.
+    version è il nome della versione pubblicata letta (snapshots.py), che non
+    cambia mai: senza (dataset non versionato) si usa l'hash dei file, più
+    costoso da calcolare. Un'istanza può essere condivisa tra thread.
+    """
+    def __init__(self, data_dir, max_bytes: int = CACHE_MAX_BYTES, version: str = None):
+        self.data_dir = Path(data_dir)
+        self.dir = self.data_dir / CACHE_DIR
+        self.max_bytes = max_bytes
+        self.version = version or dataset_version(self.data_dir)
+        self._invalidate()
+
+    def _path(self, sql: str) -> Path:
+        key = hashlib.blake2b(normalize_sql(sql).encode(), digest_size=16).hexdigest()
+        return self.dir / f"{self.version}-{key}.parquet"
+
+    def _invalidate(self):
+        """Rimuove i risultati (e i file temporanei) delle altre versioni del dataset"""
+        if not self.dir.exists():
+            return
+        for f in self.dir.iterdir():
+            if not f.name.startswith(f"{self.version}-"):
+                f.unlink(missing_ok=True)
+
+    def cacheable(self, sql: str) -> bool:
+        """Solo SELECT deterministiche sulle viste del catalogo"""
+        return _VOLATILE_RE.search(_QUOTED_RE.sub("", sql)) is None and reads_only_catalog(sql)
+
+    def get(self, sql: str) -> Optional[pa.RecordBatchReader]:
+        """Risultato salvato di sql, letto a batch; None se assente (o se sql non è salvabile)"""
+        if not self.cacheable(sql):
+            return None
+        path = self._path(sql)
+        try:
+            pf = pq.ParquetFile(path)
+        except (FileNotFoundError, pa.ArrowInvalid):
+            return None
+        # mtime come ultimo accesso per l'ordine LRU (il file può essere appena stato rimosso
+        # da evict() di un altro processo: il file aperto resta leggibile)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return pa.RecordBatchReader.from_batches(pf.schema_arrow, pf.iter_batches())
+
+    def store(self, sql: str, reader: pa.RecordBatchReader) -> pa.RecordBatchReader:
+        """
+        Restituisce un reader equivalente a reader che, mentre viene letto, salva
+        il risultato. Il file viene pubblicato solo se il risultato è letto per
+        intero; se supera da solo la dimensione massima viene scartato.
+        """
+        if not self.cacheable(sql):
+            return reader
+        path = self._path(sql)
+        tmp = path.with_suffix(f".{os.getpid()}-{threading.get_ident()}.tmp")
+        self.dir.mkdir(parents=True, exist_ok=True)
+
+        def batches() -> Iterator[pa.RecordBatch]:
+            writer = pq.ParquetWriter(tmp, reader.schema, compression="zstd")
+            complete = False
+            try:
+                for batch in reader:
+                    writer.write_batch(batch)
+                    yield batch
+                complete = True
+            finally:
+                writer.close()
+                if complete and tmp.stat().st_size <= self.max_bytes:
+                    os.replace(tmp, path)
+                    self.evict()
+                else:
+                    tmp.unlink(missing_ok=True)
+        return pa.RecordBatchReader.from_batches(reader.schema, batches())
+
+    def evict(self) -> int:
+        """Rimuove i risultati usati meno di recente oltre max_bytes; restituisce i byte liberati"""
+        entries = []
+        for f in self.dir.glob("*.parquet"):
+            try:
+                st = f.stat()
+            except FileNotFoundError:  # Rimosso da un altro processo
+                continue
+            entries.append((st.st_mtime_ns, st.st_size, f))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        freed = 0
+        for _, size, f in entries:
+            if total - freed <= self.max_bytes:
+                break
+            f.unlink(missing_ok=True)
+            freed += size
+        if freed:
+            logger.info(f"Query cache: evicted {freed} bytes")
+        return freed
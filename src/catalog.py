@@ -0,0 +1,265 @@
+import os
+import sys
+import logging
+from pathlib import Path
+from typing import Dict, List, Optional
+import duckdb
+import polars as pl
+from .models import TABLE_SCHEMAS, DIMENSIONS
+from .dimensions import dimension_path
+
+logger = logging.getLogger(__name__)
+
+CATALOG_NAME = "_catalog.duckdb"
+# Da incrementare quando cambiano le definizioni delle viste
+CATALOG_VERSION = 4
+TABLES = ("aiuti", "componenti", "strumenti", "aiuti_aggregati")
+# Le tabelle dimensione sono esposte come viste dim_<nome>
+DIMENSION_VIEW_PREFIX = "dim_"
+
+# Modello completo: ogni AIUTO con i suoi componenti e strumenti, uniti sulle
+# chiavi surrogate intere. L'uguaglianza su ANNO permette a DuckDB di unire
+# partizione per partizione.
+JOINED_VIEW = "aiuti_completi"
+JOINED_VIEW_SQL = f"""
+CREATE OR REPLACE VIEW {JOINED_VIEW} AS
+SELECT a.*,
+       c.* EXCLUDE (CAR_AIUTO, COR_AIUTO, AIUTO_SK, ANNO),
+       s.* EXCLUDE (ID_COMPONENTE_AIUTO, COMPONENTE_SK, ANNO)
+FROM aiuti a
+LEFT JOIN componenti c ON c.AIUTO_SK = a.AIUTO_SK AND c.ANNO = a.ANNO
+LEFT JOIN strumenti s ON s.COMPONENTE_SK = c.COMPONENTE_SK AND s.ANNO = c.ANNO
+"""
+# Tutte le viste del catalogo: le uniche tabelle che una query in cache può leggere
+CATALOG_VIEWS = (JOINED_VIEW,) + TABLES + tuple(DIMENSION_VIEW_PREFIX + d for d in DIMENSIONS)
+
+
+def arrow_table(result):
+    """Risultato DuckDB come pyarrow.Table (API cambiata nelle versioni recenti)"""
+    if hasattr(result, "to_arrow_table"):
+        return result.to_arrow_table()
+    return result.fetch_arrow_table()
+
+def arrow_reader(result, batch_size: int = 1_000_000):
+    """Risultato DuckDB come RecordBatchReader, letto a blocchi"""
+    if hasattr(result, "to_arrow_reader"):
+        return result.to_arrow_reader(batch_size)
+    return result.fetch_record_batch(batch_size)
+
+def _quote(value) -> str:
+    return "'" + str(value).replace("'", "''") + "'"
+
+def table_glob(data_dir: Path, table: str) -> str:
+    return str(data_dir.resolve() / table / "ANNO=*" / "*.parquet")
+
+def _available_tables(data_dir: Path) -> List[str]:
+    return [t for t in TABLES if next((data_dir / t).glob("ANNO=*/*.parquet"), None) is not None]
+
+def _available_dimensions(data_dir: Path) -> List[str]:
+    return [name for name in DIMENSIONS if dimension_path(data_dir, name).exists()]
+
+def _table_view(data_dir: Path, table: str, dimensions: List[str]) -> str:
+    """Vista di una tabella dei fatti con le descrizioni delle sue dimensioni"""
+    source = (f"read_parquet({_quote(table_glob(data_dir, table))}, "
+              f"hive_partitioning=true, hive_types={{'ANNO': INTEGER}}, union_by_name=true)")
+    columns, joins = ["f.*"], []
+    for i, name in enumerate(dimensions):
+        code, description = DIMENSIONS[name]
+        if code not in TABLE_SCHEMAS[table].names:
+            continue
+        columns.append(f"d{i}.{description}")
+        joins.append(f"LEFT JOIN {DIMENSION_VIEW_PREFIX}{name} d{i} ON d{i}.{code} = f.{code}")
+    return f"CREATE OR REPLACE VIEW {table} AS SELECT {', '.join(columns)} FROM {source} f " + " ".join(joins)
+
+def _view_statements(data_dir: Path, tables: List[str]) -> List[str]:
+    dimensions = _available_dimensions(data_dir)
+    statements = [
+        f"CREATE OR REPLACE VIEW {DIMENSION_VIEW_PREFIX}{name} AS "
+        f"SELECT * FROM read_parquet({_quote(dimension_path(data_dir, name).resolve())})"
+        for name in dimensions
+    ]
+    statements += [_table_view(data_dir, t, dimensions) for t in tables]
+    if {"aiuti", "componenti", "strumenti"} <= set(tables):
+        statements.append(JOINED_VIEW_SQL)
+    return statements
+
+def _catalog_info(data_dir: Path, tables: List[str]) -> Dict[str, str]:
+    return {"version": str(CATALOG_VERSION), "data_dir": str(data_dir.resolve()), "tables": ",".join(tables),
+            "dimensions": ",".join(_available_dimensions(data_dir))}
+
+def refresh_catalog(data_dir: Path) -> Optional[Path]:
+    """
+    (Ri)crea il catalogo DuckDB persistente del dataset con una vista per tabella
+    (partizionamento Hive, ANNO tipizzato INTEGER) e la vista unita aiuti_completi.
+    Restituisce None se il catalogo è in uso da un'altra connessione.
+    """
+    data_dir = Path(data_dir)
+    path = data_dir / CATALOG_NAME
+    tables = _available_tables(data_dir)
+    try:
+        con = duckdb.connect(str(path))
+    except duckdb.Error as e:
+        logger.warning(f"Could not update catalog {path}: {e}")
+        return None
+    try:
+        for view in CATALOG_VIEWS:
+            con.execute(f"DROP VIEW IF EXISTS {view}")
+        for statement in _view_statements(data_dir, tables):
+            con.execute(statement)
+        con.execute("CREATE OR REPLACE TABLE _catalog_info (key VARCHAR, value VARCHAR)")
+        con.executemany("INSERT INTO _catalog_info VALUES (?, ?)", list(_catalog_info(data_dir, tables).items()))
+    finally:
+        con.close()
+    return path
+
+def _catalog_is_current(path: Path, data_dir: Path) -> bool:
+    if not path.exists():
+        return False
+    try:
+        con = duckdb.connect(str(path), read_only=True)
+    except duckdb.Error:
+        return False
+    try:
+        info = dict(con.execute("SELECT key, value FROM _catalog_info").fetchall())
+    except duckdb.Error:
+        return False
+    finally:
+        con.close()
+    return info == _catalog_info(data_dir, _available_tables(data_dir))
+
+def is_statement(sql: str) -> bool:
+    """True se sql è una o più istruzioni SQL complete"""
+    try:
+        return len(duckdb.extract_statements(sql)) > 0
+    except duckdb.ParserException:
+        return False
+
+def build_query(table: str, sql_query: str = None, limit: int = 10) -> str:
+    """
+    Query da eseguire per il comando `query`: una query completa viene usata
+    così com'è, altrimenti il testo è trattato come condizione WHERE su table.
+    Serve solo il parser, non il catalogo (così la cache dei risultati può
+    essere consultata prima di aprire la sessione).
+    """
+    if not sql_query:
+        return f"SELECT * FROM {table} LIMIT {int(limit)}"
+    if is_statement(sql_query):
+        return sql_query
+    return f"SELECT * FROM {table} WHERE {sql_query} LIMIT {int(limit)}"
+
+class QuerySession:
+    """
+    Connessione DuckDB riutilizzabile sul catalogo persistente del dataset.
+    Le tabelle sono interrogabili per nome (aiuti, componenti, strumenti,
+    aiuti_aggregati, aiuti_completi); la connessione resta aperta tra una query e l'altra, così
+    i metadati Parquet letti restano in cache.
+    """
+    def __init__(self, data_dir, threads: int = None, memory_limit: str = None):
+        self.data_dir = Path(data_dir)
+        path = self.data_dir / CATALOG_NAME
+        if not _catalog_is_current(path, self.data_dir):
+            refresh_catalog(self.data_dir)
+
+        try:
+            # Sola lettura: più sessioni (CLI, server) possono condividere il catalogo
+            self.con = duckdb.connect(str(path), read_only=True)
+        except duckdb.Error as e:
+            logger.warning(f"Catalog unavailable ({e}), using an in-memory catalog")
+            self.con = duckdb.connect()
+            for statement in _view_statements(self.data_dir, _available_tables(self.data_dir)):
+                self.con.execute(statement)
+
+        self.con.execute("SET parquet_metadata_cache = true")
+        if threads:
+            self.con.execute(f"SET threads = {int(threads)}")
+        if memory_limit:
+            self.con.execute(f"SET memory_limit = {_quote(memory_limit)}")
+
+    def restrict(self):
+        """
+        Limita la sessione ai file del dataset (niente read_text, COPY TO o ATTACH
+        altrove) e blocca le impostazioni, che una query non può più cambiare
+        """
+        self.con.execute(f"SET allowed_directories = [{_quote(str(self.data_dir.resolve()) + os.sep)}]")
+        self.con.execute("SET enable_external_access = false")
+        self.con.execute("SET lock_configuration = true")
+
+    def is_statement(self, sql: str) -> bool:
+        return is_statement(sql)
+
+    def build_query(self, table: str, sql_query: str = None, limit: int = 10) -> str:
+        return build_query(table, sql_query, limit)
+
+    def execute(self, sql: str):
+        return self.con.execute(sql)
+
+    def cursor(self) -> "QuerySession":
+        """
+        Sessione su un cursore della stessa connessione, da usare in un altro
+        thread: condivide catalogo, impostazioni e cache dei metadati Parquet.
+        """
+        session = QuerySession.__new__(QuerySession)
+        session.data_dir = self.data_dir
+        session.con = self.con.cursor()
+        return session
+
+    def tables(self) -> List[str]:
+        return [r[0] for r in self.con.execute(
+            "SELECT view_name FROM duckdb_views() WHERE NOT internal ORDER BY view_name"
+        ).fetchall()]
+
+    def close(self):
+        self.con.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+def print_result(result, out=None):
+    """Stampa il risultato di una query come tabella"""
+    out = out or sys.stdout
+    if result.description is None:
+        return
+    out.write(f"{pl.from_arrow(arrow_table(result))}\n")
+
+def run_script(session: QuerySession, sql: str, out=None):
+    """Esegue in sequenza tutte le istruzioni di uno script sulla stessa connessione"""
+    for statement in session.con.extract_statements(sql):
+        print_result(session.con.execute(statement), out)
+
+def run_shell(session: QuerySession, stdin=None, out=None):
+    """
+    Shell SQL interattiva: le istruzioni terminano con ';'.
+    Comandi speciali: .tables (elenco viste), .quit / .exit
+    """
+    stdin = stdin or sys.stdin
+    out = out or sys.stdout
+    interactive = stdin.isatty()
+    buffer = []
+    while True:
+        if interactive:
+            out.write("sql> " if not buffer else "...> ")
+            out.flush()
+        line = stdin.readline()
+        if not line:
+            break
+        stripped = line.strip()
+        if not buffer and stripped in (".quit", ".exit"):
+            break
+        if not buffer and stripped == ".tables":
+            out.write("\n".join(session.tables()) + "\n")
+            continue
+        buffer.append(line)
+        if stripped.endswith(";"):
+            try:
+                run_script(session, "".join(buffer), out)
+            except duckdb.Error as e:
+                out.write(f"Error: {e}\n")
+            buffer = []
+    if buffer and "".join(buffer).strip():
+        try:
+            run_script(session, "".join(buffer), out)
+        except duckdb.Error as e:
+            out.write(f"Error: {e}\n")
@@ -0,0 +1,189 @@
+import os
+import json
+import hashlib
+import logging
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set
+from .sources import WorkUnit, find_aiuto_end, is_archive
+from .writer import PARTITION_COL
+from .dimensions import dimensions_to_json, dimensions_from_json
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_DIR = "_checkpoints"
+# Input letto tra due checkpoint: a ogni checkpoint i file Parquet aperti vengono chiusi
+CHECKPOINT_INTERVAL = 256 * 1024 * 1024
+# Statistiche del worker salvate nel checkpoint (e ripristinate alla ripresa)
+STAT_KEYS = ("aiuti", "componenti", "strumenti", "bytes_stripped")
+
+def unit_key(path: str, start: int = None, end: int = None, member: str = None) -> str:
+    text = "\x1f".join(str(v) for v in (Path(path).resolve(), start, end, member))
+    return hashlib.blake2b(text.encode(), digest_size=12).hexdigest()
+
+def checkpoint_path(output_dir, key: str) -> Path:
+    return Path(output_dir) / CHECKPOINT_DIR / f"{key}.json"
+
+def load_checkpoint(output_dir, key: str) -> Optional[dict]:
+    path = checkpoint_path(output_dir, key)
+    if not path.exists():
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def _source_signature(path: str) -> Dict[str, int]:
+    st = os.stat(path)
+    return {"source_size": st.st_size, "source_mtime_ns": st.st_mtime_ns}
+
+def _prefixed_outputs(output_dir: Path, prefix: str) -> List[str]:
+    """File Parquet scritti con il prefisso di un writer, relativi a output_dir"""
+    return [str(f.relative_to(output_dir))
+            for f in output_dir.glob(f"*/{PARTITION_COL}=*/{prefix}-*.parquet")]
+
+class Checkpointer:
+    """
+    Checkpoint di un'unità di lavoro in _checkpoints/<chiave>.json. A ogni commit
+    il parser ha già svuotato i buffer e chiuso i file Parquet: il checkpoint
+    registra gli AIUTO letti, l'offset del file da cui riprendere (None per gli
+    archivi, che riprendono saltando gli AIUTO già letti), i file scritti e le
+    statistiche. Alla fine dell'unità viene salvato con complete=True e rimosso
+    dalla CLI dopo il salvataggio del manifest.
+    """
+    def __init__(self, output_dir, path: str, start: int = None, end: int = None, member: str = None,
+                 interval: int = CHECKPOINT_INTERVAL):
+        self.output_dir = Path(output_dir)
+        self.path = path
+        self.interval = interval
+        self.key = unit_key(path, start, end, member)
+        self.seekable = member is None and not is_archive(path)
+        self.state = {"unit": str(path), "start": start, "end": end, "member": member,
+                      "prefix": None, "seq": 0, "elements": 0, "offset": (start or 0) if self.seekable else None,
+                      "outputs": [], "complete": False, "stats": None, **_source_signature(path)}
+        # Stream dell'unità: i checkpoint scattano ogni interval byte letti
+        self.stream = None
+        self._base = 0
+        self._bytes_at_commit = 0
+
+    def resume(self) -> Optional[dict]:
+        """
+        Carica l'ultimo checkpoint valido, dopo aver rimosso i file scritti dal
+        tentativo precedente dopo quel checkpoint. None se non c'è nulla da riprendere.
+        """
+        state = load_checkpoint(self.output_dir, self.key)
+        if state is None or state["prefix"] is None:
+            return None
+        if any(state.get(k) != v for k, v in _source_signature(self.path).items()):
+            logger.warning(f"{self.path} changed since its checkpoint, starting over")
+            discard_checkpoint(self.output_dir, self.key)
+            return None
+        committed = set(state["outputs"])
+        stale = [f for f in _prefixed_outputs(self.output_dir, state["prefix"]) if f not in committed]
+        for rel in stale:
+            (self.output_dir / rel).unlink(missing_ok=True)
+        if state["stats"]:
+            state["stats"]["dimensions"] = dimensions_from_json(state["stats"]["dimensions"])
+        self.state = state
+        logger.info(f"Resuming {self.path} after {state['elements']} aids"
+                    f"{' (complete)' if state['complete'] else ''}, {len(stale)} uncommitted files removed")
+        return state
+
+    @property
+    def skip(self) -> int:
+        """AIUTO da saltare all'inizio dello stream (solo archivi: i file in chiaro ripartono dall'offset)"""
+        return 0 if self.seekable else self.state["elements"]
+
+    def begin(self, writer):
+        """Checkpoint iniziale: registra il prefisso dei file prima di scriverne"""
+        # Gli AIUTO contati dal parser partono dall'offset (file in chiaro) o dall'inizio del membro
+        self._base = self.state["elements"] if self.seekable else 0
+        self.state["prefix"] = writer.prefix
+        self._save()
+
+    def due(self) -> bool:
+        return self.interval > 0 and self.stream.bytes_in - self._bytes_at_commit >= self.interval
+
+    def commit(self, elements: int, writer, stats: dict, complete: bool = False):
+        """Registra lo stato dopo elements AIUTO letti dal parser in questo tentativo"""
+        state = self.state
+        total = self._base + elements
+        if state["offset"] is not None:
+            state["offset"] = find_aiuto_end(self.path, state["offset"], total - state["elements"])
+        state["elements"] = total
+        state["seq"] = writer.seq
+        state["outputs"] = sorted(set(state["outputs"]) | set(writer.files))
+        state["stats"] = {k: stats[k] for k in STAT_KEYS}
+        state["stats"]["dimensions"] = dimensions_to_json(stats["dimensions"])
+        state["complete"] = complete
+        if self.stream is not None:
+            self._bytes_at_commit = self.stream.bytes_in
+        self._save()
+
+    def _save(self):
+        path = checkpoint_path(self.output_dir, self.key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.state, f)
+        os.replace(tmp, path)
+
+    @property
+    def committed(self) -> List[str]:
+        return self.state["outputs"]
+
+def discard_checkpoint(output_dir, key: str, keep: Set[str] = frozenset()):
+    """
+    Rimuove un checkpoint e tutti i file scritti dai tentativi a cui si riferisce,
+    tranne quelli in keep (già registrati nel manifest)
+    """
+    state = load_checkpoint(output_dir, key)
+    output_dir = Path(output_dir)
+    if state is not None and state.get("prefix"):
+        for rel in _prefixed_outputs(output_dir, state["prefix"]):
+            if rel not in keep:
+                (output_dir / rel).unlink(missing_ok=True)
+    checkpoint_path(output_dir, key).unlink(missing_ok=True)
+
+def prepare_checkpoints(output_dir, units: Iterable[WorkUnit], resume: bool,
+                        keep: Set[str] = frozenset()) -> int:
+    """
+    Prima di un parse: con resume si tengono i checkpoint delle unità da
+    processare; tutti gli altri (unità diverse, o parse senza --resume) vengono
+    eliminati insieme ai loro file, che altrimenti resterebbero come duplicati.
+    keep sono gli output registrati nel manifest, che non vanno mai rimossi.
+    Restituisce il numero di unità che riprenderanno da un checkpoint.
+    """
+    directory = Path(output_dir) / CHECKPOINT_DIR
+    if not directory.exists():
+        return 0
+    wanted = {unit_key(u.path, u.start, u.end, u.member) for u in units} if resume else set()
+    kept = 0
+    for f in directory.glob("*.json"):
+        if f.stem in wanted:
+            kept += 1
+        else:
+            discard_checkpoint(output_dir, f.stem, keep)
+    for f in directory.glob("*.tmp"):
+        f.unlink()
+    return kept
+
+def clear_checkpoints(output_dir, units: Iterable[WorkUnit]):
+    """Rimuove i checkpoint di unità i cui output sono ormai registrati nel manifest"""
+    for u in units:
+        checkpoint_path(output_dir, unit_key(u.path, u.start, u.end, u.member)).unlink(missing_ok=True)
+
+def held_outputs(output_dir) -> List[str]:
+    """
+    Checkpoint rimasti (unità fallite o interrotte) e tutti i file scritti dai
+    loro tentativi, relativi a output_dir: non fanno parte del dataset finché
+    un parse --resume non completa le unità.
+    """
+    output_dir = Path(output_dir)
+    directory = output_dir / CHECKPOINT_DIR
+    if not directory.exists():
+        return []
+    held = []
+    for f in directory.glob("*.json"):
+        state = load_checkpoint(output_dir, f.stem)
+        if state.get("prefix"):
+            held += _prefixed_outputs(output_dir, state["prefix"])
+        held.append(str(f.relative_to(output_dir)))
+    return held
@@ -1,13 +1,27 @@
+import sys
 import click
+import polars as pl
 import multiprocessing
 from pathlib import Path
 import time
 from typing import List
 import logging
-from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
 from .parser import process_file
-from .exporter import export_dataset, run_query, export_aggregated_dataset
+from .sources import discover_inputs, build_work_units
+from .manifest import Manifest, source_key
+from .compactor import compact_dataset
+from .scheduler import run_work_units, effective_workers, WORKER_MEMORY_ESTIMATE
+from .exporter import export_dataset, run_query, export_aggregated_dataset, parse_years, DATA_DIR
+from .catalog import QuerySession, refresh_catalog, run_script, run_shell, TABLES
+from .results import OUTPUT_FORMATS, PAGE_SIZE
+from .dimensions import combine_dimensions, merge_dimensions
+from .index import update_index, lookup as lookup_beneficiary
+from .search import update_search_index, search as search_aiuti
+from .server import serve as serve_dataset, DEFAULT_CONNECTIONS
+from .metrics import build_report, chrome_trace, log_report, write_json
+from .checkpoint import CHECKPOINT_INTERVAL, prepare_checkpoints, clear_checkpoints, held_outputs
+from .snapshots import Snapshot, StagedVersion, resolve_data_dir
 
 # Configuration logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -19,94 +33,314 @@ def cli():
     pass
 
 @cli.command()
-@click.option('--input', '-i', required=True, help='Input directory or file path')
+@click.option('--input', '-i', required=True, help='Input directory or file path (.xml, .zip, .xml.gz, .xml.zst)')
 @click.option('--output', '-o', default='public/parquet', help='Output directory for Parquet files')
 @click.option('--workers', '-w', default=4, help='Number of worker processes')
-def parse(input, output, workers):
-    """Parse XML files and convert to Parquet"""
+@click.option('--chunk-size', default=64, show_default=True, help='Split XML files larger than this (MB) into byte ranges parsed in parallel, at most one per worker (0 disables)')
+@click.option('--full-refresh', is_flag=True, help='Re-parse every input file into a new, empty dataset version')
+@click.option('--memory-per-worker', default=WORKER_MEMORY_ESTIMATE // 2**20, show_default=True, help='Memory budget per worker (MB): sizes parser buffers and caps the number of workers to the available RAM')
+@click.option('--profile', 'profile_path', default=None, help='Write per-stage timings, throughput and peak RSS of each work unit to this JSON file')
+@click.option('--trace', 'trace_path', default=None, help='Write a Chrome trace (chrome://tracing, Perfetto) of the workers to this file')
+@click.option('--checkpoint-interval', default=CHECKPOINT_INTERVAL // 2**20, show_default=True, help='Commit a checkpoint of each work unit every this many MB of input (0 disables)')
+@click.option('--resume', is_flag=True, help='Resume interrupted work units from their last checkpoint instead of starting over')
+def parse(input, output, workers, chunk_size, full_refresh, memory_per_worker, profile_path, trace_path,
+          checkpoint_interval, resume):
+    """Parse XML files (plain or zip/gz/zst archives) and convert to Parquet"""
     input_path = Path(input)
     output_path = Path(output)
     
-    # Pulizia preventiva della cartella di output per evitare conflitti di schema o dati misti
-    if output_path.exists():
-        logger.info(f"Cleaning output directory {output_path}...")
-        import shutil
-        shutil.rmtree(output_path)
+    manifest = Manifest.load(str(resolve_data_dir(output_path)))
+    if output_path.exists() and not full_refresh and not manifest.compatible:
+        logger.warning("Output directory has no compatible manifest, running a full refresh")
+        full_refresh = True
     
-    output_path.mkdir(parents=True, exist_ok=True)
+    # Il parse scrive una nuova versione del dataset (vuota solo su richiesta o con
+    # schema incompatibile): query ed export continuano a leggere quella pubblicata
+    try:
+        staging = StagedVersion(output_path, fresh=full_refresh, resume=resume)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    with staging:
+        _ingest(staging, input_path, workers, chunk_size, memory_per_worker, profile_path, trace_path,
+                checkpoint_interval, resume)
+
+def _ingest(staging: StagedVersion, input_path: Path, workers: int, chunk_size: int, memory_per_worker: int,
+            profile_path: str, trace_path: str, checkpoint_interval: int, resume: bool):
+    """Corpo di parse: processa gli input nella versione staging e la pubblica"""
+    output_path = staging.path
+    manifest = Manifest.load(str(output_path))
     
-    files = []
-    if input_path.is_file():
-        files.append(str(input_path))
-    else:
-        # Recursive search for XML files
-        files = [str(p) for p in input_path.rglob("*.xml")]
+    # Recursive search for XML files and zip/gz/zst archives
+    files = discover_inputs(input_path)
+    
+    # Ingest incrementale: solo i file nuovi o modificati rispetto al manifest
+    files, unchanged, removed = manifest.plan(files, input_path)
+    for key in removed:
+        logger.info(f"Source {key} no longer exists, removing its outputs")
+        manifest.delete_outputs(manifest.forget(key))
+    
+    logger.info(f"Found {len(files)} new or changed input files to process ({len(unchanged)} unchanged, skipped)")
+    
+    # Niente di nuovo: la versione preparata sarebbe identica a quella pubblicata
+    if not (files or removed or manifest.touched or staging.must_publish):
+        staging.discard()
+        return
+    
+    # Ogni file grande viene diviso in intervalli di byte allineati sugli elementi <AIUTO>
+    # (al più uno per worker, contigui: ogni unità scrive i propri file), ogni membro
+    # di un archivio diventa un'unità di lavoro a sé
+    workers = effective_workers(workers, memory_per_worker * 2**20)
+    work_units = build_work_units(files, chunk_size * 1024 * 1024, max_ranges=workers)
     
-    logger.info(f"Found {len(files)} XML files to process")
-    logger.info(f"Starting processing with {workers} workers...")
+    # Checkpoint di un parse interrotto: ripresi con --resume, altrimenti scartati con i loro file
+    resumed = prepare_checkpoints(output_path, work_units, resume, keep=manifest.all_outputs())
+    if resumed:
+        logger.info(f"Resuming {resumed} work units from their checkpoints")
+    
+    logger.info(f"Starting processing of {len(work_units)} work units with up to {workers} workers...")
     
     start_time = time.time()
     
-    total_stats = {"aiuti": 0, "componenti": 0, "strumenti": 0}
+    total_stats = {"aiuti": 0, "componenti": 0, "strumenti": 0, "bytes_stripped": 0}
     failed_files = []
+    # Output e statistiche raccolti per file sorgente (un file può avere più unità)
+    # Le coppie codice/descrizione trovate dalle unità ("dimensions") sono unite alle
+    # tabelle dimensione a fine parse
+    source_results = {f: {"outputs": [], "committed": [], "units": [], "dimensions": [],
+                          "stats": dict.fromkeys(total_stats, 0), "failed": False} for f in files}
+    # Metriche per unità restituite dai worker con --profile/--trace
+    profiles = []
+    profiling = bool(profile_path or trace_path)
+    
+    total_bytes = sum(u.size for u in work_units)
     
-    with ProcessPoolExecutor(max_workers=workers) as executor:
-        # Map future to filename for error tracking
-        futures = {executor.submit(process_file, f, str(output_path)): f for f in files}
-        
-        with tqdm(total=len(files), desc="Processing files") as pbar:
-            for future in as_completed(futures):
-                filename = futures[future]
-                try:
-                    stats = future.result()
-                    if stats.get("error", 0) > 0:
-                         failed_files.append(filename)
-                    else:
-                        for k, v in stats.items():
-                            if k in total_stats:
-                                total_stats[k] += v
-                except Exception as e:
-                    logger.error(f"Worker failed for {filename}: {e}")
+    # Unità in ordine LPT, progresso in byte di input e record al secondo
+    with tqdm(total=total_bytes, unit="B", unit_scale=True, unit_divisor=1024, desc="Processing") as pbar:
+        results = run_work_units(
+            work_units, process_file,
+            lambda u: (u.path, str(output_path), u.start, u.end, u.member, profiling, bool(trace_path),
+                       memory_per_worker * 2**20, checkpoint_interval * 2**20, resume),
+            workers, memory_per_worker=memory_per_worker * 2**20
+        )
+        for unit, stats, error in results:
+            filename = unit.label
+            result = source_results[unit.path]
+            if error is not None:
+                logger.error(f"Worker failed for {filename}: {error}")
+                result["failed"] = True
+                if filename not in failed_files:
                     failed_files.append(filename)
-                finally:
-                    pbar.update(1)
+            else:
+                result["outputs"].extend(stats.get("outputs", []))
+                result["committed"].extend(stats.get("committed", []))
+                if stats.get("error", 0) > 0:
+                    result["failed"] = True
+                    if filename not in failed_files:
+                        failed_files.append(filename)
+                else:
+                    # Hash dei byte letti dal worker: il manifest non rilegge la sorgente
+                    result["units"].append((unit.member, unit.start, unit.end, stats["digest"]))
+                    for k, v in stats.items():
+                        if k in total_stats:
+                            total_stats[k] += v
+                            result["stats"][k] += v
+                    result["dimensions"].append(((unit.member or "", unit.start or 0), stats["dimensions"]))
+                    if "profile" in stats:
+                        profiles.append(stats["profile"])
+            pbar.update(unit.size)
+            elapsed = max(time.time() - start_time, 1e-6)
+            pbar.set_postfix(records_s=f"{total_stats['aiuti'] / elapsed:,.0f}")
+    
+    # Sostituzione degli output: i vecchi file di una sorgente vengono rimossi solo
+    # dopo che i nuovi sono stati scritti; in caso di errore si tengono i vecchi
+    # (e i file coperti da un checkpoint, da cui ripartirà --resume)
+    for f, result in source_results.items():
+        if result["failed"]:
+            manifest.delete_outputs(set(result["outputs"]) - set(result["committed"]))
+        else:
+            manifest.delete_outputs(set(manifest.outputs(f)) - set(result["outputs"]))
+            manifest.record(f, result["outputs"], result["stats"], result["units"])
+    # Ordine deterministico (sorgenti come nel manifest, poi unità): per un codice con
+    # descrizioni diverse vince l'ultima, qualunque sia l'ordine di completamento dei worker.
+    # Le dimensioni vengono unite prima di salvare il manifest: se falliscono, i checkpoint
+    # restano e un --resume ripete l'unione
+    dimensions = combine_dimensions(
+        pairs for f in sorted(source_results, key=source_key) if not source_results[f]["failed"]
+        for _, pairs in sorted(source_results[f]["dimensions"], key=lambda d: d[0])
+    )
+    merge_dimensions(output_path, dimensions)
+    manifest.save()
+    # I checkpoint servono finché gli output non sono nel manifest
+    clear_checkpoints(output_path, [u for u in work_units if not source_results[u.path]["failed"]])
+    refresh_catalog(output_path)
+    update_index(output_path)
+    update_search_index(output_path)
+    # Pubblicazione atomica; i file delle unità da riprendere restano fuori dalla versione
+    staging.publish(hold=held_outputs(output_path))
     
     elapsed = time.time() - start_time
     logger.info(f"Processing completed in {elapsed:.2f} seconds")
     logger.info(f"Total processed records: {total_stats}")
+    if profiling:
+        report = build_report(profiles, elapsed, workers)
+        log_report(report)
+        if profile_path:
+            write_json(profile_path, report)
+            logger.info(f"Profile written to {profile_path}")
+        if trace_path:
+            write_json(trace_path, chrome_trace(profiles))
+            logger.info(f"Chrome trace written to {trace_path}")
     
     if failed_files:
-        failure_path = output_path.parent / "failures.txt"
+        failure_path = staging.root.parent / "failures.txt"
         with open(failure_path, "w") as f:
             for fail in failed_files:
                 f.write(f"{fail}\n")
         logger.warning(f"WARNING: {len(failed_files)} files failed. List saved to {failure_path}")
+        if checkpoint_interval:
+            logger.warning("Rerun with --resume to continue them from their last checkpoint")
     else:
         logger.info("All files processed successfully.")
 
 @cli.command()
-@click.option('--table', '-t', required=True, type=click.Choice(['aiuti', 'componenti', 'strumenti']), help='Table to query')
+@click.option('--output', '-o', default='public/parquet', help='Parquet dataset directory to compact')
+@click.option('--table', '-t', 'tables', multiple=True, type=click.Choice(TABLES), help='Table to compact (repeatable, default all)')
+@click.option('--target-file-size', default=256, show_default=True, help='Target Parquet file size (MB)')
+@click.option('--row-group-size', default=122880, show_default=True, help='Rows per row group')
+@click.option('--threads', default=None, type=int, help='DuckDB threads (default all cores)')
+def compact(output, tables, target_file_size, row_group_size, threads):
+    """Rewrite each ANNO partition into sorted, zstd-compressed, right-sized files"""
+    # Compattazione in una nuova versione: le query in corso non vedono file a metà
+    try:
+        staging = StagedVersion(output, discard_held=False)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    with staging:
+        report = compact_dataset(
+            str(staging.path), list(tables) or None,
+            target_file_size=target_file_size * 1024 * 1024,
+            row_group_size=row_group_size,
+            threads=threads
+        )
+        # compact_dataset aggiorna già catalogo e indici della versione
+        staging.publish()
+    for table, r in report.items():
+        click.echo(
+            f"{table:<12} files {r['before']['files']:>6} -> {r['after']['files']:<6} "
+            f"size {r['before']['bytes'] / 1e6:>10.1f} -> {r['after']['bytes'] / 1e6:<10.1f} MB "
+            f"scan {r['before']['scan_seconds']:>7.2f} -> {r['after']['scan_seconds']:.2f} s"
+        )
+
+def _more() -> bool:
+    """Pausa tra le pagine del risultato: False se l'utente preme q"""
+    click.echo("-- More -- (any key to continue, q to quit)", nl=False)
+    key = click.getchar()
+    click.echo()
+    return key.lower() != "q"
+
+@cli.command()
+@click.option('--table', '-t', required=True, type=click.Choice(TABLES), help='Table to query')
 @click.option('--query', '-q', required=False, help='SQL query to filter data (DuckDB syntax)')
 @click.option('--limit', '-l', default=10, help='Limit results')
-def query(table, query, limit):
+@click.option('--out', 'out', default=None, help='Stream the result to a file instead of the terminal')
+@click.option('--format', '-f', 'fmt', type=click.Choice(OUTPUT_FORMATS), default=None, help='Output file format (default from --out extension)')
+@click.option('--page-size', default=PAGE_SIZE, show_default=True, help='Rows per page on the terminal')
+@click.option('--no-cache', is_flag=True, help='Always run the query, bypassing the result cache')
+def query(table, query, limit, out, fmt, page_size, no_cache):
     """Run interactive queries on dataset"""
-    run_query(table, query, limit)
+    wait = _more if sys.stdout.isatty() else None
+    run_query(table, query, limit, output=out, fmt=fmt, page_size=page_size, wait=wait, cache=not no_cache)
 
 @cli.command()
-@click.option('--table', '-t', required=True, type=click.Choice(['aiuti', 'componenti', 'strumenti']), help='Table to export')
+@click.option('--script', '-s', type=click.Path(exists=True, dir_okay=False), help='Run the SQL statements in this file and exit')
+@click.option('--threads', default=None, type=int, help='DuckDB threads (default all cores)')
+@click.option('--memory-limit', default=None, help='DuckDB memory limit, e.g. 4GB')
+def sql(script, threads, memory_limit):
+    """SQL shell on the dataset catalog (aiuti, componenti, strumenti, aiuti_completi)"""
+    with Snapshot(DATA_DIR) as snapshot, \
+            QuerySession(snapshot.path, threads=threads, memory_limit=memory_limit) as session:
+        if script:
+            run_script(session, Path(script).read_text())
+        else:
+            run_shell(session)
+
+def _parse_years(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        return parse_years(value)
+    except ValueError:
+        raise click.BadParameter(f"invalid years specification: {value}")
+
+@cli.command()
+@click.option('--table', '-t', required=True, type=click.Choice(TABLES), help='Table to export')
 @click.option('--format', '-f', type=click.Choice(['csv', 'txt']), default='csv', help='Output format')
 @click.option('--output', '-o', required=True, help='Output file path')
 @click.option('--delimiter', '-d', default=',', help='Delimiter for TXT/CSV')
-def export(table, format, output, delimiter):
+@click.option('--years', '-y', default=None, callback=_parse_years, help='Years to export, e.g. 2021,2022 or 2020-2023')
+@click.option('--columns', '-c', default=None, help='Comma-separated columns to export')
+@click.option('--where', '-w', default=None, help="Row filter (SQL condition), e.g. \"REGIONE_BENEFICIARIO = 'Lazio'\"")
+def export(table, format, output, delimiter, years, columns, where):
     """Export dataset to CSV or TXT"""
-    export_dataset(table, format, output, delimiter)
+    columns = [c.strip() for c in columns.split(",") if c.strip()] if columns else None
+    export_dataset(table, format, output, delimiter, years=years, columns=columns, where=where)
 
 @cli.command()
 @click.option('--output', '-o', required=True, help='Output CSV file path')
 @click.option('--delimiter', '-d', default=',', help='Delimiter for CSV')
-def export_aggregated(output, delimiter):
+@click.option('--jobs', '-j', default=None, type=int, help='Years exported in parallel (default: CPU count)')
+@click.option('--memory-budget', default=None, type=int, help='Memory budget in MB for the years in flight (default: available RAM)')
+def export_aggregated(output, delimiter, jobs, memory_budget):
     """Export aggregated dataset (AIUTI + COMP + STRUM) to CSV"""
-    export_aggregated_dataset(output, delimiter)
+    export_aggregated_dataset(output, delimiter, jobs=jobs,
+                              memory_budget=memory_budget * 1024 * 1024 if memory_budget else None)
+
+@cli.command()
+@click.option('--cf', default=None, help='Beneficiary tax code (CODICE_FISCALE_BENEFICIARIO)')
+@click.option('--cup', default=None, help='Project code (CUP)')
+def lookup(cf, cup):
+    """Find the aids, components and instruments of a tax code or CUP using the index"""
+    if bool(cf) == bool(cup):
+        raise click.UsageError("Specify exactly one of --cf or --cup")
+    key_type, key = ("CF", cf) if cf else ("CUP", cup)
+    with Snapshot(DATA_DIR) as snapshot:
+        results = lookup_beneficiary(snapshot.path, key_type, key)
+    if not results:
+        click.echo(f"No aids found for {key_type} {key}")
+        return
+    with pl.Config(tbl_rows=-1, tbl_cols=-1, fmt_str_lengths=60):
+        for table, df in results.items():
+            click.echo(f"{table}: {df.height} rows")
+            click.echo(df)
+
+@cli.command()
+@click.argument('text')
+@click.option('--limit', '-l', default=20, show_default=True, help='Maximum number of results')
+def search(text, limit):
+    """Full-text search over project and measure titles/descriptions (BM25 ranking)"""
+    start = time.perf_counter()
+    with Snapshot(DATA_DIR) as snapshot:
+        results = search_aiuti(snapshot.path, text, limit)
+    elapsed = (time.perf_counter() - start) * 1000
+    if results.is_empty():
+        click.echo(f"No aids match '{text}' ({elapsed:.0f} ms)")
+        return
+    columns = [c for c in ("SCORE", "CAR", "COR", "ANNO", "TITOLO_PROGETTO", "TITOLO_MISURA", "DENOMINAZIONE_BENEFICIARIO")
+               if c in results.columns]
+    with pl.Config(tbl_rows=-1, fmt_str_lengths=60):
+        click.echo(results.select(columns))
+    click.echo(f"{results.height} results in {elapsed:.0f} ms")
+
+@cli.command()
+@click.option('--host', default='127.0.0.1', show_default=True, help='Address to listen on')
+@click.option('--port', '-p', default=8080, show_default=True, help='Port to listen on')
+@click.option('--connections', default=DEFAULT_CONNECTIONS, show_default=True, help='Warm DuckDB connections (queries run concurrently)')
+@click.option('--threads', default=None, type=int, help='DuckDB threads (default all cores)')
+@click.option('--memory-limit', default=None, help='DuckDB memory limit, e.g. 4GB')
+def serve(host, port, connections, threads, memory_limit):
+    """HTTP service for query, lookup, search and export (NDJSON, Arrow IPC or CSV streams)"""
+    click.echo(f"Serving {DATA_DIR} on http://{host}:{port}")
+    serve_dataset(DATA_DIR, host, port, connections, threads, memory_limit)
 
 if __name__ == '__main__':
     cli()
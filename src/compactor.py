@@ -0,0 +1,143 @@
+import os
+import time
+import shutil
+import logging
+from pathlib import Path
+from typing import Dict, List
+import duckdb
+from .models import SORT_KEYS
+from .manifest import Manifest
+from .catalog import arrow_reader, refresh_catalog
+from .index import update_index
+from .search import update_search_index
+
+logger = logging.getLogger(__name__)
+
+COMPACT_PREFIX = "c-"
+TARGET_FILE_SIZE = 256 * 1024 * 1024
+ROW_GROUP_SIZE = 122880
+BLOOM_FILTER_FPP = 0.01
+# Colonne con più valori distinti di così non usano dictionary (e quindi bloom filter)
+DICTIONARY_SIZE_LIMIT = 1_000_000
+TMP_DIR_NAME = "_compact_tmp"
+
+def _quote(path) -> str:
+    return "'" + str(path).replace("'", "''") + "'"
+
+def _file_list(files: List[Path]) -> str:
+    return "[" + ", ".join(_quote(f) for f in files) + "]"
+
+def _scan_seconds(con, files: List[Path]) -> float:
+    """Tempo di una scansione completa (tutte le colonne) dei file indicati"""
+    if not files:
+        return 0.0
+    start = time.perf_counter()
+    reader = arrow_reader(con.execute(
+        f"SELECT * FROM read_parquet({_file_list(files)}, hive_partitioning=false, union_by_name=true)"
+    ))
+    for _ in reader:
+        pass
+    return time.perf_counter() - start
+
+def _table_summary(con, table_dir: Path) -> Dict[str, float]:
+    files = sorted(table_dir.glob("ANNO=*/*.parquet"))
+    return {
+        "files": len(files),
+        "bytes": sum(f.stat().st_size for f in files),
+        "scan_seconds": round(_scan_seconds(con, files), 3),
+    }
+
+def compact_dataset(data_dir: str, tables: List[str] = None,
+                    target_file_size: int = TARGET_FILE_SIZE,
+                    row_group_size: int = ROW_GROUP_SIZE,
+                    threads: int = None) -> Dict[str, dict]:
+    """
+    Riscrive ogni partizione ANNO=YYYY delle tabelle in file di dimensione
+    target_file_size, con row group ottimizzati, compressione zstd, righe ordinate
+    su SORT_KEYS, statistiche di colonna e bloom filter.
+
+    I file vengono fusi per sorgente (secondo il manifest di ingest), così il
+    parse incrementale può ancora sostituire gli output di un singolo file.
+    Un gruppo già compattato (un solo file compatto) viene saltato: il comando
+    può essere rilanciato senza effetti. Restituisce le statistiche prima/dopo.
+    """
+    base = Path(data_dir)
+    tables = tables or list(SORT_KEYS)
+    manifest = Manifest.load(data_dir)
+    owners = {rel: key for key, entry in manifest.sources.items() for rel in entry["outputs"]}
+    tmp_root = base / TMP_DIR_NAME
+
+    con = duckdb.connect()
+    if threads:
+        con.execute(f"SET threads = {int(threads)}")
+
+    report = {}
+    try:
+        for table in tables:
+            table_dir = base / table
+            if not table_dir.exists():
+                continue
+            before = _table_summary(con, table_dir)
+            order_by = ", ".join(f'"{c}"' for c in SORT_KEYS[table])
+
+            for part_dir in sorted(table_dir.glob("ANNO=*")):
+                # Raggruppamento dei file della partizione per sorgente di provenienza
+                groups: Dict[str, List[Path]] = {}
+                for f in sorted(part_dir.glob("*.parquet")):
+                    rel = str(f.relative_to(base))
+                    groups.setdefault(owners.get(rel), []).append(f)
+
+                for owner, files in groups.items():
+                    if len(files) == 1 and files[0].name.startswith(COMPACT_PREFIX) \
+                            and files[0].stat().st_size <= target_file_size:
+                        continue
+
+                    tmp_dir = tmp_root / table / part_dir.name
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+                    tmp_dir.parent.mkdir(parents=True, exist_ok=True)
+
+                    con.execute(f"""
+                        COPY (
+                            SELECT * FROM read_parquet({_file_list(files)}, hive_partitioning=false, union_by_name=true)
+                            ORDER BY {order_by}
+                        ) TO {_quote(tmp_dir)} (
+                            FORMAT parquet,
+                            COMPRESSION zstd,
+                            ROW_GROUP_SIZE {int(row_group_size)},
+                            FILE_SIZE_BYTES {int(target_file_size)},
+                            FILENAME_PATTERN '{COMPACT_PREFIX}{{uuid}}',
+                            DICTIONARY_SIZE_LIMIT {DICTIONARY_SIZE_LIMIT},
+                            BLOOM_FILTER_FALSE_POSITIVE_RATIO {BLOOM_FILTER_FPP}
+                        )
+                    """)
+
+                    # I nuovi file entrano nella partizione prima di rimuovere i vecchi
+                    new_files = []
+                    for f in sorted(tmp_dir.glob("*.parquet")):
+                        dest = part_dir / f.name
+                        os.replace(f, dest)
+                        new_files.append(str(dest.relative_to(base)))
+                    old_files = [str(f.relative_to(base)) for f in files]
+
+                    if owner is not None:
+                        entry = manifest.sources[owner]
+                        entry["outputs"] = sorted((set(entry["outputs"]) - set(old_files)) | set(new_files))
+                        manifest.save()
+                    for f in files:
+                        f.unlink()
+
+            after = _table_summary(con, table_dir)
+            report[table] = {"before": before, "after": after}
+            logger.info(
+                f"{table}: {before['files']} -> {after['files']} files, "
+                f"{before['bytes'] / 1e6:.1f} -> {after['bytes'] / 1e6:.1f} MB, "
+                f"scan {before['scan_seconds']:.2f}s -> {after['scan_seconds']:.2f}s"
+            )
+    finally:
+        con.close()
+        shutil.rmtree(tmp_root, ignore_errors=True)
+
+    refresh_catalog(base)
+    update_index(base)
+    update_search_index(base)
+    return report
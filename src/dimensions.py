@@ -0,0 +1,117 @@
+import os
+import logging
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+import polars as pl
+import pyarrow as pa
+import pyarrow.parquet as pq
+from .models import DIMENSIONS, dimension_schema
+
+logger = logging.getLogger(__name__)
+
+DIMENSIONS_DIR = "dimensioni"
+
+def dimension_path(data_dir, name: str) -> Path:
+    return Path(data_dir) / DIMENSIONS_DIR / f"{name}.parquet"
+
+def _code_value(code, code_type: pa.DataType):
+    """Codice nel tipo dello schema (i codici interi possono arrivare come stringhe, es. da JSON)"""
+    return int(code) if pa.types.is_integer(code_type) else str(code)
+
+def dimensions_to_json(found: Dict[str, dict]) -> Dict[str, list]:
+    """Coppie codice/descrizione come liste [codice, descrizione]: in JSON le chiavi diventerebbero stringhe"""
+    return {name: [[code, description] for code, description in pairs.items()] for name, pairs in found.items()}
+
+def dimensions_from_json(data: Dict[str, list]) -> Dict[str, dict]:
+    """Inverso di dimensions_to_json, con i codici convertiti nel tipo dello schema"""
+    found = {}
+    for name, pairs in data.items():
+        schema = dimension_schema(name)
+        code_type = schema.field(schema.names[0]).type
+        found[name] = {_code_value(code, code_type): description for code, description in pairs}
+    return found
+
+def _apply(merged: dict, pairs: dict, code_type: pa.DataType, conflicts: list):
+    """Aggiunge pairs a merged: in caso di descrizione diversa per lo stesso codice vince pairs"""
+    for code, description in pairs.items():
+        code = _code_value(code, code_type)
+        previous = merged.get(code)
+        if previous is not None and previous != description:
+            conflicts.append((code, previous, description))
+        merged[code] = description
+
+def combine_dimensions(parts: Iterable[Dict[str, dict]]) -> Dict[str, dict]:
+    """
+    Unisce le coppie codice/descrizione trovate dalle unità di lavoro, nell'ordine
+    dato (sorgenti in ordine di manifest): a parità di codice vince l'ultima
+    descrizione, così il risultato non dipende dall'ordine di completamento dei worker.
+    """
+    parts = list(parts)
+    combined = {name: {} for name in DIMENSIONS}
+    for name, (code, _) in DIMENSIONS.items():
+        conflicts = []
+        code_type = dimension_schema(name).field(code).type
+        for part in parts:
+            _apply(combined[name], part.get(name, {}), code_type, conflicts)
+        log_conflicts(name, conflicts)
+    return combined
+
+def log_conflicts(name: str, conflicts: list):
+    """Segnala i codici con più descrizioni (codice, precedente, nuova): vince sempre l'ultima"""
+    if not conflicts:
+        return
+    examples = "; ".join(f"{c}: {old!r} -> {new!r}" for c, old, new in conflicts[:3])
+    logger.warning(f"Dimension {name}: {len(conflicts)} codes with a different description, "
+                   f"keeping the latest ({examples})")
+
+def merge_dimensions(data_dir, found: Dict[str, dict]) -> Dict[str, int]:
+    """
+    Unisce le coppie codice/descrizione trovate dal parse alle tabelle dimensione
+    esistenti: per un codice già presente vince la descrizione appena letta (i
+    conflitti vengono segnalati nel log). I codici vengono convertiti nel tipo
+    dello schema. Ogni file viene riscritto in modo atomico. Restituisce le righe
+    per dimensione.
+    """
+    sizes = {}
+    for name, pairs in found.items():
+        path = dimension_path(data_dir, name)
+        schema = dimension_schema(name)
+        code, description = schema.names
+        code_type = schema.field(code).type
+        merged = {}
+        if path.exists():
+            existing = pq.read_table(path)
+            merged.update(zip(existing.column(code).to_pylist(), existing.column(description).to_pylist()))
+        conflicts = []
+        _apply(merged, pairs, code_type, conflicts)
+        log_conflicts(name, conflicts)
+        if not merged:
+            continue
+        codes = sorted(merged)
+        table = pa.table({code: codes, description: [merged[c] for c in codes]}, schema=schema)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        pq.write_table(table, tmp, compression="zstd")
+        os.replace(tmp, path)
+        sizes[name] = len(codes)
+    return sizes
+
+def attach_descriptions(lf: pl.LazyFrame, data_dir, columns: Optional[Iterable[str]] = None) -> pl.LazyFrame:
+    """
+    Riunisce a lf le descrizioni delle dimensioni di cui contiene il codice.
+    Con columns vengono aggiunte solo le descrizioni richieste; se la tabella
+    dimensione non esiste la descrizione è null.
+    """
+    wanted = None if columns is None else set(columns)
+    present = lf.collect_schema().names()
+    for name, (code, description) in DIMENSIONS.items():
+        if code not in present or description in present:
+            continue
+        if wanted is not None and description not in wanted:
+            continue
+        path = dimension_path(data_dir, name)
+        if path.exists():
+            lf = lf.join(pl.scan_parquet(path), on=code, how="left")
+        else:
+            lf = lf.with_columns(pl.lit(None, dtype=pl.String).alias(description))
+    return lf
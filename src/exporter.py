@@ -1,248 +1,361 @@
+import os
 import polars as pl
 import duckdb
 from pathlib import Path
+from typing import Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 import logging
+from tqdm import tqdm
+from .catalog import QuerySession, arrow_reader, build_query
+from .cache import ResultCache
+from .results import write_batches, page_batches, BATCH_ROWS, PAGE_SIZE
+from .scheduler import available_memory
+from .models import DIMENSIONS
+from .dimensions import attach_descriptions
+from .snapshots import Snapshot, resolve_data_dir
 
 logger = logging.getLogger(__name__)
 
+# Cartella del dataset: le funzioni leggono la versione pubblicata (vedi snapshots.py)
 DATA_DIR = Path("public/parquet")
 
-def get_dataset_path(table: str) -> str:
-    return str(DATA_DIR / table)
+def get_dataset_path(table: str, data_dir: Path = None) -> str:
+    return str((data_dir or resolve_data_dir(DATA_DIR)) / table)
 
-def run_query(table: str, sql_query: str = None, limit: int = 10):
-    """Esegue una query SQL su DuckDB usando i file Parquet"""
-    dataset_path = get_dataset_path(table) + "/**/*.parquet"
-    
-    con = duckdb.connect()
-    
+def _emit(reader, output: str, fmt: str, page_size: int, wait):
+    if output:
+        rows = write_batches(reader, output, fmt)
+        logger.info(f"Wrote {rows} rows to {output}")
+    else:
+        page_batches(reader, page_size, wait=wait)
+
+def run_query(table: str, sql_query: str = None, limit: int = 10, output: str = None,
+              fmt: str = None, page_size: int = PAGE_SIZE, wait=None, cache: bool = True):
+    """
+    Esegue una query SQL su DuckDB tramite il catalogo persistente del dataset.
+    Il risultato viene letto a record batch Arrow: stampato a pagine oppure, con
+    output, scritto in streaming su file Parquet/CSV/NDJSON.
+    Con cache i risultati letti per intero vengono salvati nella cache su disco
+    e riusati finché i file del dataset non cambiano.
+    La query legge la versione pubblicata all'avvio, anche se nel frattempo un
+    parse ne pubblica una nuova.
+    """
     try:
-        # Registra la vista su glob pattern per leggere tutte le partizioni
-        query_base = f"SELECT * FROM read_parquet('{dataset_path}')"
-        
-        final_query = sql_query if sql_query else f"{query_base} LIMIT {limit}"
-        
-        # Se l'utente ha scritto una query custom ma senza specificare la tabella sorgente
-        # cerchiamo di iniettarla (approccio semplice per CLI)
-        if "FROM" not in final_query.upper():
-             final_query = f"SELECT * FROM read_parquet('{dataset_path}') WHERE {final_query}"
-             
-        print(f"Executing: {final_query}")
-        result = con.execute(final_query).df()
-        print(result)
-        
+        # Query completa (le tabelle sono viste: FROM aiuti, JOIN componenti, ...)
+        # oppure semplice condizione WHERE sulla tabella scelta
+        final_query = build_query(table, sql_query, limit)
+        with Snapshot(DATA_DIR) as snapshot:
+            _run_query(snapshot.path, final_query, output, fmt, page_size, wait, cache, snapshot.version)
     except Exception as e:
         logger.error(f"Query error: {e}")
-    finally:
-        con.close()
 
-def export_dataset(table: str, format: str, output_path: str, delimiter: str = ","):
-    """Esporta il dataset in CSV/TXT usando Polars"""
-    dataset_path = get_dataset_path(table)
-    
+def _run_query(data_dir: Path, final_query: str, output: str, fmt: str, page_size: int, wait, cache: bool,
+               version: str = None):
+    results = ResultCache(data_dir, version=version) if cache else None
+    reader = results.get(final_query) if results else None
+    if reader is not None:
+        logger.info(f"Cached result: {final_query}")
+        _emit(reader, output, fmt, page_size, wait)
+        return
+
+    with QuerySession(data_dir) as session:
+        logger.info(f"Executing: {final_query}")
+        result = session.execute(final_query)
+        if result.description is None:
+            return
+        reader = arrow_reader(result, BATCH_ROWS)
+        if results:
+            reader = results.store(final_query, reader)
+        _emit(reader, output, fmt, page_size, wait)
+
+def parse_years(spec: str) -> List[int]:
+    """Anni da una specifica come "2021,2022" o "2020-2023" (anche combinate)"""
+    years = set()
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            first, last = (int(p) for p in part.split("-", 1))
+            years.update(range(first, last + 1))
+        else:
+            years.add(int(part))
+    return sorted(years)
+
+def scan_table(table: str, years: List[int] = None, columns: List[str] = None,
+               where: str = None, data_dir: Path = None) -> pl.LazyFrame:
+    """
+    Scansione lazy di una tabella con i filtri spinti fino alla lettura:
+    - years: vengono lette solo le cartelle ANNO=YYYY richieste
+    - where: condizione SQL valutata anche sulle statistiche dei row group
+    - columns: vengono lette solo le colonne indicate
+    Le descrizioni delle dimensioni vengono riunite solo se richieste
+    (tutte se columns non è indicato). data_dir è la versione del dataset da
+    leggere (default: quella pubblicata, senza lease).
+    """
+    data_dir = data_dir or resolve_data_dir(DATA_DIR)
+    dataset_path = Path(get_dataset_path(table, data_dir))
+    if years is None:
+        sources = str(dataset_path / "**" / "*.parquet")
+    else:
+        # Pruning delle partizioni prima della scansione: le altre cartelle non vengono nemmeno elencate
+        sources = [str(dataset_path / f"ANNO={y}" / "*.parquet") for y in years
+                   if next((dataset_path / f"ANNO={y}").glob("*.parquet"), None) is not None]
+        if not sources:
+            raise FileNotFoundError(f"No {table} partitions for years {years}")
+
+    lf = pl.scan_parquet(sources, hive_partitioning=True)
+    wanted = None
+    if columns:
+        wanted = set(columns) | {d for _, d in DIMENSIONS.values() if where and d in where}
+    lf = attach_descriptions(lf, data_dir, wanted)
+    if where:
+        lf = lf.filter(pl.sql_expr(where))
+    if columns:
+        lf = lf.select(columns)
+    return lf
+
+def export_dataset(table: str, format: str, output_path: str, delimiter: str = ",",
+                   years: List[int] = None, columns: List[str] = None, where: str = None):
+    """Esporta il dataset (o una sua porzione) in CSV/TXT usando Polars in streaming"""
     try:
-        # Lazy load del dataset partizionato
-        # scan_parquet supporta hive partitioning automaticamente
-        lf = pl.scan_parquet(str(Path(dataset_path) / "**/*.parquet"))
-        
-        # Qui potremmo aggiungere filtri o aggregazioni se passati via CLI
-        
-        # Collect (attenzione alla RAM per dataset enormi, meglio streaming)
-        # Per ora usiamo sink_csv che è memory efficient
-        logger.info(f"Exporting {table} to {output_path}...")
-        
-        if format == 'csv' or format == 'txt':
-            lf.sink_csv(output_path, separator=delimiter)
+        with Snapshot(DATA_DIR) as snapshot:
+            lf = scan_table(table, years, columns, where, snapshot.path)
+            logger.info(f"Exporting {table} to {output_path}...")
+
+            # sink_csv esegue la query in streaming senza materializzare il dataset
+            if format == 'csv' or format == 'txt':
+                lf.sink_csv(output_path, separator=delimiter)
             
         logger.info("Export completed.")
         
     except Exception as e:
         logger.error(f"Export error: {e}")
 
-def export_aggregated_dataset(output_path: str, delimiter: str = ","):
+# Colonne descrittive di AIUTI riportate nell'export aggregato
+AGGREGATED_AIUTI_COLUMNS = [
+    "CAR", "TITOLO_MISURA", "DES_TIPO_MISURA", "TITOLO_PROGETTO",
+    "DESCRIZIONE_PROGETTO", "DATA_CONCESSIONE", "CUP",
+    "DENOMINAZIONE_BENEFICIARIO", "CODICE_FISCALE_BENEFICIARIO",
+    "DES_TIPO_BENEFICIARIO", "REGIONE_BENEFICIARIO",
+    "FILE_SOURCE", "COR"
+]
+AGGREGATED_COLUMNS = [
+    "IMPORTO_NOMINALE_TOTALE", "ELEMENTO_DI_AIUTO_TOTALE",
+    "NUM_COMPONENTI", "NUM_STRUMENTI", "COD_STRUMENTI", "SETTORI_ATTIVITA"
+]
+# Memoria stimata per l'export di un anno, in multipli dei byte Parquet delle sue partizioni
+EXPORT_MEMORY_FACTOR = 4
+
+def _scan_columns(source: str, columns: Dict[str, pl.DataType], data_dir: Path) -> Optional[pl.LazyFrame]:
     """
-    Esporta il dataset aggregato unendo AIUTI, COMPONENTI e STRUMENTI.
-    Esegue join e aggregazioni per produrre una riga per ogni AIUTO con totali calcolati.
+    Scansione delle sole colonne indicate; quelle assenti nei file
+    (dataset prodotti da versioni precedenti) vengono aggiunte a null.
     """
-    try:
-        logger.info("Starting aggregated export...")
-        
-        # 1. Caricamento Lazy dei dataset
-        # Usiamo scan_parquet per efficienza
-        # Utilizziamo union_by_name per gestire potenziali differenze di schema tra file vecchi e nuovi
-        
-        # Helper per caricare e normalizzare
-        def scan_and_normalize(path, required_cols=[]):
-            try:
-                lf = pl.scan_parquet(path)
-                # Verifica colonne mancanti e aggiungile come null per evitare crash su dataset misti
-                current_cols = lf.collect_schema().names()
-                for col in required_cols:
-                    if col not in current_cols:
-                        logger.warning(f"Column {col} missing in {path}, filling with nulls.")
-                        lf = lf.with_columns(pl.lit(None).alias(col))
-                return lf
-            except Exception as ex:
-                logger.warning(f"Could not scan {path}: {ex}")
-                # Ritorna un LF vuoto con lo schema atteso se fallisce tutto (es. cartella vuota)
-                # Ma per semplicità lasciamo fallire se proprio non c'è nulla
-                raise ex
-
-        # Colonne target per AIUTI (solo quelle che stanno effettivamente nella tabella AIUTI + ANNO che gestiamo a mano)
-        required_aiuti = [
-            "CAR", "TITOLO_MISURA", "DES_TIPO_MISURA", "TITOLO_PROGETTO", 
-            "DESCRIZIONE_PROGETTO", "DATA_CONCESSIONE", "CUP", 
-            "DENOMINAZIONE_BENEFICIARIO", "CODICE_FISCALE_BENEFICIARIO", 
-            "DES_TIPO_BENEFICIARIO", "REGIONE_BENEFICIARIO", 
-            "FILE_SOURCE", "COR"
-        ]
-        
-        # Colonne che ci aspettiamo di avere DOPO il join per l'aggregazione
-        # (Utile per debugging, ma non per scan_and_normalize degli aiuti)
-        
-        # 1. Discovery degli anni disponibili
-        # Cerchiamo le cartelle ANNO=YYYY in public/parquet/aiuti
-        aiuti_path = DATA_DIR / "aiuti"
-        years = []
-        if aiuti_path.exists():
-            for p in aiuti_path.glob("ANNO=*"):
-                try:
-                     y = int(p.name.split("=")[1])
-                     years.append(y)
-                except:
-                    pass
-        years = sorted(years)
-        
-        if not years:
-            logger.warning("No data found to export.")
-            return
+    if source is None:
+        return None
+    lf = attach_descriptions(pl.scan_parquet(source), data_dir, columns)
+    present = lf.collect_schema().names()
+    exprs = []
+    for col, dtype in columns.items():
+        if col in present:
+            exprs.append(pl.col(col))
+        else:
+            logger.warning(f"Column {col} missing in {source}, filling with nulls.")
+            exprs.append(pl.lit(None, dtype=dtype).alias(col))
+    return lf.select(exprs)
 
-        logger.info(f"Found years to export: {years}")
-        
-        from tqdm import tqdm
-        
-        # output_path gestito come prefisso se non finisce con .csv, o manipolato
-        out_path_obj = Path(output_path)
-        base_stem = out_path_obj.stem
-        base_dir = out_path_obj.parent
-        base_ext = out_path_obj.suffix if out_path_obj.suffix else ".csv"
-        
-        pbar = tqdm(years, desc="Exporting years")
-        
-        for year in pbar:
-            pbar.set_description(f"Exporting Year {year}")
-            
-            # Aiuti Year Path
-            aiuti_year_path = DATA_DIR / "aiuti" / f"ANNO={year}"
-            if not aiuti_year_path.exists():
-                 continue
-
-            try:
-                lf_aiuti = scan_and_normalize(str(aiuti_year_path / "*.parquet"), required_aiuti)
-                
-                # Aggiungiamo la colonna ANNO manualmente perché leggendo la partizione foglia non c'è
-                lf_aiuti = lf_aiuti.with_columns(pl.lit(year).alias("ANNO"))
-                
-                # Per componenti e strumenti
-                comp_year_path = DATA_DIR / "componenti" / f"ANNO={year}"
-                strum_year_path = DATA_DIR / "strumenti" / f"ANNO={year}"
-                
-                # Se mancano componenti per quell'anno, usiamo dummy vuoto per permettere il join
-                if comp_year_path.exists():
-                    lf_componenti = pl.scan_parquet(str(comp_year_path / "*.parquet"))
-                else:
-                    # Schema dummy vuoto
-                    lf_componenti = pl.LazyFrame(schema=lf_aiuti.collect_schema()) # placeholder errato
-                    # Meglio: scan vuoto o gestire join
-                    lf_componenti = None
-
-                if strum_year_path.exists():
-                     lf_strumenti = pl.scan_parquet(str(strum_year_path / "*.parquet"))
-                else:
-                     lf_strumenti = None
-
-
-                # JOIN LOGIC
-                # Se non ci sono componenti, l'aggregazione di aiuti sarà semplice
-                
-                if lf_componenti is not None:
-                     lf_joined = lf_aiuti.join(
-                        lf_componenti, 
-                        left_on=["CAR", "COR"], 
-                        right_on=["CAR_AIUTO", "COR_AIUTO"], 
-                        how="left",
-                        suffix="_COMP"
-                    )
-                else:
-                    lf_joined = lf_aiuti
-                    
-                if lf_strumenti is not None and lf_componenti is not None:
-                    lf_joined = lf_joined.join(
-                        lf_strumenti,
-                        left_on="ID_COMPONENTE_AIUTO",
-                        right_on="ID_COMPONENTE_AIUTO",
-                        how="left",
-                        suffix="_STRUM"
-                    )
-                elif lf_strumenti is not None and lf_componenti is None:
-                     # Caso strano: strumenti senza componenti? Impossibile da schema, ma gestiamo
-                     pass
-
-                # Aggregazione
-                group_cols = [c for c in required_aiuti if c in lf_joined.collect_schema().names()] # Usa solo colonne disponibili
-                
-                # Definiamo le aggregazioni dinamicamente a seconda se abbiamo fatto il join o no
-                # Ma per semplicità usiamo quelle standard, che su colonne mancanti (se null) daranno null
-                
-                aggs = [
-                    pl.col("IMPORTO_NOMINALE").sum().fill_null(0).alias("IMPORTO_NOMINALE_TOTALE"),
-                    pl.col("ELEMENTO_DI_AIUTO").sum().fill_null(0).alias("ELEMENTO_DI_AIUTO_TOTALE"),
-                ]
-                
-                if "ID_COMPONENTE_AIUTO" in lf_joined.collect_schema().names():
-                     aggs.append(pl.col("ID_COMPONENTE_AIUTO").n_unique().alias("NUM_COMPONENTI"))
-                else:
-                     aggs.append(pl.lit(0).alias("NUM_COMPONENTI"))
-                     
-                if "COD_STRUMENTO" in lf_joined.collect_schema().names():
-                     aggs.append(pl.col("COD_STRUMENTO").count().alias("NUM_STRUMENTI"))
-                     aggs.append(pl.col("COD_STRUMENTO").filter(pl.col("COD_STRUMENTO").is_not_null()).unique().str.concat("|").alias("COD_STRUMENTI"))
-                else:
-                     aggs.append(pl.lit(0).alias("NUM_STRUMENTI"))
-                     aggs.append(pl.lit(None).alias("COD_STRUMENTI"))
-
-                if "SETTORE_ATTIVITA" in lf_joined.collect_schema().names():
-                    aggs.append(pl.col("SETTORE_ATTIVITA").filter(pl.col("SETTORE_ATTIVITA").is_not_null()).unique().str.concat("|").alias("SETTORI_ATTIVITA"))
-                else:
-                    aggs.append(pl.lit(None).alias("SETTORI_ATTIVITA"))
-
-
-                aggregated = lf_joined.group_by(group_cols).agg(aggs)
-                
-                # Output filename
-                year_out = base_dir / f"{base_stem}_{year}{base_ext}"
-                
-                # Collect & Write
-                # Usiamo collect con streaming per risparmiare memoria
-                aggregated.collect(streaming=True).write_csv(year_out, separator=delimiter)
-                
-                # Cleanup Polars cache if needed
-                del aggregated
-                del lf_joined
-                
-            except Exception as e:
-                logger.error(f"Failed exporting year {year}: {e}")
-                # Non blocchiamo tutto, continuiamo con prossimo anno?
-                # Meglio loggare e continuare
-                continue
-                
-        logger.info("Aggregated export completed.")
-        
-    except Exception as e:
-        logger.error(f"Aggregated export fatal error: {e}")
-        raise e
-        
+def _has_columns(source: Optional[str], columns: List[str]) -> bool:
+    return source is None or set(columns) <= set(pl.scan_parquet(source).collect_schema().names())
+
+def aggregate_aiuti(aiuti_source: str, componenti_source: str = None,
+                    strumenti_source: str = None, data_dir: Path = None) -> pl.LazyFrame:
+    """
+    Una riga per AIUTO con i totali di componenti e strumenti.
+    Gli strumenti vengono prima ridotti a una riga per componente e i componenti
+    a una riga per AIUTO: il join finale con AIUTI è 1:1 e il raggruppamento
+    avviene solo sulle chiavi, non sulle colonne descrittive.
+    I join usano le chiavi surrogate intere (AIUTO_SK, COMPONENTE_SK); i dataset
+    che non le hanno ripiegano sulle chiavi testuali (CAR, COR, ID_COMPONENTE_AIUTO).
+    data_dir è la versione del dataset con le tabelle dimensione.
+    """
+    data_dir = data_dir or resolve_data_dir(DATA_DIR)
+    use_sk = (_has_columns(aiuti_source, ["AIUTO_SK"])
+              and _has_columns(componenti_source, ["AIUTO_SK", "COMPONENTE_SK"])
+              and _has_columns(strumenti_source, ["COMPONENTE_SK"]))
+    if use_sk:
+        aiuto_key, parent_key, comp_key = ["AIUTO_SK"], ["AIUTO_SK"], "COMPONENTE_SK"
+        key_types = {"AIUTO_SK": pl.Int64, "COMPONENTE_SK": pl.Int64}
+    else:
+        aiuto_key, parent_key, comp_key = ["CAR", "COR"], ["CAR_AIUTO", "COR_AIUTO"], "ID_COMPONENTE_AIUTO"
+        key_types = {"CAR_AIUTO": pl.String, "COR_AIUTO": pl.String}
+
+    aiuti_columns = {c: pl.String for c in AGGREGATED_AIUTI_COLUMNS}
+    if use_sk:
+        aiuti_columns["AIUTO_SK"] = pl.Int64
+    aiuti = _scan_columns(aiuti_source, aiuti_columns, data_dir)
+    componenti = _scan_columns(componenti_source, {
+        **key_types, "ID_COMPONENTE_AIUTO": pl.String, "SETTORE_ATTIVITA": pl.String,
+    }, data_dir)
+    strumenti = _scan_columns(strumenti_source, {
+        comp_key: key_types.get(comp_key, pl.String), "COD_STRUMENTO": pl.String,
+        "IMPORTO_NOMINALE": pl.Float64, "ELEMENTO_DI_AIUTO": pl.Float64,
+    }, data_dir)
+
+    if componenti is None:
+        return aiuti.with_columns(
+            pl.lit(0.0).alias("IMPORTO_NOMINALE_TOTALE"),
+            pl.lit(0.0).alias("ELEMENTO_DI_AIUTO_TOTALE"),
+            pl.lit(0, dtype=pl.UInt32).alias("NUM_COMPONENTI"),
+            pl.lit(0, dtype=pl.UInt32).alias("NUM_STRUMENTI"),
+            pl.lit(None, dtype=pl.String).alias("COD_STRUMENTI"),
+            pl.lit(None, dtype=pl.String).alias("SETTORI_ATTIVITA"),
+        ).select(AGGREGATED_AIUTI_COLUMNS + AGGREGATED_COLUMNS)
+
+    if strumenti is not None:
+        # 1. Strumenti -> una riga per componente
+        per_componente = strumenti.group_by(comp_key).agg(
+            pl.col("IMPORTO_NOMINALE").sum(),
+            pl.col("ELEMENTO_DI_AIUTO").sum(),
+            pl.col("COD_STRUMENTO").count().alias("NUM_STRUMENTI"),
+            pl.col("COD_STRUMENTO").drop_nulls().unique(maintain_order=True).alias("COD_STRUMENTI"),
+        )
+        componenti = componenti.join(per_componente, on=comp_key, how="left")
+    else:
+        componenti = componenti.with_columns(
+            pl.lit(None, dtype=pl.Float64).alias("IMPORTO_NOMINALE"),
+            pl.lit(None, dtype=pl.Float64).alias("ELEMENTO_DI_AIUTO"),
+            pl.lit(0, dtype=pl.UInt32).alias("NUM_STRUMENTI"),
+            pl.lit(None, dtype=pl.List(pl.String)).alias("COD_STRUMENTI"),
+        )
+
+    # 2. Componenti -> una riga per AIUTO
+    per_aiuto = componenti.group_by(parent_key).agg(
+        pl.col("IMPORTO_NOMINALE").sum().alias("IMPORTO_NOMINALE_TOTALE"),
+        pl.col("ELEMENTO_DI_AIUTO").sum().alias("ELEMENTO_DI_AIUTO_TOTALE"),
+        pl.col("ID_COMPONENTE_AIUTO").n_unique().alias("NUM_COMPONENTI"),
+        pl.col("NUM_STRUMENTI").sum(),
+        pl.col("COD_STRUMENTI").explode().drop_nulls().unique(maintain_order=True).str.join("|"),
+        pl.col("SETTORE_ATTIVITA").drop_nulls().unique(maintain_order=True).str.join("|").alias("SETTORI_ATTIVITA"),
+    )
+
+    # 3. Le colonne descrittive arrivano da AIUTI con un join 1:1 sulla chiave
+    return aiuti.join(
+        per_aiuto, left_on=aiuto_key, right_on=parent_key, how="left"
+    ).with_columns(
+        pl.col("IMPORTO_NOMINALE_TOTALE", "ELEMENTO_DI_AIUTO_TOTALE").fill_null(0.0),
+        pl.col("NUM_COMPONENTI", "NUM_STRUMENTI").fill_null(0),
+    ).select(AGGREGATED_AIUTI_COLUMNS + AGGREGATED_COLUMNS)
+
+def _partition_source(data_dir: Path, table: str, year: int = None) -> Optional[str]:
+    """Glob dei file di una tabella (o di una sua partizione), None se non ci sono dati"""
+    path = data_dir / table if year is None else data_dir / table / f"ANNO={year}"
+    if next(path.glob("*.parquet"), None) is None:
+        return None
+    return str(path / "*.parquet")
+
+def _partition_bytes(data_dir: Path, year: int) -> int:
+    """Byte Parquet letti dall'export di un anno"""
+    tables = (("aiuti_aggregati",) if _partition_source(data_dir, "aiuti_aggregati", year)
+              else ("aiuti", "componenti", "strumenti"))
+    return sum(
+        f.stat().st_size
+        for table in tables
+        for f in (data_dir / table / f"ANNO={year}").glob("*.parquet")
+    )
+
+def _export_year(data_dir: Path, year: Optional[int], output_path: Path, delimiter: str) -> Path:
+    materialized = _partition_source(data_dir, "aiuti_aggregati", year)
+    if materialized is not None:
+        # Rollup già calcolato dal parser: nessun join
+        columns = AGGREGATED_AIUTI_COLUMNS + AGGREGATED_COLUMNS
+        lf = attach_descriptions(pl.scan_parquet(materialized), data_dir, columns).select(columns)
+    else:
+        lf = aggregate_aiuti(
+            _partition_source(data_dir, "aiuti", year),
+            _partition_source(data_dir, "componenti", year),
+            _partition_source(data_dir, "strumenti", year),
+            data_dir,
+        )
+    # Scrittura in streaming: il risultato dell'anno non viene materializzato
+    lf.sink_csv(output_path, separator=delimiter)
+    return output_path
+
+def _available_years(data_dir: Path) -> List[int]:
+    years = []
+    for p in (data_dir / "aiuti").glob("ANNO=*"):
+        try:
+            years.append(int(p.name.split("=", 1)[1]))
+        except ValueError:
+            pass
+    return sorted(years)
+
+def export_aggregated_dataset(output_path: str, delimiter: str = ",", jobs: int = None,
+                              memory_budget: int = None):
+    """
+    Esporta il dataset aggregato: una riga per ogni AIUTO con totali calcolati,
+    un file CSV per anno. Legge la tabella aiuti_aggregati prodotta dal parse;
+    per dataset che non la contengono unisce AIUTI, COMPONENTI e STRUMENTI.
+    Gli anni sono indipendenti e vengono esportati in parallelo (fino a jobs),
+    dal più grande, ammettendo un nuovo anno solo se la memoria stimata degli
+    anni in corso resta entro memory_budget (default: memoria disponibile).
+    Tutti gli anni vengono letti dalla stessa versione del dataset.
+    """
+    try:
+        with Snapshot(DATA_DIR) as snapshot:
+            _export_aggregated(snapshot.path, Path(output_path), delimiter, jobs, memory_budget)
     except Exception as e:
         logger.error(f"Aggregated export error: {e}")
         # Rilancia l'eccezione per farla vedere alla CLI
         raise e
+
+def _export_aggregated(data_dir: Path, out_path_obj: Path, delimiter: str, jobs: Optional[int],
+                       memory_budget: Optional[int]):
+    logger.info("Starting aggregated export...")
+    years = _available_years(data_dir)
+
+    if not years:
+        if _partition_source(data_dir, "aiuti") is None:
+            logger.warning("No data found to export.")
+            return
+        # Dataset non partizionato: un unico file
+        _export_year(data_dir, None, out_path_obj, delimiter)
+        logger.info("Aggregated export completed.")
+        return
+
+    logger.info(f"Found years to export: {years}")
+    
+    # output_path gestito come prefisso: <stem>_<anno><ext>
+    base_stem = out_path_obj.stem
+    base_dir = out_path_obj.parent
+    base_ext = out_path_obj.suffix if out_path_obj.suffix else ".csv"
+
+    jobs = max(1, min(jobs or os.cpu_count() or 1, len(years)))
+    budget = memory_budget or available_memory()
+    estimates = {y: EXPORT_MEMORY_FACTOR * _partition_bytes(data_dir, y) for y in years}
+    queue = sorted(years, key=estimates.get, reverse=True)
+    pending = {}
+    in_use = 0
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor, tqdm(total=len(years), desc="Exporting years") as pbar:
+        while queue or pending:
+            # Un anno entra solo se c'è spazio nel budget (sempre almeno uno in corso)
+            while queue and len(pending) < jobs and (
+                    not pending or not budget or in_use + estimates[queue[0]] <= budget):
+                year = queue.pop(0)
+                year_out = base_dir / f"{base_stem}_{year}{base_ext}"
+                pending[executor.submit(_export_year, data_dir, year, year_out, delimiter)] = year
+                in_use += estimates[year]
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                year = pending.pop(future)
+                in_use -= estimates[year]
+                try:
+                    future.result()
+                except Exception as e:
+                    # Un anno fallito non blocca gli altri
+                    logger.error(f"Failed exporting year {year}: {e}")
+                pbar.update(1)
+            
+    logger.info("Aggregated export completed.")
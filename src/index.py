@@ -0,0 +1,137 @@
+import os
+import logging
+from pathlib import Path
+from typing import Dict, List
+import polars as pl
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from .writer import PARTITION_COL
+from .dimensions import attach_descriptions
+
+logger = logging.getLogger(__name__)
+
+INDEX_NAME = "_index_beneficiari.parquet"
+# Chiavi indicizzate: tipo -> colonna di AIUTI
+KEY_COLUMNS = {
+    "CF": "CODICE_FISCALE_BENEFICIARIO",
+    "CUP": "CUP",
+}
+# Row group piccoli: una ricerca legge solo il row group che contiene la chiave
+INDEX_ROW_GROUP_SIZE = 16 * 1024
+
+INDEX_SCHEMA = pa.schema([
+    ('KEY_TYPE', pa.string()),
+    ('KEY', pa.string()),
+    ('FILE', pa.string()),      # File di AIUTI, relativo alla cartella del dataset
+    ('ROW_GROUP', pa.int32()),
+])
+
+PARTITIONING = ds.partitioning(pa.schema([(PARTITION_COL, pa.int32())]), flavor="hive")
+
+def _index_file(base: Path, rel: str) -> pa.Table:
+    """Chiavi distinte di ogni row group di un file di AIUTI"""
+    pf = pq.ParquetFile(base / rel)
+    columns = [c for c in KEY_COLUMNS.values() if c in pf.schema_arrow.names]
+    key_types, keys, row_groups = [], [], []
+    for rg in range(pf.num_row_groups):
+        data = pf.read_row_group(rg, columns=columns)
+        for key_type, column in KEY_COLUMNS.items():
+            if column not in columns:
+                continue
+            values = pc.unique(data[column]).drop_null().to_pylist()
+            key_types += [key_type] * len(values)
+            keys += values
+            row_groups += [rg] * len(values)
+    return pa.table({
+        "KEY_TYPE": key_types, "KEY": keys, "FILE": [rel] * len(keys), "ROW_GROUP": row_groups,
+    }, schema=INDEX_SCHEMA)
+
+def update_index(data_dir) -> int:
+    """
+    Aggiorna l'indice beneficiari (CF e CUP -> file e row group di AIUTI).
+    Vengono letti solo i file di AIUTI non ancora indicizzati; le voci dei file
+    non più presenti (sostituiti da parse o compact) vengono rimosse.
+    L'indice è ordinato per chiave, così le statistiche min/max dei suoi row
+    group permettono di leggerne solo una piccola parte. Restituisce le voci.
+    """
+    base = Path(data_dir)
+    path = base / INDEX_NAME
+    files = sorted(str(f.relative_to(base)) for f in (base / "aiuti").glob(f"{PARTITION_COL}=*/*.parquet"))
+
+    parts = []
+    indexed = set()
+    if path.exists():
+        existing = pq.read_table(path)
+        kept = existing.filter(pc.is_in(existing["FILE"], value_set=pa.array(files, pa.string())))
+        indexed = set(pc.unique(kept["FILE"]).to_pylist())
+        if kept.num_rows == existing.num_rows and indexed == set(files):
+            return existing.num_rows
+        parts.append(kept)
+
+    for rel in files:
+        if rel not in indexed:
+            parts.append(_index_file(base, rel))
+
+    table = pa.concat_tables(parts) if parts else INDEX_SCHEMA.empty_table()
+    table = table.sort_by([("KEY_TYPE", "ascending"), ("KEY", "ascending")])
+    tmp = path.with_suffix(".tmp")
+    pq.write_table(table, tmp, row_group_size=INDEX_ROW_GROUP_SIZE, compression="zstd")
+    os.replace(tmp, path)
+    logger.info(f"Beneficiary index: {table.num_rows} entries over {len(files)} files")
+    return table.num_rows
+
+def _year(rel: str) -> int:
+    return int(Path(rel).parent.name.split("=", 1)[1])
+
+def _children(base: Path, table: str, years: List[int], filters: Dict[str, list]) -> pa.Table:
+    """Righe di table nelle partizioni years che soddisfano tutti i filtri colonna IN valori"""
+    dataset = ds.dataset(base / table, format="parquet", partitioning=PARTITIONING)
+    expr = ds.field(PARTITION_COL).isin(years)
+    for column, values in filters.items():
+        expr = expr & ds.field(column).isin(values)
+    return dataset.to_table(filter=expr)
+
+def lookup(data_dir, key_type: str, key: str) -> Dict[str, pl.DataFrame]:
+    """
+    Aiuti, componenti e strumenti di un codice fiscale (key_type "CF") o di un
+    CUP ("CUP"). Dall'indice si ricavano file e row group di AIUTI da leggere;
+    componenti e strumenti vengono cercati solo nelle partizioni degli aiuti
+    trovati, filtrando sulle chiavi (con pruning dei row group tramite statistiche).
+    """
+    base = Path(data_dir)
+    path = base / INDEX_NAME
+    if not path.exists():
+        update_index(base)
+    column = KEY_COLUMNS[key_type]
+
+    entries = pq.read_table(path, columns=["FILE", "ROW_GROUP"],
+                            filters=[("KEY_TYPE", "==", key_type), ("KEY", "==", key)])
+    groups: Dict[str, List[int]] = {}
+    for rel, rg in zip(entries["FILE"].to_pylist(), entries["ROW_GROUP"].to_pylist()):
+        groups.setdefault(rel, []).append(rg)
+
+    parts = []
+    for rel, row_groups in sorted(groups.items()):
+        data = pq.ParquetFile(base / rel).read_row_groups(sorted(row_groups))
+        data = data.filter(pc.equal(data[column], key))
+        parts.append(data.append_column(PARTITION_COL, pa.array([_year(rel)] * data.num_rows, pa.int32())))
+
+    if not parts:
+        return {}
+    aiuti = pa.concat_tables(parts, promote_options="default")
+    years = sorted({_year(rel) for rel in groups})
+    componenti = _children(base, "componenti", years, {
+        "CAR_AIUTO": pc.unique(aiuti["CAR"]).to_pylist(),
+        "AIUTO_SK": pc.unique(aiuti["AIUTO_SK"]).to_pylist(),
+    })
+    strumenti = _children(base, "strumenti", years, {
+        "ID_COMPONENTE_AIUTO": pc.unique(componenti["ID_COMPONENTE_AIUTO"]).to_pylist(),
+        "COMPONENTE_SK": pc.unique(componenti["COMPONENTE_SK"]).to_pylist(),
+    })
+
+    return {
+        name: attach_descriptions(pl.from_arrow(table).lazy(), base).collect()
+        for name, table in (("aiuti", aiuti), ("componenti", componenti), ("strumenti", strumenti))
+    }
@@ -0,0 +1,168 @@
+import os
+import json
+import hashlib
+import logging
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from .sources import build_work_units, is_archive, open_source
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "_manifest.json"
+# Da incrementare quando cambia lo schema dei dati: forza una ricostruzione completa
+MANIFEST_VERSION = 4
+HASH_ALGORITHM = "blake2b"
+DIGEST_BLOCK_SIZE = 4 * 1024 * 1024
+
+def file_digest(path: str) -> str:
+    """Hash del contenuto del file, letto a blocchi"""
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, HASH_ALGORITHM).hexdigest()
+
+def unit_digest(path: str, member: str = None, start: int = None, end: int = None) -> str:
+    """
+    Hash dei byte letti da un'unità di lavoro (intervallo con prologo/epilogo,
+    membro o archivio decompresso): gli stessi che il worker calcola mentre li legge
+    """
+    source = open_source(path, member, start, end)
+    f = open(source, 'rb') if isinstance(source, str) else source
+    h = hashlib.new(HASH_ALGORITHM)
+    try:
+        while block := f.read(DIGEST_BLOCK_SIZE):
+            h.update(block)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+def combine_digests(units: Iterable[Tuple[Optional[str], Optional[int], Optional[int], str]]) -> str:
+    """Hash di una sorgente dagli hash delle sue unità (member, start, end, hash), in ordine"""
+    h = hashlib.new(HASH_ALGORITHM)
+    for *_, digest in sorted(units, key=lambda u: (u[0] or "", u[1] or 0)):
+        h.update(bytes.fromhex(digest))
+    return h.hexdigest()
+
+def _unit_layout(units) -> List[list]:
+    return sorted(([u[0], u[1], u[2]] for u in units), key=lambda u: (u[0] or "", u[1] or 0))
+
+def source_key(path: str) -> str:
+    return str(Path(path).resolve())
+
+class Manifest:
+    """
+    Manifest dei file sorgente già processati, salvato accanto al dataset Parquet.
+    Per ogni sorgente registra dimensione, mtime, hash del contenuto e i file
+    Parquet prodotti (relativi alla cartella di output), così che un nuovo parse
+    possa saltare i file invariati e sostituire solo gli output di quelli cambiati.
+    """
+    def __init__(self, output_dir: str):
+        self.output_dir = Path(output_dir)
+        self.path = self.output_dir / MANIFEST_NAME
+        self.version = MANIFEST_VERSION
+        self.sources: Dict[str, dict] = {}
+        # plan ha aggiornato voci esistenti (solo mtime cambiato): il manifest va salvato
+        self.touched = False
+
+    @classmethod
+    def load(cls, output_dir: str) -> "Manifest":
+        manifest = cls(output_dir)
+        if manifest.path.exists():
+            with open(manifest.path) as f:
+                data = json.load(f)
+            manifest.version = data.get("version")
+            manifest.sources = data.get("sources", {})
+        return manifest
+
+    @property
+    def compatible(self) -> bool:
+        return self.version == MANIFEST_VERSION
+
+    def save(self):
+        """Scrittura atomica: file temporaneo + rename"""
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            json.dump({"version": MANIFEST_VERSION, "sources": self.sources}, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def plan(self, files: Iterable[str], input_path: Path) -> Tuple[List[str], List[str], List[str]]:
+        """
+        Confronta i file di input con il manifest.
+        Restituisce (da processare, invariati, sorgenti rimosse sotto input_path).
+        L'hash viene calcolato solo se dimensione o mtime sono cambiati.
+        """
+        to_process, unchanged = [], []
+        seen = set()
+        for f in files:
+            key = source_key(f)
+            seen.add(key)
+            entry = self.sources.get(key)
+            st = os.stat(f)
+            if entry and entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns:
+                unchanged.append(f)
+            elif entry and entry["size"] == st.st_size and entry["hash"] == self._digest(f, entry):
+                # Solo il mtime è cambiato (es. copia): aggiorniamo il manifest
+                entry["mtime_ns"] = st.st_mtime_ns
+                self.touched = True
+                unchanged.append(f)
+            else:
+                to_process.append(f)
+
+        root = source_key(input_path)
+        removed = [
+            key for key in self.sources
+            if key not in seen and (key == root or key.startswith(root.rstrip(os.sep) + os.sep)) and not os.path.exists(key)
+        ]
+        return to_process, unchanged, removed
+
+    @staticmethod
+    def _digest(path: str, entry: dict) -> Optional[str]:
+        """
+        Hash attuale della sorgente, calcolato come quello registrato: sulle stesse
+        unità (hash dei worker) oppure sull'intero file (manifest precedenti)
+        """
+        units = entry.get("units")
+        if units is None:
+            return file_digest(path)
+        if is_archive(path) and _unit_layout((u.member, u.start, u.end) for u in build_work_units([path], 0)) != units:
+            return None
+        return combine_digests((*u, unit_digest(path, *u)) for u in units)
+
+    def record(self, path: str, outputs: List[str], stats: Dict[str, int],
+               units: List[Tuple[Optional[str], Optional[int], Optional[int], str]] = None):
+        """
+        Registra una sorgente processata con successo. units sono le unità
+        (member, start, end, hash) con l'hash dei byte letti dai worker: il file
+        non viene riletto; senza units l'hash è calcolato sull'intero file.
+        """
+        st = os.stat(path)
+        entry = {
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+            "hash": combine_digests(units) if units else file_digest(path),
+            "outputs": sorted(outputs),
+            "stats": stats,
+        }
+        if units:
+            entry["units"] = _unit_layout(units)
+        self.sources[source_key(path)] = entry
+
+    def outputs(self, path: str) -> List[str]:
+        entry = self.sources.get(source_key(path))
+        return entry["outputs"] if entry else []
+
+    def all_outputs(self) -> Set[str]:
+        """Tutti i file Parquet registrati, di qualsiasi sorgente"""
+        return {rel for entry in self.sources.values() for rel in entry["outputs"]}
+
+    def forget(self, key: str) -> List[str]:
+        """Rimuove una sorgente dal manifest restituendo i suoi output"""
+        entry = self.sources.pop(key, None)
+        return entry["outputs"] if entry else []
+
+    def delete_outputs(self, outputs: Iterable[str]):
+        """Cancella i file Parquet indicati (relativi alla cartella di output)"""
+        for rel in outputs:
+            try:
+                (self.output_dir / rel).unlink()
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,148 @@
+import os
+import json
+import time
+import resource
+import logging
+from pathlib import Path
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Fasi del parse, nell'ordine in cui compaiono nel report
+PARSE_STAGES = ("read_sanitize", "iterparse", "extract", "convert", "write")
+# Nel Chrome trace finiscono solo gli intervalli più lunghi di così (gli altri sono solo sommati)
+TRACE_MIN_SECONDS = 0.001
+
+def reset_peak_rss() -> bool:
+    """Azzera il picco di RSS del processo (Linux, /proc/self/clear_refs); False se non supportato"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def peak_rss() -> int:
+    """Picco di RSS in byte: VmHWM (azzerabile) su Linux, altrimenti ru_maxrss"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss è in KB su Linux, in byte su macOS
+    return rss if os.uname().sysname == "Darwin" else rss * 1024
+
+class StageTimer:
+    """
+    Tempi per fase di un worker. Le fasi si possono annidare: il tempo di una
+    fase interna viene tolto da quella esterna, così ogni secondo viene contato
+    in una sola fase. Con enabled=False start() e stop() non fanno nulla.
+    Con trace=True vengono registrati anche gli intervalli per il Chrome trace.
+    """
+    def __init__(self, enabled: bool = True, trace: bool = False):
+        self.enabled = enabled
+        self.seconds: Dict[str, float] = {}
+        self.calls: Dict[str, int] = {}
+        self.events: Optional[List[tuple]] = [] if trace else None
+        self._stack: List[list] = []
+        # Per convertire perf_counter in tempo assoluto, confrontabile tra processi
+        self.epoch = time.time() - time.perf_counter()
+
+    def start(self, name: str):
+        if self.enabled:
+            self._stack.append([name, time.perf_counter(), 0.0])
+
+    def stop(self):
+        if not self.enabled:
+            return
+        name, started, nested = self._stack.pop()
+        elapsed = time.perf_counter() - started
+        self.seconds[name] = self.seconds.get(name, 0.0) + elapsed - nested
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self._stack:
+            self._stack[-1][2] += elapsed
+        if self.events is not None and elapsed >= TRACE_MIN_SECONDS:
+            self.events.append((name, self.epoch + started, elapsed))
+
+    def iterate(self, name: str, iterable):
+        """Itera su iterable contando nella fase name il tempo di ogni next()"""
+        if not self.enabled:
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        while True:
+            self.start(name)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.stop()
+                return
+            self.stop()
+            yield item
+
+    def report(self) -> dict:
+        return {"seconds": dict(self.seconds), "calls": dict(self.calls), "events": self.events}
+
+def unit_profile(label: str, timer: StageTimer, started: float, bytes_in: int, bytes_out: int,
+                 records: int) -> dict:
+    """Metriche di un'unità di lavoro, restituite dal worker insieme alle statistiche"""
+    seconds = time.perf_counter() - started
+    profile = timer.report()
+    profile.update({
+        "unit": label, "pid": os.getpid(), "elapsed": seconds,
+        "start": timer.epoch + started,
+        "bytes_in": bytes_in, "bytes_out": bytes_out, "records": records,
+        "records_s": records / seconds if seconds else 0.0,
+        "mb_s": bytes_in / 2**20 / seconds if seconds else 0.0,
+        "peak_rss": peak_rss(),
+    })
+    return profile
+
+def build_report(units: List[dict], elapsed: float, workers: int) -> dict:
+    """Report JSON del parse: totali per fase e dettaglio per unità (senza gli eventi del trace)"""
+    totals = {stage: 0.0 for stage in PARSE_STAGES}
+    for unit in units:
+        for stage, seconds in unit["seconds"].items():
+            totals[stage] = totals.get(stage, 0.0) + seconds
+    busy = sum(totals.values())
+    bytes_in = sum(u["bytes_in"] for u in units)
+    records = sum(u["records"] for u in units)
+    return {
+        "elapsed": elapsed,
+        "workers": workers,
+        "bytes_in": bytes_in,
+        "bytes_out": sum(u["bytes_out"] for u in units),
+        "records": records,
+        "records_s": records / elapsed if elapsed else 0.0,
+        "mb_s": bytes_in / 2**20 / elapsed if elapsed else 0.0,
+        "peak_rss": max((u["peak_rss"] for u in units), default=0),
+        "stages": {stage: {"seconds": s, "share": s / busy if busy else 0.0} for stage, s in totals.items()},
+        "units": [{k: v for k, v in u.items() if k != "events"} for u in units],
+    }
+
+def chrome_trace(units: List[dict]) -> dict:
+    """Eventi in formato Chrome trace (chrome://tracing, Perfetto): una riga per worker"""
+    events = []
+    for unit in units:
+        events.append({"name": unit["unit"], "cat": "unit", "ph": "X", "pid": unit["pid"], "tid": 0,
+                       "ts": unit["start"] * 1e6, "dur": unit["elapsed"] * 1e6,
+                       "args": {"records": unit["records"], "bytes_in": unit["bytes_in"]}})
+        for name, start, seconds in unit.get("events") or ():
+            events.append({"name": name, "cat": "stage", "ph": "X", "pid": unit["pid"], "tid": 1,
+                           "ts": start * 1e6, "dur": seconds * 1e6})
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+def write_json(path, data: dict):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(data, f, indent=1)
+
+def log_report(report: dict):
+    stages = ", ".join(f"{name} {s['seconds']:.2f}s ({s['share']:.0%})" for name, s in report["stages"].items())
+    logger.info(f"Stage time across workers: {stages}")
+    logger.info(f"{report['mb_s']:.1f} MB/s, {report['records_s']:,.0f} records/s, "
+                f"peak RSS {report['peak_rss'] / 2**20:.0f} MB per worker")
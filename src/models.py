@@ -1,11 +1,20 @@
+import hashlib
 import polars as pl
 import pyarrow as pa
 
+def surrogate_key(*parts) -> int:
+    """
+    Chiave surrogata intera a 64 bit (con segno, per Parquet INT64) derivata
+    dal contenuto delle chiavi naturali: deterministica tra esecuzioni e worker.
+    """
+    text = "\x1f".join("" if p is None else str(p) for p in parts)
+    return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), "little", signed=True)
+
 # Schema per la tabella principale AIUTI
 SCHEMA_AIUTI = pa.schema([
     ('CAR', pa.string()),
     ('TITOLO_MISURA', pa.string()),
-    ('DES_TIPO_MISURA', pa.string()),
+    ('COD_TIPO_MISURA', pa.int64()),  # surrogate_key(DES_TIPO_MISURA), descrizione in dimensioni/tipo_misura
     ('BASE_GIURIDICA_NAZIONALE', pa.string()),
     ('CODICE_FISCALE_BENEFICIARIO', pa.string()),
     ('DENOMINAZIONE_BENEFICIARIO', pa.string()),
@@ -15,7 +24,8 @@ SCHEMA_AIUTI = pa.schema([
     ('REGIONE_BENEFICIARIO', pa.string()),  # New field
     ('DES_TIPO_BENEFICIARIO', pa.string()), # New field
     ('COR', pa.string()),
-    ('DATA_CONCESSIONE', pa.string()),  # Convertito poi in date
+    ('AIUTO_SK', pa.int64()),  # surrogate_key(CAR, COR)
+    ('DATA_CONCESSIONE', pa.date32()),  # Parsata in blocco da ColumnarBatch
     ('ANNO', pa.int32()),  # Partizione
     ('FILE_SOURCE', pa.string()) # Tracciabilità
 ])
@@ -25,12 +35,11 @@ SCHEMA_COMPONENTI = pa.schema([
     ('ID_COMPONENTE_AIUTO', pa.string()),
     ('CAR_AIUTO', pa.string()), # FK verso AIUTI (usando CAR come link logico, anche se non univoco tra bandi diversi, meglio usare combinazione CAR+COR o un ID sintetico)
     ('COR_AIUTO', pa.string()), # FK aggiuntiva
-    ('COD_PROCEDIMENTO', pa.string()),
-    ('DES_PROCEDIMENTO', pa.string()),
+    ('AIUTO_SK', pa.int64()),   # FK intera verso AIUTI: chiave di join al posto di CAR+COR
+    ('COMPONENTE_SK', pa.int64()),  # surrogate_key(AIUTO_SK, ID_COMPONENTE_AIUTO)
+    ('COD_PROCEDIMENTO', pa.string()),  # Le descrizioni sono nelle tabelle dimensione
     ('COD_REGOLAMENTO', pa.string()),
-    ('DES_REGOLAMENTO', pa.string()),
     ('COD_OBIETTIVO', pa.string()),
-    ('DES_OBIETTIVO', pa.string()),
     ('SETTORE_ATTIVITA', pa.string()),
     ('ANNO', pa.int32())
 ])
@@ -38,9 +47,62 @@ SCHEMA_COMPONENTI = pa.schema([
 # Schema per STRUMENTI_AIUTO
 SCHEMA_STRUMENTI = pa.schema([
     ('ID_COMPONENTE_AIUTO', pa.string()), # FK verso COMPONENTI
+    ('COMPONENTE_SK', pa.int64()),        # FK intera verso COMPONENTI
     ('COD_STRUMENTO', pa.string()),
-    ('DES_STRUMENTO', pa.string()),
     ('ELEMENTO_DI_AIUTO', pa.float64()),
     ('IMPORTO_NOMINALE', pa.float64()),
     ('ANNO', pa.int32())
 ])
+
+# Schema per AIUTI_AGGREGATI: una riga per AIUTO con i totali di componenti e
+# strumenti, calcolati dal parser mentre il sottoalbero dell'AIUTO è in memoria
+SCHEMA_AIUTI_AGGREGATI = pa.schema(list(SCHEMA_AIUTI) + [
+    ('IMPORTO_NOMINALE_TOTALE', pa.float64()),
+    ('ELEMENTO_DI_AIUTO_TOTALE', pa.float64()),
+    ('NUM_COMPONENTI', pa.int32()),
+    ('NUM_STRUMENTI', pa.int32()),
+    ('COD_STRUMENTI', pa.string()),    # Codici distinti separati da '|'
+    ('SETTORI_ATTIVITA', pa.string()), # Codici ATECO distinti separati da '|'
+])
+
+TABLE_SCHEMAS = {
+    "aiuti": SCHEMA_AIUTI,
+    "componenti": SCHEMA_COMPONENTI,
+    "strumenti": SCHEMA_STRUMENTI,
+    "aiuti_aggregati": SCHEMA_AIUTI_AGGREGATI,
+}
+
+# Tabelle dimensione (dimensioni/<nome>.parquet): nome -> (colonna codice, colonna descrizione).
+# Le tabelle dei fatti contengono solo il codice; le descrizioni, lunghe e ripetute
+# su ogni riga, vengono riunite dalle viste e dall'exporter quando servono.
+DIMENSIONS = {
+    'tipo_misura': ('COD_TIPO_MISURA', 'DES_TIPO_MISURA'),
+    'procedimento': ('COD_PROCEDIMENTO', 'DES_PROCEDIMENTO'),
+    'regolamento': ('COD_REGOLAMENTO', 'DES_REGOLAMENTO'),
+    'obiettivo': ('COD_OBIETTIVO', 'DES_OBIETTIVO'),
+    'strumento': ('COD_STRUMENTO', 'DES_STRUMENTO'),
+}
+
+def dimension_schema(name: str) -> pa.Schema:
+    code, description = DIMENSIONS[name]
+    code_type = next(s.field(code).type for s in TABLE_SCHEMAS.values() if code in s.names)
+    return pa.schema([(code, code_type), (description, pa.string())])
+
+# Colonne a bassa cardinalità da scrivere con dictionary encoding Parquet.
+# Le colonne di testo libero (titoli, descrizioni) restano in plain encoding.
+DICTIONARY_COLUMNS = frozenset(
+    [name for schema in (SCHEMA_AIUTI, SCHEMA_COMPONENTI, SCHEMA_STRUMENTI, SCHEMA_AIUTI_AGGREGATI)
+     for name in schema.names if name.startswith(('DES_', 'COD_'))]
+    + ['FILE_SOURCE', 'REGIONE_BENEFICIARIO', 'SETTORE_ATTIVITA', 'SETTORI_ATTIVITA']
+)
+
+# Chiavi di ordinamento usate da `compact`, per il pruning dei row group tramite
+# statistiche min/max: prima la colonna filtrata (codice fiscale per lookup ed
+# export), poi le chiavi surrogate usate nei join verso la tabella figlia.
+# Una chiave quasi univoca in prima posizione renderebbe inutili le successive
+SORT_KEYS = {
+    'aiuti': ['CODICE_FISCALE_BENEFICIARIO', 'AIUTO_SK'],
+    'componenti': ['AIUTO_SK', 'COMPONENTE_SK'],
+    'strumenti': ['COMPONENTE_SK'],
+    'aiuti_aggregati': ['CODICE_FISCALE_BENEFICIARIO', 'AIUTO_SK'],
+}
@@ -1,14 +1,23 @@
 import os
+import time
+import hashlib
 from lxml import etree
-import polars as pl
 import pyarrow as pa
 import pyarrow.parquet as pq
 from pathlib import Path
 from typing import List, Dict, Any, Tuple
 import logging
 import re
-import io
-from .models import SCHEMA_AIUTI, SCHEMA_COMPONENTI, SCHEMA_STRUMENTI
+from .models import (SCHEMA_AIUTI, SCHEMA_COMPONENTI, SCHEMA_STRUMENTI, SCHEMA_AIUTI_AGGREGATI,
+                     TABLE_SCHEMAS, DIMENSIONS, DICTIONARY_COLUMNS, surrogate_key)
+from .batch import ColumnarBatch
+from .writer import PartitionedParquetWriter
+from .sources import open_source, source_name
+from .checkpoint import Checkpointer
+from .dimensions import log_conflicts
+from .manifest import HASH_ALGORITHM, unit_digest
+from .metrics import StageTimer, reset_peak_rss, unit_profile
+from .scheduler import WORKER_MEMORY_ESTIMATE
 
 logger = logging.getLogger(__name__)
 
@@ -31,31 +40,126 @@ def safe_float(element) -> float:
             return 0.0
     return 0.0
 
+# Byte di controllo ASCII non ammessi in XML 1.0 (tutti tranne \t, \n, \r)
+INVALID_CONTROL_BYTES = bytes(b for b in range(32) if b not in (9, 10, 13))
+# Entità numeriche che referenziano gli stessi caratteri, anche con zeri iniziali:
+# decimali &#0; - &#31; (eccetto 9, 10, 13) ed esadecimali &#x0; - &#x1F; (eccetto 9, A, D)
+INVALID_ENTITY = re.compile(
+    rb'&#(?:0*(?:[0-8]|1[1-2]|1[4-9]|2[0-9]|3[0-1])|[xX]0*(?:[0-8]|[bBcCeEfF]|1[0-9a-fA-F]));'
+)
+# Lunghezza massima di un'entità che può restare spezzata a fine blocco
+MAX_ENTITY_LEN = 16
+READ_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Ripartizione della memoria di un worker: buffer colonnari del parser e dati in
+# attesa nel writer; il resto resta per lxml, conversione Arrow e codifica Parquet
+# (durante un flush i dati esistono sia come liste Python sia come array Arrow)
+BATCH_MEMORY_FRACTION = 0.25
+PENDING_MEMORY_FRACTION = 0.25
+
 class CleanFileInputStream:
     """
     Wrapper file-like che rimuove i caratteri XML non validi dallo stream.
-    Rimuove i caratteri di controllo ASCII (0-31) eccetto \t (9), \n (10), \r (13).
+    Rimuove i caratteri di controllo ASCII (0-31) eccetto \t (9), \n (10), \r (13),
+    sia come byte grezzi sia come entità numeriche (&#1;, &#x1F;, ...).
+    Accetta un percorso oppure un oggetto file-like binario già aperto.
+
+    La sorgente viene letta a blocchi di dimensione fissa; un'entità spezzata tra
+    due blocchi viene rimandata al blocco successivo. I blocchi già puliti (il caso
+    normale) passano senza sostituzioni, dopo una sola scansione dei byte in C.
+    Con digest (un oggetto hashlib) i byte letti dalla sorgente vengono anche
+    aggiunti all'hash, così il manifest non deve rileggere il file.
     """
-    def __init__(self, filename):
-        self.f = open(filename, 'rb')
-        # Regex per caratteri invalidi:
-        # 1. Raw bytes: range 0x00-0x08, 0x0B-0x0C, 0x0E-0x1F
-        # 2. Entità decimali: &#0; to &#31; (eccetto 9, 10, 13)
-        # 3. Entità hex: &#x0; to &#x1F; (eccetto 9, A, D)
-        # Nota: pattern bytes per performance
-        self.invalid_xml_chars = re.compile(
-            b'[\x00-\x08\x0b\x0c\x0e-\x1f]|'
-            b'&#(?:[0-8]|1[1-2]|1[4-9]|2[0-9]|3[0-1]);|'
-            b'&#x(?:[0-8]|[bB][cC]|[eE][fF]|1[0-9a-fA-F]);'
-        )
+    def __init__(self, source, buffer_size: int = READ_BUFFER_SIZE, timer: StageTimer = None, digest=None):
+        if isinstance(source, (str, os.PathLike)):
+            self.f = open(source, 'rb')
+        else:
+            self.f = source
+        self.buffer_size = buffer_size
+        self.timer = timer or StageTimer(enabled=False)
+        self.bytes_in = 0
+        self.bytes_stripped = 0
+        self.digest = digest
+        self._buffer = b''
+        self._pos = 0
+        self._carry = b''
+        self._eof = False
+
+    def _clean(self, data: bytes) -> bytes:
+        # Fast path: translate scorre il blocco in C, se la lunghezza non cambia
+        # non ci sono byte di controllo e il blocco originale viene riusato
+        cleaned = data.translate(None, INVALID_CONTROL_BYTES)
+        if len(cleaned) == len(data):
+            cleaned = data
+        if b'&#' in cleaned:
+            cleaned = INVALID_ENTITY.sub(b'', cleaned)
+        self.bytes_stripped += len(data) - len(cleaned)
+        return cleaned
+
+    def _next_block(self) -> bytes:
+        """Legge e ripulisce il prossimo blocco non vuoto; b'' a fine stream"""
+        self.timer.start("read_sanitize")
+        try:
+            return self._read_block()
+        finally:
+            self.timer.stop()
+
+    def _read_block(self) -> bytes:
+        while not self._eof:
+            raw = self.f.read(self.buffer_size)
+            if raw:
+                self.bytes_in += len(raw)
+                if self.digest is not None:
+                    self.digest.update(raw)
+                data = self._carry + raw if self._carry else raw
+                self._carry = b''
+                # Un'entità aperta a fine blocco potrebbe chiudersi nel blocco successivo
+                amp = data.rfind(b'&', max(0, len(data) - MAX_ENTITY_LEN))
+                if amp >= 0 and data.find(b';', amp) < 0:
+                    self._carry = data[amp:]
+                    data = data[:amp]
+            else:
+                self._eof = True
+                data, self._carry = self._carry, b''
+            if data:
+                cleaned = self._clean(data)
+                if cleaned:
+                    return cleaned
+        return b''
 
     def read(self, size=-1):
-        data = self.f.read(size)
-        if not data:
-            return data
-        # Sostituisce i caratteri invalidi con spazio o nulla (qui usiamo nulla)
-        return self.invalid_xml_chars.sub(b'', data)
+        if self._pos >= len(self._buffer):
+            self._buffer = self._next_block()
+            self._pos = 0
+            if not self._buffer:
+                return b''
+
+        if size < 0:
+            chunks = [self._buffer[self._pos:]]
+            self._buffer, self._pos = b'', 0
+            while True:
+                block = self._next_block()
+                if not block:
+                    return b''.join(chunks)
+                chunks.append(block)
+
+        if self._pos == 0 and size >= len(self._buffer):
+            data = self._buffer
+        else:
+            data = self._buffer[self._pos:self._pos + size]
+        self._pos += len(data)
+        return data
     
+    def hexdigest(self) -> str:
+        """Hash dell'intera sorgente: i byte non ancora letti dal parser vengono letti ora"""
+        while not self._eof:
+            raw = self.f.read(self.buffer_size)
+            if not raw:
+                break
+            self.digest.update(raw)
+        self._eof = True
+        return self.digest.hexdigest()
+
     def close(self):
         self.f.close()
     
@@ -65,46 +169,260 @@ class CleanFileInputStream:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.close()
 
-def process_file(file_path: str, output_dir: str) -> Dict[str, int]:
+def process_file(file_path: str, output_dir: str, start: int = None, end: int = None, member: str = None,
+                 profile: bool = False, trace: bool = False,
+                 memory_per_worker: int = WORKER_MEMORY_ESTIMATE,
+                 checkpoint_interval: int = 0, resume: bool = False) -> Dict[str, int]:
     """
-    Processa un singolo file XML e salva i risultati in Parquet partizionati per Anno.
-    Restituisce statistiche sui record processati.
+    Processa un singolo file XML (o l'intervallo di byte [start, end) ottenuto
+    da split_file, o il membro member di un archivio zip/gz/zst) e salva i
+    risultati in Parquet partizionati per Anno. I buffer vengono svuotati in
+    base alla memoria stimata, entro memory_per_worker byte.
+    Con checkpoint_interval > 0 ogni checkpoint_interval byte letti i file
+    Parquet vengono chiusi e lo stato salvato in un checkpoint; con resume
+    l'unità riparte dall'ultimo checkpoint invece che dall'inizio.
+    Restituisce statistiche sui record processati e l'hash dei byte letti
+    (stats["digest"], vedi manifest.unit_digest); con profile anche i tempi
+    per fase, i byte letti e scritti e il picco di RSS (stats["profile"]),
+    con trace gli intervalli per il Chrome trace.
     """
     path = Path(file_path)
-    filename = path.name
+    filename = source_name(path, member)
+    timer = StageTimer(enabled=profile or trace, trace=trace)
+    if timer.enabled:
+        reset_peak_rss()
+    started = time.perf_counter()
     
-    stats = {"aiuti": 0, "componenti": 0, "strumenti": 0}
+    stats = {"aiuti": 0, "componenti": 0, "strumenti": 0, "bytes_stripped": 0,
+             "dimensions": {name: {} for name in DIMENSIONS}}
+    writer = None
+    checkpointer = None
+    state = None
+    unit_range = (member, start, end)
     
     try:
-        # Usa il wrapper per pulire lo stream XML on-the-fly
-        with CleanFileInputStream(str(path)) as clean_stream:
-            # iterparse accetta un oggetto file-like
-            # recover=True tenta di continuare anche se ci sono errori di parsing
-            context = etree.iterparse(clean_stream, events=("end",), tag=f"{NS}AIUTO", recover=False)
-            _process_xml_context(context, filename, output_dir, stats)
+        if checkpoint_interval > 0:
+            checkpointer = Checkpointer(output_dir, file_path, start, end, member, checkpoint_interval)
+            state = checkpointer.resume() if resume else None
+        if state is not None:
+            if state["stats"]:
+                stats.update(state["stats"])
+            if state["complete"]:
+                return dict(stats, outputs=list(state["outputs"]), committed=list(state["outputs"]),
+                            digest=unit_digest(file_path, *unit_range))
+            if state["offset"] is not None:
+                start = state["offset"]
+
+        # Un writer per unità: i batch vengono accodati come row group agli stessi file
+        writer = PartitionedParquetWriter(output_dir, TABLE_SCHEMAS, dictionary_columns=DICTIONARY_COLUMNS,
+                                          max_pending_bytes=int(memory_per_worker * PENDING_MEMORY_FRACTION),
+                                          prefix=state and state["prefix"], first_seq=state["seq"] if state else 0)
+        if checkpointer:
+            checkpointer.begin(writer)
+        with writer:
+            # Usa il wrapper per pulire lo stream XML on-the-fly
+            with CleanFileInputStream(open_source(path, member, start, end), timer=timer,
+                                      digest=hashlib.new(HASH_ALGORITHM)) as clean_stream:
+                if checkpointer:
+                    checkpointer.stream = clean_stream
+                # iterparse accetta un oggetto file-like
+                # recover=True tenta di continuare anche se ci sono errori di parsing
+                context = etree.iterparse(clean_stream, events=("end",), tag=f"{NS}AIUTO", recover=False)
+                consumed = _process_xml_context(context, filename, writer, stats, timer,
+                                                batch_bytes=int(memory_per_worker * BATCH_MEMORY_FRACTION),
+                                                checkpointer=checkpointer)
+                stats["bytes_stripped"] += clean_stream.bytes_stripped
+                bytes_in = clean_stream.bytes_in
+                # Ripresa da un offset: la parte già letta non è nello stream, l'unità va riletta
+                resumed = state is not None and state["offset"] is not None and start != (unit_range[1] or 0)
+                stats["digest"] = unit_digest(file_path, *unit_range) if resumed else clean_stream.hexdigest()
+            # Chiusura del writer: scrittura dei row group rimasti in buffer
+            timer.start("write")
+        timer.stop()
+        if checkpointer:
+            checkpointer.commit(consumed, writer, stats, complete=True)
+        
+        if stats["bytes_stripped"]:
+            logger.info(f"Stripped {stats['bytes_stripped']} invalid XML bytes from {filename}")
             
     except Exception as e:
         # Critical: convert exception to string to avoid pickling errors with lxml objects
         error_msg = str(e)
         logger.error(f"Critical error processing file {filename}: {error_msg}")
-        return {"aiuti": 0, "componenti": 0, "strumenti": 0, "error": 1}
+        # I file già scritti vengono restituiti per permettere al chiamante di rimuoverli,
+        # tranne quelli coperti da un checkpoint, da cui riparte il prossimo --resume
+        committed = list(checkpointer.committed) if checkpointer else []
+        return {"aiuti": 0, "componenti": 0, "strumenti": 0, "error": 1, "committed": committed,
+                "outputs": [f for f in writer.files if f not in committed] if writer else []}
 
+    # Percorsi dei file Parquet prodotti, relativi a output_dir (compresi quelli dei tentativi precedenti)
+    stats["outputs"] = list(checkpointer.committed) if checkpointer else list(writer.files)
+    stats["committed"] = list(stats["outputs"]) if checkpointer else []
+    if timer.enabled:
+        bytes_out = sum((Path(output_dir) / f).stat().st_size for f in writer.files)
+        records = stats["aiuti"] + stats["componenti"] + stats["strumenti"]
+        stats["profile"] = unit_profile(filename, timer, started, bytes_in, bytes_out, records)
     return stats
 
-def _process_xml_context(context, filename, output_dir, stats):
-    """Logica estratta per processare il contesto XML"""
-    batch_aiuti = []
-    batch_componenti = []
-    batch_strumenti = []
+def _field_index(schema, exclude=()) -> Dict[str, int]:
+    """Tabella tag XML (con namespace) -> posizione della colonna nello schema"""
+    return {f"{NS}{name}": i for i, name in enumerate(schema.names) if name not in exclude}
+
+# Tabelle di dispatch generate dagli schemi: per aggiungere un campo basta aggiungerlo
+# allo schema in models.py. Le colonne escluse non sono figli XML ma derivano dal contesto.
+AIUTO_FIELDS = _field_index(SCHEMA_AIUTI, exclude=("AIUTO_SK", "COD_TIPO_MISURA", "ANNO", "FILE_SOURCE"))
+COMPONENTE_FIELDS = _field_index(SCHEMA_COMPONENTI, exclude=("CAR_AIUTO", "COR_AIUTO", "AIUTO_SK", "COMPONENTE_SK", "ANNO"))
+STRUMENTO_FIELDS = _field_index(SCHEMA_STRUMENTI, exclude=("ID_COMPONENTE_AIUTO", "COMPONENTE_SK", "ANNO"))
+
+def _dimension_fields(schema, fields: Dict[str, int]) -> List[Tuple[str, int, int]]:
+    """
+    Dimensioni con il codice in schema: (nome, indice codice, indice descrizione).
+    La descrizione non è una colonna della tabella: viene letta in una posizione
+    oltre la fine dello schema, che ColumnarBatch.append ignora.
+    """
+    dims = []
+    for name, (code, description) in DIMENSIONS.items():
+        if code in schema.names:
+            index = len(schema) + len(dims)
+            fields[f"{NS}{description}"] = index
+            dims.append((name, schema.get_field_index(code), index))
+    return dims
+
+AIUTO_DIMENSIONS = _dimension_fields(SCHEMA_AIUTI, AIUTO_FIELDS)
+COMPONENTE_DIMENSIONS = _dimension_fields(SCHEMA_COMPONENTI, COMPONENTE_FIELDS)
+STRUMENTO_DIMENSIONS = _dimension_fields(SCHEMA_STRUMENTI, STRUMENTO_FIELDS)
+
+TAG_COMPONENTI = f"{NS}COMPONENTI_AIUTO"
+TAG_COMPONENTE = f"{NS}COMPONENTE_AIUTO"
+TAG_STRUMENTI = f"{NS}STRUMENTI_AIUTO"
+TAG_STRUMENTO = f"{NS}STRUMENTO_AIUTO"
+
+A_CAR = SCHEMA_AIUTI.get_field_index("CAR")
+A_COR = SCHEMA_AIUTI.get_field_index("COR")
+A_SK = SCHEMA_AIUTI.get_field_index("AIUTO_SK")
+A_TIPO_MISURA = SCHEMA_AIUTI.get_field_index("COD_TIPO_MISURA")
+A_DES_TIPO_MISURA = AIUTO_FIELDS[f"{NS}DES_TIPO_MISURA"]
+A_DATA = SCHEMA_AIUTI.get_field_index("DATA_CONCESSIONE")
+A_ANNO = SCHEMA_AIUTI.get_field_index("ANNO")
+A_FILE = SCHEMA_AIUTI.get_field_index("FILE_SOURCE")
+C_ID = SCHEMA_COMPONENTI.get_field_index("ID_COMPONENTE_AIUTO")
+C_CAR = SCHEMA_COMPONENTI.get_field_index("CAR_AIUTO")
+C_COR = SCHEMA_COMPONENTI.get_field_index("COR_AIUTO")
+C_AIUTO_SK = SCHEMA_COMPONENTI.get_field_index("AIUTO_SK")
+C_SK = SCHEMA_COMPONENTI.get_field_index("COMPONENTE_SK")
+C_ANNO = SCHEMA_COMPONENTI.get_field_index("ANNO")
+C_SETTORE = SCHEMA_COMPONENTI.get_field_index("SETTORE_ATTIVITA")
+S_ID = SCHEMA_STRUMENTI.get_field_index("ID_COMPONENTE_AIUTO")
+S_SK = SCHEMA_STRUMENTI.get_field_index("COMPONENTE_SK")
+S_ANNO = SCHEMA_STRUMENTI.get_field_index("ANNO")
+S_COD = SCHEMA_STRUMENTI.get_field_index("COD_STRUMENTO")
+S_IMPORTO = SCHEMA_STRUMENTI.get_field_index("IMPORTO_NOMINALE")
+S_ELEMENTO = SCHEMA_STRUMENTI.get_field_index("ELEMENTO_DI_AIUTO")
+
+# Importi mancanti o non numerici valgono 0.0 (come safe_float)
+STRUMENTI_DEFAULTS = {"ELEMENTO_DI_AIUTO": 0.0, "IMPORTO_NOMINALE": 0.0}
+
+def _amount(text) -> float:
+    """Importo per i totali di aiuti_aggregati, con le stesse regole di STRUMENTI_DEFAULTS"""
+    if text:
+        try:
+            return float(text)
+        except ValueError:
+            pass
+    return 0.0
+
+def _collect_dimensions(row: list, dims: List[Tuple[str, int, int]], found: Dict[str, dict],
+                        conflicts: Dict[str, list]):
+    """
+    Registra le coppie codice/descrizione di row. Come tra le unità di lavoro
+    (dimensions.combine_dimensions) vince l'ultima descrizione letta, così il
+    risultato non dipende da come il file è diviso tra i worker.
+    """
+    for name, code_index, description_index in dims:
+        code = row[code_index]
+        description = row[description_index]
+        if code is None or description is None:
+            continue
+        previous = found[name].get(code)
+        if previous is not None and previous != description:
+            conflicts[name].append((code, previous, description))
+        found[name][code] = description
+
+def _dispatch_children(elem, fields: Dict[str, int], row: list, container_tag: str = None):
+    """
+    Visita una sola volta i figli di elem: il testo dei tag presenti in fields
+    finisce nella colonna corrispondente di row. Restituisce l'eventuale nodo
+    contenitore (container_tag) incontrato durante la visita.
+    """
+    container = None
+    for child in elem:
+        idx = fields.get(child.tag)
+        if idx is not None:
+            text = child.text
+            if text:
+                row[idx] = text.strip()
+        elif child.tag == container_tag:
+            container = child
+    return container
+
+def _release(elem):
+    """
+    Libera il sottoalbero di elem già elaborato e tutti i nodi precedenti, a ogni
+    livello fino alla radice: l'albero costruito da iterparse non cresce con il file.
+    """
+    elem.clear(keep_tail=False)
+    for node in (elem, *elem.iterancestors()):
+        parent = node.getparent()
+        if parent is None:
+            break
+        while node.getprevious() is not None:
+            del parent[0]
+
+def _process_xml_context(context, filename, writer: PartitionedParquetWriter, stats, timer: StageTimer = None,
+                         batch_bytes: int = int(WORKER_MEMORY_ESTIMATE * BATCH_MEMORY_FRACTION),
+                         checkpointer: Checkpointer = None) -> int:
+    """
+    Logica estratta per processare il contesto XML. Restituisce il numero di
+    AIUTO letti, compresi quelli saltati per riprendere da un checkpoint.
+    Gli errori (su un elemento o in scrittura) si propagano: l'unità fallisce e
+    la sorgente non viene registrata nel manifest con righe mancanti.
+    """
+    timer = timer or StageTimer(enabled=False)
+    skip = checkpointer.skip if checkpointer else 0
+    consumed = 0
+    batches = {
+        "aiuti": ColumnarBatch(SCHEMA_AIUTI),
+        "componenti": ColumnarBatch(SCHEMA_COMPONENTI),
+        "strumenti": ColumnarBatch(SCHEMA_STRUMENTI, defaults=STRUMENTI_DEFAULTS),
+        "aiuti_aggregati": ColumnarBatch(SCHEMA_AIUTI_AGGREGATI),
+    }
+    batch_aiuti = batches["aiuti"]
+    batch_componenti = batches["componenti"]
+    batch_strumenti = batches["strumenti"]
+    batch_aggregati = batches["aiuti_aggregati"]
     
-    BATCH_SIZE = 10000 
+    # Righe con le posizioni extra per le descrizioni delle dimensioni
+    n_aiuti = len(SCHEMA_AIUTI)
+    row_aiuti = n_aiuti + len(AIUTO_DIMENSIONS)
+    row_componenti = len(SCHEMA_COMPONENTI) + len(COMPONENTE_DIMENSIONS)
+    row_strumenti = len(SCHEMA_STRUMENTI) + len(STRUMENTO_DIMENSIONS)
+    dimensions = stats["dimensions"]
+    conflicts = {name: [] for name in dimensions}
     
-    for event, elem in context:
+    for event, elem in timer.iterate("iterparse", context):
+        consumed += 1
+        if consumed <= skip:
+            # Già scritto prima del checkpoint (archivi, che non si possono riaprire a un offset)
+            _release(elem)
+            continue
+        timer.start("extract")
         try:
-            # Estrazione dati AIUTO
-            car = safe_text(elem.find(f"{NS}CAR"))
-            cor = safe_text(elem.find(f"{NS}COR"))
-            data_concessione = safe_text(elem.find(f"{NS}DATA_CONCESSIONE"))
+            # Estrazione dati AIUTO: una sola passata sui figli
+            aiuto = [None] * row_aiuti
+            componenti_node = _dispatch_children(elem, AIUTO_FIELDS, aiuto, TAG_COMPONENTI)
+            car = aiuto[A_CAR]
+            cor = aiuto[A_COR]
+            data_concessione = aiuto[A_DATA]
             
             # Determinare l'anno per il partizionamento
             anno = 0
@@ -114,119 +432,113 @@ def _process_xml_context(context, filename, output_dir, stats):
                 except:
                     anno = 0
             
-            aiuto = {
-                "CAR": car,
-                "TITOLO_MISURA": safe_text(elem.find(f"{NS}TITOLO_MISURA")),
-                "DES_TIPO_MISURA": safe_text(elem.find(f"{NS}DES_TIPO_MISURA")),
-                "BASE_GIURIDICA_NAZIONALE": safe_text(elem.find(f"{NS}BASE_GIURIDICA_NAZIONALE")),
-                "CODICE_FISCALE_BENEFICIARIO": safe_text(elem.find(f"{NS}CODICE_FISCALE_BENEFICIARIO")),
-                "DENOMINAZIONE_BENEFICIARIO": safe_text(elem.find(f"{NS}DENOMINAZIONE_BENEFICIARIO")),
-                "TITOLO_PROGETTO": safe_text(elem.find(f"{NS}TITOLO_PROGETTO")),
-                "DESCRIZIONE_PROGETTO": safe_text(elem.find(f"{NS}DESCRIZIONE_PROGETTO")),
-                "CUP": safe_text(elem.find(f"{NS}CUP")),
-                "REGIONE_BENEFICIARIO": safe_text(elem.find(f"{NS}REGIONE_BENEFICIARIO")),
-                "DES_TIPO_BENEFICIARIO": safe_text(elem.find(f"{NS}DES_TIPO_BENEFICIARIO")),
-                "COR": cor,
-                "DATA_CONCESSIONE": data_concessione,
-                "ANNO": anno,
-                "FILE_SOURCE": filename
-            }
+            # DATA_CONCESSIONE resta testo e viene convertita in date32 in blocco
+            # da ColumnarBatch.to_arrow()
+            aiuto_sk = surrogate_key(car, cor)
+            aiuto[A_SK] = aiuto_sk
+            # Il tipo misura non ha un codice nell'XML: lo si deriva dalla descrizione
+            if aiuto[A_DES_TIPO_MISURA]:
+                aiuto[A_TIPO_MISURA] = surrogate_key(aiuto[A_DES_TIPO_MISURA])
+                _collect_dimensions(aiuto, AIUTO_DIMENSIONS, dimensions, conflicts)
+            aiuto[A_ANNO] = anno
+            aiuto[A_FILE] = filename
             batch_aiuti.append(aiuto)
             stats["aiuti"] += 1
             
+            # Totali per aiuti_aggregati (dict come insiemi ordinati)
+            importo_totale = 0.0
+            elemento_totale = 0.0
+            id_componenti = set()
+            num_strumenti = 0
+            cod_strumenti = {}
+            settori = {}
+            
             # Componenti
-            componenti_node = elem.find(f"{NS}COMPONENTI_AIUTO")
             if componenti_node is not None:
-                for comp_elem in componenti_node.findall(f"{NS}COMPONENTE_AIUTO"):
-                    id_comp = safe_text(comp_elem.find(f"{NS}ID_COMPONENTE_AIUTO"))
-                    
-                    comp = {
-                        "ID_COMPONENTE_AIUTO": id_comp,
-                        "CAR_AIUTO": car,
-                        "COR_AIUTO": cor,
-                        "COD_PROCEDIMENTO": safe_text(comp_elem.find(f"{NS}COD_PROCEDIMENTO")),
-                        "DES_PROCEDIMENTO": safe_text(comp_elem.find(f"{NS}DES_PROCEDIMENTO")),
-                        "COD_REGOLAMENTO": safe_text(comp_elem.find(f"{NS}COD_REGOLAMENTO")),
-                        "DES_REGOLAMENTO": safe_text(comp_elem.find(f"{NS}DES_REGOLAMENTO")),
-                        "COD_OBIETTIVO": safe_text(comp_elem.find(f"{NS}COD_OBIETTIVO")),
-                        "DES_OBIETTIVO": safe_text(comp_elem.find(f"{NS}DES_OBIETTIVO")),
-                        "SETTORE_ATTIVITA": safe_text(comp_elem.find(f"{NS}SETTORE_ATTIVITA")),
-                        "ANNO": anno
-                    }
+                for comp_elem in componenti_node:
+                    if comp_elem.tag != TAG_COMPONENTE:
+                        continue
+                    comp = [None] * row_componenti
+                    strumenti_node = _dispatch_children(comp_elem, COMPONENTE_FIELDS, comp, TAG_STRUMENTI)
+                    id_comp = comp[C_ID]
+                    comp[C_CAR] = car
+                    comp[C_COR] = cor
+                    comp[C_AIUTO_SK] = aiuto_sk
+                    # ID_COMPONENTE_AIUTO è univoco solo all'interno del suo AIUTO
+                    comp_sk = surrogate_key(aiuto_sk, id_comp)
+                    comp[C_SK] = comp_sk
+                    comp[C_ANNO] = anno
+                    _collect_dimensions(comp, COMPONENTE_DIMENSIONS, dimensions, conflicts)
                     batch_componenti.append(comp)
                     stats["componenti"] += 1
+                    id_componenti.add(id_comp)
+                    if comp[C_SETTORE]:
+                        settori[comp[C_SETTORE]] = None
                     
                     # Strumenti
-                    strumenti_node = comp_elem.find(f"{NS}STRUMENTI_AIUTO")
                     if strumenti_node is not None:
-                        for strum_elem in strumenti_node.findall(f"{NS}STRUMENTO_AIUTO"):
-                            strum = {
-                                "ID_COMPONENTE_AIUTO": id_comp,
-                                "COD_STRUMENTO": safe_text(strum_elem.find(f"{NS}COD_STRUMENTO")),
-                                "DES_STRUMENTO": safe_text(strum_elem.find(f"{NS}DES_STRUMENTO")),
-                                "ELEMENTO_DI_AIUTO": safe_float(strum_elem.find(f"{NS}ELEMENTO_DI_AIUTO")),
-                                "IMPORTO_NOMINALE": safe_float(strum_elem.find(f"{NS}IMPORTO_NOMINALE")),
-                                "ANNO": anno
-                            }
+                        for strum_elem in strumenti_node:
+                            if strum_elem.tag != TAG_STRUMENTO:
+                                continue
+                            strum = [None] * row_strumenti
+                            _dispatch_children(strum_elem, STRUMENTO_FIELDS, strum)
+                            _collect_dimensions(strum, STRUMENTO_DIMENSIONS, dimensions, conflicts)
+                            strum[S_ID] = id_comp
+                            strum[S_SK] = comp_sk
+                            strum[S_ANNO] = anno
                             batch_strumenti.append(strum)
                             stats["strumenti"] += 1
+                            importo_totale += _amount(strum[S_IMPORTO])
+                            elemento_totale += _amount(strum[S_ELEMENTO])
+                            if strum[S_COD]:
+                                num_strumenti += 1
+                                cod_strumenti[strum[S_COD]] = None
+
+            has_componenti = bool(id_componenti)
+            batch_aggregati.append(aiuto[:n_aiuti] + [
+                importo_totale,
+                elemento_totale,
+                len(id_componenti),
+                num_strumenti,
+                "|".join(cod_strumenti) if has_componenti else None,
+                "|".join(settori) if has_componenti else None,
+            ])
 
             # Release memory for the processed element
-            elem.clear()
-            while elem.getprevious() is not None:
-                del elem.getparent()[0]
-                
-            # Flush batches if size reached
-            if len(batch_aiuti) >= BATCH_SIZE:
-                flush_batches(batch_aiuti, batch_componenti, batch_strumenti, output_dir)
-                batch_aiuti = []
-                batch_componenti = []
-                batch_strumenti = []
-
-        except Exception as e:
-            logger.error(f"Error processing element in {filename}: {e}")
-            continue
+            _release(elem)
+        finally:
+            timer.stop()
+
+        # Flush quando la memoria stimata dei buffer raggiunge il budget
+        if sum(b.nbytes for b in batches.values()) >= batch_bytes:
+            flush_batches(batches, writer, timer)
 
+        # Checkpoint: tutto ciò che è stato letto finora finisce in file Parquet chiusi
+        if checkpointer and checkpointer.due():
+            flush_batches(batches, writer, timer)
+            timer.start("write")
+            writer.close()
+            timer.stop()
+            checkpointer.commit(consumed, writer, stats)
     # Final flush
-    if batch_aiuti:
-        try:
-            flush_batches(batch_aiuti, batch_componenti, batch_strumenti, output_dir)
-        except Exception as e:
-             logger.error(f"Error flushing final batch in {filename}: {str(e)}")
+    if len(batch_aiuti):
+        flush_batches(batches, writer, timer)
+    for name, found in conflicts.items():
+        log_conflicts(name, found)
              
     # Non cancelliamo context qui perché è gestito dal chiamante, ma possiamo cancellare le ref
     del context
+    return consumed
 
-def flush_batches(aiuti: List[dict], componenti: List[dict], strumenti: List[dict], output_dir: str):
-    """Scrive i batch su disco in formato Parquet partizionato dataset style"""
-    base_path = Path(output_dir)
-    
-    if aiuti:
-        df = pl.DataFrame(aiuti, schema=None, orient="row") 
-        table = df.to_arrow()
-        pq.write_to_dataset(
-            table,
-            root_path=str(base_path / "aiuti"),
-            partition_cols=['ANNO'],
-            existing_data_behavior='overwrite_or_ignore'
-        )
-
-    if componenti:
-        df = pl.DataFrame(componenti, orient="row")
-        table = df.to_arrow()
-        pq.write_to_dataset(
-            table,
-            root_path=str(base_path / "componenti"),
-            partition_cols=['ANNO'],
-            existing_data_behavior='overwrite_or_ignore'
-        )
-
-    if strumenti:
-        df = pl.DataFrame(strumenti, orient="row")
-        table = df.to_arrow()
-        pq.write_to_dataset(
-            table,
-            root_path=str(base_path / "strumenti"),
-            partition_cols=['ANNO'],
-            existing_data_behavior='overwrite_or_ignore'
-        )
+def flush_batches(batches: Dict[str, ColumnarBatch], writer: PartitionedParquetWriter, timer: StageTimer = None):
+    """Converte i buffer colonnari in tabelle Arrow, le accoda al writer e svuota i buffer"""
+    timer = timer or StageTimer(enabled=False)
+    for table_name, batch in batches.items():
+        if len(batch):
+            timer.start("convert")
+            table = batch.to_arrow()
+            timer.stop()
+            timer.start("write")
+            writer.write(table_name, table)
+            timer.stop()
+            batch.clear()
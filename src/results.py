@@ -0,0 +1,73 @@
+import sys
+import logging
+from pathlib import Path
+from typing import Callable, Optional
+import polars as pl
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_FORMATS = ("parquet", "csv", "ndjson")
+_EXTENSIONS = {".parquet": "parquet", ".csv": "csv", ".ndjson": "ndjson", ".jsonl": "ndjson", ".json": "ndjson"}
+
+# Righe per batch lette da DuckDB: limita la memoria indipendentemente dalla dimensione del risultato
+BATCH_ROWS = 64 * 1024
+PAGE_SIZE = 50
+
+def infer_format(path: str, fmt: str = None) -> str:
+    """Formato di output esplicito o dedotto dall'estensione del file"""
+    if fmt:
+        return fmt
+    try:
+        return _EXTENSIONS[Path(path).suffix.lower()]
+    except KeyError:
+        raise ValueError(f"Cannot infer output format from {path}, use one of {OUTPUT_FORMATS}")
+
+def write_batches(reader: pa.RecordBatchReader, path: str, fmt: str = None) -> int:
+    """
+    Scrive i record batch di un risultato direttamente su file (Parquet, CSV o NDJSON)
+    man mano che arrivano, senza materializzare il risultato. Restituisce le righe scritte.
+    """
+    fmt = infer_format(path, fmt)
+    rows = 0
+    if fmt == "parquet":
+        with pq.ParquetWriter(path, reader.schema, compression="zstd") as writer:
+            for batch in reader:
+                writer.write_batch(batch)
+                rows += batch.num_rows
+    elif fmt == "csv":
+        with pacsv.CSVWriter(path, reader.schema) as writer:
+            for batch in reader:
+                writer.write_batch(batch)
+                rows += batch.num_rows
+    elif fmt == "ndjson":
+        with open(path, "wb") as f:
+            for batch in reader:
+                pl.from_arrow(batch).write_ndjson(f)
+                rows += batch.num_rows
+    else:
+        raise ValueError(f"Unsupported output format {fmt}")
+    return rows
+
+def page_batches(reader: pa.RecordBatchReader, page_size: int = PAGE_SIZE, out=None,
+                 wait: Optional[Callable[[], bool]] = None) -> int:
+    """
+    Stampa il risultato a pagine di page_size righe man mano che i batch arrivano.
+    Tra una pagina e l'altra viene chiamato wait() (se indicato): se restituisce
+    False la lettura si interrompe. Restituisce le righe stampate.
+    """
+    out = out or sys.stdout
+    rows = 0
+    first = True
+    with pl.Config(tbl_rows=page_size, tbl_cols=-1, fmt_str_lengths=60):
+        for batch in reader:
+            for offset in range(0, batch.num_rows, page_size):
+                if not first and wait is not None and not wait():
+                    return rows
+                page = batch.slice(offset, page_size)
+                out.write(f"{pl.from_arrow(page)}\n")
+                rows += page.num_rows
+                first = False
+    return rows
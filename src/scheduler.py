@@ -0,0 +1,70 @@
+import os
+import logging
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Callable, Iterator, List, Optional, Tuple
+from .sources import WorkUnit
+
+logger = logging.getLogger(__name__)
+
+# Stima della memoria di picco di un worker (parser lxml + batch + buffer Parquet)
+WORKER_MEMORY_ESTIMATE = 512 * 1024 * 1024
+
+def available_memory() -> Optional[int]:
+    """Memoria disponibile in byte (MemAvailable su Linux), None se non determinabile"""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def effective_workers(requested: int, memory_per_worker: int = WORKER_MEMORY_ESTIMATE) -> int:
+    """Limita il numero di worker in modo da non superare la RAM disponibile"""
+    available = available_memory()
+    if not available or memory_per_worker <= 0:
+        return max(1, requested)
+    fit = max(1, available // memory_per_worker)
+    if fit < requested:
+        logger.warning(
+            f"Only {available / 2**30:.1f} GB available: running {fit} workers instead of {requested} "
+            f"({memory_per_worker / 2**20:.0f} MB each)"
+        )
+    return max(1, min(requested, fit))
+
+def order_largest_first(units: List[WorkUnit]) -> List[WorkUnit]:
+    """Ordinamento LPT (Longest Processing Time first): le unità più grandi partono per prime"""
+    return sorted(units, key=lambda u: u.size, reverse=True)
+
+def run_work_units(units: List[WorkUnit], fn: Callable, make_args: Callable[[WorkUnit], tuple],
+                   workers: int, memory_per_worker: int = WORKER_MEMORY_ESTIMATE
+                   ) -> Iterator[Tuple[WorkUnit, Any, Optional[BaseException]]]:
+    """
+    Esegue fn(*make_args(unit)) per ogni unità su un pool di processi.
+    Le unità vengono assegnate in ordine LPT e al massimo una per worker alla volta,
+    così l'ordine viene rispettato e la memoria impegnata resta entro il budget.
+    Restituisce (unità, risultato, eccezione) man mano che le unità terminano.
+    """
+    queue = order_largest_first(units)
+    workers = effective_workers(workers, memory_per_worker)
+    pending = {}
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        next_index = 0
+        while next_index < len(queue) or pending:
+            while next_index < len(queue) and len(pending) < workers:
+                unit = queue[next_index]
+                pending[executor.submit(fn, *make_args(unit))] = unit
+                next_index += 1
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                unit = pending.pop(future)
+                try:
+                    yield unit, future.result(), None
+                except Exception as e:
+                    yield unit, None, e
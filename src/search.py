@@ -0,0 +1,194 @@
+import os
+import re
+import json
+import logging
+import unicodedata
+from pathlib import Path
+from typing import Dict, List
+import polars as pl
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from .writer import PARTITION_COL
+from .dimensions import attach_descriptions
+
+logger = logging.getLogger(__name__)
+
+SEARCH_DIR = "_search"
+SEARCH_META = "segments.json"
+# Da incrementare quando cambia la tokenizzazione: forza la ricostruzione dell'indice
+SEARCH_VERSION = 1
+
+# Colonne di testo libero indicizzate (concatenate in un unico documento per AIUTO)
+TEXT_COLUMNS = ["TITOLO_PROGETTO", "DESCRIZIONE_PROGETTO", "TITOLO_MISURA"]
+MIN_TOKEN_LEN = 2
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+SEGMENT_ROW_GROUP_SIZE = 16 * 1024
+# Parametri BM25
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Parole vuote italiane (già senza accenti, come i token)
+STOPWORDS = frozenset("""
+a ad agli ai al all alla alle allo anche c che chi ci col come con contro cui d da dagli dai dal dall dalla
+dalle dallo degli dei del dell della delle dello dentro di dove e ed era essere fra gli ha hanno i il in
+l la le lo loro ma nei nel nell nella nelle nello negli noi non o ogni per perche piu po quale quali quando
+quanto quella quelle quelli quello questa queste questi questo se si sia sono su sugli sui sul sull sulla
+sulle sullo tra tutti tutto un una uno
+""".split())
+
+def fold(text: str) -> str:
+    """Minuscolo e senza accenti (attività -> attivita)"""
+    return "".join(c for c in unicodedata.normalize("NFKD", text.lower()) if not unicodedata.combining(c))
+
+def tokenize(text: str) -> List[str]:
+    """Token di una query: stessa normalizzazione usata in fase di indicizzazione"""
+    return [t for t in TOKEN_RE.findall(fold(text)) if len(t) >= MIN_TOKEN_LEN and t not in STOPWORDS]
+
+def _tokens_expr(text: pl.Expr) -> pl.Expr:
+    """Versione vettoriale di tokenize (Polars), per indicizzare file interi"""
+    return (text.str.to_lowercase().str.normalize("NFKD")
+            .str.replace_all(r"\p{M}", "").str.extract_all(TOKEN_RE.pattern))
+
+def _segment_name(rel: str) -> str:
+    path = Path(rel)
+    return f"{path.parent.name}-{path.name}"
+
+def _load_meta(search_dir: Path) -> Dict:
+    path = search_dir / SEARCH_META
+    if path.exists():
+        with open(path) as f:
+            meta = json.load(f)
+        if meta.get("version") == SEARCH_VERSION:
+            return meta
+    return {"version": SEARCH_VERSION, "segments": {}}
+
+def _save_meta(search_dir: Path, meta: Dict):
+    tmp = search_dir / (SEARCH_META + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(meta, f, indent=1, sort_keys=True)
+    os.replace(tmp, search_dir / SEARCH_META)
+
+def _build_segment(base: Path, rel: str, dest: Path) -> Dict[str, int]:
+    """
+    Postings (TERM, AIUTO_SK, TF, DOC_LEN, ROW_GROUP) di un file di AIUTI,
+    ordinate per termine: le statistiche dei row group permettono di leggere
+    solo la parte del segmento che contiene i termini cercati.
+    """
+    pf = pq.ParquetFile(base / rel)
+    columns = [c for c in TEXT_COLUMNS if c in pf.schema_arrow.names]
+    frames = [
+        pl.from_arrow(pf.read_row_group(rg, columns=["AIUTO_SK"] + columns))
+        .with_columns(pl.lit(rg, dtype=pl.Int32).alias("ROW_GROUP"))
+        for rg in range(pf.num_row_groups)
+    ]
+    docs = pl.concat(frames) if frames else pl.DataFrame()
+    if not columns or docs.is_empty():
+        postings = pl.DataFrame(schema={"TERM": pl.String, "AIUTO_SK": pl.Int64, "TF": pl.Int32,
+                                        "DOC_LEN": pl.Int32, "ROW_GROUP": pl.Int32})
+    else:
+        text = pl.concat_str([pl.col(c).fill_null("") for c in columns], separator=" ")
+        tokens = (docs.lazy()
+                  .select("AIUTO_SK", "ROW_GROUP", _tokens_expr(text).alias("TERM"))
+                  .explode("TERM")
+                  .filter(pl.col("TERM").str.len_chars() >= MIN_TOKEN_LEN)
+                  .filter(~pl.col("TERM").is_in(list(STOPWORDS))))
+        doc_len = tokens.group_by("AIUTO_SK", "ROW_GROUP").agg(pl.len().cast(pl.Int32).alias("DOC_LEN"))
+        postings = (tokens.group_by("TERM", "AIUTO_SK", "ROW_GROUP").agg(pl.len().cast(pl.Int32).alias("TF"))
+                    .join(doc_len, on=["AIUTO_SK", "ROW_GROUP"])
+                    .select("TERM", "AIUTO_SK", "TF", "DOC_LEN", "ROW_GROUP")
+                    .sort("TERM", "AIUTO_SK")
+                    .collect())
+    # dest può essere un hard link condiviso con la versione pubblicata: mai riscritto sul posto
+    tmp = dest.with_suffix(".tmp")
+    postings.write_parquet(tmp, compression="zstd", row_group_size=SEGMENT_ROW_GROUP_SIZE)
+    os.replace(tmp, dest)
+    return {"segment": dest.name, "docs": pf.metadata.num_rows,
+            "tokens": int(postings["TF"].sum() or 0)}
+
+def update_search_index(data_dir) -> int:
+    """
+    Aggiorna l'indice full-text: un segmento di postings per ogni file di AIUTI.
+    Vengono indicizzati solo i file nuovi; i segmenti dei file sostituiti da
+    parse o compact vengono rimossi. Restituisce il numero di documenti indicizzati.
+    """
+    base = Path(data_dir)
+    search_dir = base / SEARCH_DIR
+    search_dir.mkdir(parents=True, exist_ok=True)
+    meta = _load_meta(search_dir)
+    segments = meta["segments"]
+    files = sorted(str(f.relative_to(base)) for f in (base / "aiuti").glob(f"{PARTITION_COL}=*/*.parquet"))
+
+    changed = False
+    for rel in set(segments) - set(files):
+        (search_dir / segments.pop(rel)["segment"]).unlink(missing_ok=True)
+        changed = True
+    for rel in files:
+        if rel not in segments:
+            segments[rel] = _build_segment(base, rel, search_dir / _segment_name(rel))
+            changed = True
+    # Segmenti orfani (es. indice di versione precedente)
+    known = {s["segment"] for s in segments.values()}
+    for f in search_dir.glob("*.parquet"):
+        if f.name not in known:
+            f.unlink()
+
+    if changed:
+        _save_meta(search_dir, meta)
+    docs = sum(s["docs"] for s in segments.values())
+    if changed:
+        logger.info(f"Search index: {docs} documents in {len(segments)} segments")
+    return docs
+
+def search(data_dir, query: str, limit: int = 20) -> pl.DataFrame:
+    """
+    Cerca i termini della query nei testi degli AIUTI e restituisce i migliori
+    limit risultati per punteggio BM25 (colonna SCORE), uniti alle righe di AIUTI.
+    Dai segmenti vengono letti solo i row group con i termini cercati; dai file
+    di AIUTI solo i row group dei risultati.
+    """
+    base = Path(data_dir)
+    search_dir = base / SEARCH_DIR
+    meta = _load_meta(search_dir)
+    segments = meta["segments"]
+    terms = sorted(set(tokenize(query)))
+    if not terms or not segments:
+        return pl.DataFrame()
+
+    n_docs = max(sum(s["docs"] for s in segments.values()), 1)
+    avgdl = max(sum(s["tokens"] for s in segments.values()) / n_docs, 1.0)
+    files = {s["segment"]: rel for rel, s in segments.items()}
+
+    hits = (pl.scan_parquet([str(search_dir / s) for s in files], include_file_paths="SEGMENT")
+            .filter(pl.col("TERM").is_in(terms))
+            .collect())
+    if hits.is_empty():
+        return pl.DataFrame()
+
+    df = pl.col("DF")
+    idf = (1 + (n_docs - df + 0.5) / (df + 0.5)).log()
+    tf = pl.col("TF")
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * pl.col("DOC_LEN") / avgdl)
+    top = (hits
+           .with_columns(pl.len().over("TERM").alias("DF"))
+           .with_columns((idf * tf * (BM25_K1 + 1) / (tf + norm)).alias("SCORE"))
+           .group_by("SEGMENT", "ROW_GROUP", "AIUTO_SK")
+           .agg(pl.col("SCORE").sum())
+           .sort("SCORE", "AIUTO_SK", descending=[True, False])
+           .unique("AIUTO_SK", keep="first", maintain_order=True)
+           .head(limit))
+
+    # Ritorno ad AIUTI: solo i row group dei risultati
+    parts = []
+    for segment, group in top.group_by("SEGMENT"):
+        rel = files[Path(segment[0]).name]
+        row_groups = sorted(set(group["ROW_GROUP"].to_list()))
+        data = pq.ParquetFile(base / rel).read_row_groups(row_groups)
+        data = data.filter(pc.is_in(data["AIUTO_SK"], value_set=pa.array(group["AIUTO_SK"].to_list(), pa.int64())))
+        year = int(Path(rel).parent.name.split("=", 1)[1])
+        parts.append(pl.from_arrow(data).with_columns(pl.lit(year, dtype=pl.Int32).alias(PARTITION_COL)))
+
+    aiuti = pl.concat(parts, how="diagonal_relaxed").unique("AIUTO_SK", keep="first")
+    result = aiuti.join(top.select("AIUTO_SK", "SCORE"), on="AIUTO_SK").sort("SCORE", descending=True)
+    result = attach_descriptions(result.lazy(), base).collect()
+    return result.select(["SCORE"] + [c for c in result.columns if c != "SCORE"])
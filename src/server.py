@@ -0,0 +1,449 @@
+import json
+import queue
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlsplit
+import duckdb
+import polars as pl
+import pyarrow as pa
+import pyarrow.csv as pacsv
+from .catalog import QuerySession, TABLES, arrow_reader, build_query
+from .cache import ResultCache, reads_only_catalog
+from .results import BATCH_ROWS
+from .index import lookup as lookup_beneficiary
+from .search import search as search_aiuti
+from .snapshots import Snapshot, current_version
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONNECTIONS = 4
+# Blocchi serializzati in attesa di essere inviati: limita la memoria per risposta
+STREAM_QUEUE_SIZE = 8
+# Attesa massima di un posto nella coda prima di ricontrollare se il client si è disconnesso
+PUT_TIMEOUT = 1.0
+MAX_REQUEST_BODY = 1024 * 1024
+
+CONTENT_TYPES = {
+    "arrow": "application/vnd.apache.arrow.stream",
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+}
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+class _Cancelled(Exception):
+    """Il client non legge più la risposta: il job del pool si interrompe"""
+
+class _Chunks:
+    """Sink file-like per i writer Arrow: raccoglie i byte scritti fino al prossimo drain()"""
+    def __init__(self):
+        self.parts = []
+        self.closed = False
+
+    def write(self, data) -> int:
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+def serialize(batches: Iterator[pa.RecordBatch], schema: pa.Schema, fmt: str) -> Iterator[bytes]:
+    """Serializza i record batch un blocco alla volta in Arrow IPC stream, NDJSON o CSV"""
+    if fmt == "ndjson":
+        for batch in batches:
+            yield pl.from_arrow(batch).write_ndjson().encode()
+        return
+    sink = _Chunks()
+    writer = pa.ipc.new_stream(sink, schema) if fmt == "arrow" else pacsv.CSVWriter(sink, schema)
+    for batch in batches:
+        writer.write_batch(batch)
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+def _batches(df: pl.DataFrame) -> Tuple[pa.Schema, Iterator[pa.RecordBatch]]:
+    table = df.to_arrow()
+    return table.schema, iter(table.to_batches(BATCH_ROWS))
+
+def _check_sql(sql: str):
+    """Dai client solo SELECT sulle viste del catalogo: niente COPY, SET o letture di altri file"""
+    if not reads_only_catalog(sql):
+        raise HTTPError(400, "Only a single SELECT over the dataset tables is allowed")
+
+def _int(params: Dict[str, str], name: str, default: int) -> int:
+    try:
+        return int(params.get(name, default))
+    except ValueError:
+        raise HTTPError(400, f"{name} must be an integer")
+
+class _Version:
+    """Versione del dataset servita: lease, connessione DuckDB e pool di cursori"""
+    def __init__(self, root: Path, connections: int, threads: int = None, memory_limit: str = None):
+        self.snapshot = Snapshot(root)
+        self.name = self.snapshot.version
+        self.data_dir = self.snapshot.path
+        self.session = QuerySession(self.data_dir, threads, memory_limit)
+        # Il servizio esegue SQL dei client: solo i file del dataset, in sola lettura
+        self.session.restrict()
+        # Cache dei risultati della versione, creata una volta: un hit non rilegge i file del dataset
+        self.cache = ResultCache(self.data_dir, version=self.name)
+        self.cursors: "queue.Queue[QuerySession]" = queue.Queue()
+        for _ in range(connections):
+            self.cursors.put(self.session.cursor())
+        # Richieste in corso e stato: una versione sostituita si chiude quando l'ultima termina
+        self.users = 0
+        self.retired = False
+
+    def close(self):
+        self.session.close()
+        self.snapshot.close()
+
+class QueryService:
+    """
+    Servizio HTTP asyncio sul dataset Parquet. Le query girano in un pool di
+    thread, ognuno con un cursore della stessa connessione DuckDB (catalogo e
+    cache dei metadati restano caldi tra le richieste); i risultati vengono
+    inviati a blocchi con Transfer-Encoding chunked, man mano che arrivano.
+
+    Ogni richiesta legge per intero una sola versione pubblicata del dataset:
+    quando un parse ne pubblica una nuova, le richieste successive passano
+    alla nuova connessione e la precedente viene chiusa (rilasciando il lease)
+    al termine dell'ultima richiesta che la usa.
+
+    Endpoint (parametri in query string o corpo JSON):
+      GET /query   table, q, limit, format=ndjson|arrow, cache=true|false
+      GET /lookup  cf | cup, table=aiuti|componenti|strumenti, format
+      GET /search  q, limit, format
+      GET /export  table, years, columns, where, format=csv|ndjson|arrow
+      GET /health  stato e versione del dataset servita
+    """
+    def __init__(self, data_dir, connections: int = DEFAULT_CONNECTIONS,
+                 threads: int = None, memory_limit: str = None):
+        self.root = Path(data_dir)
+        self.connections = connections
+        self.threads = threads
+        self.memory_limit = memory_limit
+        self._lock = threading.Lock()
+        self.version = _Version(self.root, connections, threads, memory_limit)
+        self.executor = ThreadPoolExecutor(max_workers=connections, thread_name_prefix="query")
+        self.routes: Dict[str, Callable] = {
+            "/query": self._query,
+            "/lookup": self._lookup,
+            "/search": self._search,
+            "/export": self._export,
+        }
+
+    # --- Versioni del dataset ---
+
+    def _acquire(self) -> _Version:
+        """Versione per una nuova richiesta: apre quella pubblicata se è cambiata"""
+        with self._lock:
+            if current_version(self.root) != self.version.name:
+                old = self.version
+                self.version = _Version(self.root, self.connections, self.threads, self.memory_limit)
+                logger.info(f"Serving dataset version {self.version.name}")
+                old.retired = True
+                if old.users == 0:
+                    old.close()
+            self.version.users += 1
+            return self.version
+
+    def _release(self, version: _Version):
+        with self._lock:
+            version.users -= 1
+            if version.retired and version.users == 0:
+                version.close()
+
+    # --- Endpoint: eseguiti nei thread del pool, restituiscono (schema, batch) ---
+    # cleanup raccoglie le funzioni da chiamare a fine richiesta, anche se interrotta
+
+    def _run_sql(self, version: _Version, sql: str, cleanup: List[Callable]) -> Tuple[pa.Schema, Iterator[pa.RecordBatch]]:
+        """Esegue sql su un cursore preso dal pool della versione"""
+        cursors = version.cursors
+        cursor = cursors.get()
+        returned = False
+
+        def release():
+            # Il cursore torna nel pool una sola volta: a risultato letto o a fine richiesta
+            # (stesso job del pool: con un cursore per worker get() non attende mai)
+            nonlocal returned
+            if not returned:
+                returned = True
+                cursors.put(cursor)
+
+        cleanup.append(release)
+        try:
+            result = cursor.execute(sql)
+        except Exception:
+            release()
+            raise
+        if result.description is None:
+            release()
+            return pa.schema([]), iter(())
+        reader = arrow_reader(result, BATCH_ROWS)
+
+        def batches():
+            try:
+                yield from reader
+            finally:
+                release()
+        return reader.schema, batches()
+
+    def _query(self, version: _Version, params: Dict[str, str], cleanup: List[Callable]):
+        table = params.get("table", "aiuti")
+        if table not in TABLES:
+            raise HTTPError(400, f"Unknown table {table}")
+        sql = build_query(table, params.get("q"), _int(params, "limit", 10))
+        _check_sql(sql)
+        if params.get("cache", "true").lower() in ("0", "false", "no"):
+            return self._run_sql(version, sql, cleanup)
+        cache = version.cache
+        reader = cache.get(sql)
+        if reader is None:
+            schema, batches = self._run_sql(version, sql, cleanup)
+            reader = cache.store(sql, pa.RecordBatchReader.from_batches(schema, batches))
+        return reader.schema, reader
+
+    def _lookup(self, version: _Version, params: Dict[str, str], cleanup: List[Callable]):
+        if bool(params.get("cf")) == bool(params.get("cup")):
+            raise HTTPError(400, "Specify exactly one of cf or cup")
+        key_type, key = ("CF", params["cf"]) if params.get("cf") else ("CUP", params["cup"])
+        table = params.get("table", "aiuti")
+        results = lookup_beneficiary(version.data_dir, key_type, key)
+        return _batches(results.get(table, pl.DataFrame()))
+
+    def _search(self, version: _Version, params: Dict[str, str], cleanup: List[Callable]):
+        if not params.get("q"):
+            raise HTTPError(400, "Missing q")
+        return _batches(search_aiuti(version.data_dir, params["q"], _int(params, "limit", 20)))
+
+    def _export(self, version: _Version, params: Dict[str, str], cleanup: List[Callable]):
+        from .exporter import parse_years
+        table = params.get("table")
+        if table not in TABLES:
+            raise HTTPError(400, f"Unknown table {table}")
+        columns = [c.strip() for c in params.get("columns", "").split(",") if c.strip()]
+        select = ", ".join('"' + c.replace('"', '""') + '"' for c in columns) if columns else "*"
+        conditions = []
+        if params.get("years"):
+            try:
+                years = parse_years(params["years"])
+            except ValueError:
+                raise HTTPError(400, f"Invalid years {params['years']}")
+            # Filtro sulla colonna di partizione: DuckDB legge solo le cartelle ANNO= richieste
+            conditions.append(f"ANNO IN ({', '.join(str(y) for y in years)})")
+        if params.get("where"):
+            # Una sola espressione, riscritta dal parser: il testo non finisce mai nell'SQL così com'è
+            try:
+                conditions.append(f"({duckdb.SQLExpression(params['where'])})")
+            except duckdb.Error:
+                raise HTTPError(400, f"Invalid where expression {params['where']}")
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        sql = f"SELECT {select} FROM {table}{where}"
+        _check_sql(sql)
+        return self._run_sql(version, sql, cleanup)
+
+    # --- HTTP ---
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Optional[Tuple[str, str, Dict[str, str], bytes]]:
+        line = await reader.readline()
+        if not line:
+            return None
+        try:
+            method, target, _ = line.decode("latin-1").split(" ", 2)
+        except ValueError:
+            raise HTTPError(400, "Malformed request line")
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0) or 0)
+        if length > MAX_REQUEST_BODY:
+            raise HTTPError(413, "Request body too large")
+        body = await reader.readexactly(length) if length else b""
+        return method, target, headers, body
+
+    async def _send(self, writer: asyncio.StreamWriter, status: int, content_type: str, body: bytes):
+        writer.write(
+            f"HTTP/1.1 {status} {_reason(status)}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+
+    async def _respond(self, writer: asyncio.StreamWriter, handler: Callable, params: Dict[str, str], fmt: str):
+        """
+        Esegue handler e serializza il risultato in un unico job del pool (il
+        cursore e la versione del dataset restano gli stessi per tutta la richiesta); i blocchi
+        arrivano all'event loop tramite una coda limitata, che fa da backpressure.
+        Gli errori prima del primo blocco diventano una risposta 400.
+        Se il client si disconnette il job si interrompe al blocco successivo e
+        il cursore torna comunque nel pool.
+        """
+        loop = asyncio.get_running_loop()
+        pending: asyncio.Queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+        cancelled = threading.Event()
+        done = object()
+
+        def put(item):
+            # Dopo una disconnessione la coda viene svuotata: l'attesa finisce e il job si ferma
+            future = asyncio.run_coroutine_threadsafe(pending.put(item), loop)
+            while True:
+                try:
+                    future.result(timeout=PUT_TIMEOUT)
+                except TimeoutError:
+                    if cancelled.is_set():
+                        # Nessuno svuota più la coda (es. event loop fermo)
+                        future.cancel()
+                        raise _Cancelled()
+                    continue
+                if cancelled.is_set():
+                    raise _Cancelled()
+                return
+
+        def produce():
+            version = None
+            cleanup = []
+            chunks = None
+            try:
+                version = self._acquire()
+                schema, batches = handler(version, params, cleanup)
+                put(None)  # Risultato pronto: si possono inviare le intestazioni
+                chunks = serialize(batches, schema, fmt)
+                for chunk in chunks:
+                    if chunk:
+                        put(chunk)
+                put(done)
+            except _Cancelled:
+                pass
+            except Exception as e:
+                try:
+                    put(e)
+                    put(done)
+                except _Cancelled:
+                    pass
+            finally:
+                if chunks is not None:
+                    chunks.close()
+                for release in cleanup:
+                    release()
+                if version is not None:
+                    self._release(version)
+
+        # Esecuzione fuori dall'event loop: il server resta reattivo durante le query
+        producer = loop.run_in_executor(self.executor, produce)
+        try:
+            first = await pending.get()
+            if isinstance(first, Exception):
+                await pending.get()
+                await producer
+                raise first
+            writer.write(
+                f"HTTP/1.1 200 OK\r\nContent-Type: {CONTENT_TYPES[fmt]}\r\nTransfer-Encoding: chunked\r\n\r\n".encode()
+            )
+            while (chunk := await pending.get()) is not done:
+                if isinstance(chunk, Exception):
+                    # Intestazioni già inviate: si interrompe la risposta senza il chunk finale
+                    logger.error(f"Streaming failed: {chunk}")
+                    await pending.get()
+                    await producer
+                    raise ConnectionAbortedError(str(chunk))
+                writer.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+                await writer.drain()
+            await producer
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        finally:
+            if not producer.done():
+                # Client disconnesso (o richiesta annullata): il job non deve restare
+                # bloccato sulla coda piena tenendo occupati thread e cursore
+                cancelled.set()
+                while not pending.empty():
+                    pending.get_nowait()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                    if request is None:
+                        break
+                    method, target, headers, body = request
+                    url = urlsplit(target)
+                    params = dict(parse_qsl(url.query))
+                    if body:
+                        data = json.loads(body)
+                        if not isinstance(data, dict):
+                            raise HTTPError(400, "Request body must be a JSON object")
+                        # Valori non stringa (limit: 5, cache: false) come nella query string
+                        params.update({k: v if isinstance(v, str) else json.dumps(v) for k, v in data.items()})
+                    if url.path == "/health":
+                        health = {"status": "ok", "version": current_version(self.root)}
+                        await self._send(writer, 200, "application/json", json.dumps(health).encode())
+                        continue
+                    handler = self.routes.get(url.path)
+                    if handler is None:
+                        raise HTTPError(404, f"Unknown endpoint {url.path}")
+                    fmt = params.get("format", "csv" if url.path == "/export" else "ndjson")
+                    if fmt not in CONTENT_TYPES:
+                        raise HTTPError(400, f"Unsupported format {fmt}")
+                    await self._respond(writer, handler, params, fmt)
+                except HTTPError as e:
+                    await self._send(writer, e.status, "application/json", json.dumps({"error": str(e)}).encode())
+                    continue
+                except (duckdb.Error, pl.exceptions.PolarsError, ValueError, KeyError, FileNotFoundError) as e:
+                    await self._send(writer, 400, "application/json", json.dumps({"error": str(e)}).encode())
+                    continue
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            logger.error(f"Request failed: {e}")
+        finally:
+            writer.close()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8080) -> asyncio.AbstractServer:
+        return await asyncio.start_server(self.handle, host, port)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.version.close()
+
+def _reason(status: int) -> str:
+    return {200: "OK", 400: "Bad Request", 404: "Not Found", 413: "Payload Too Large"}.get(status, "Error")
+
+def serve(data_dir, host: str = "127.0.0.1", port: int = 8080, connections: int = DEFAULT_CONNECTIONS,
+          threads: int = None, memory_limit: str = None):
+    """Avvia il servizio e resta in ascolto fino all'interruzione"""
+    service = QueryService(data_dir, connections, threads, memory_limit)
+
+    async def main():
+        server = await service.start(host, port)
+        logger.info(f"Serving {data_dir} on http://{host}:{port} ({connections} connections)")
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
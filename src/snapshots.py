@@ -0,0 +1,278 @@
+import os
+import fcntl
+import shutil
+import logging
+from pathlib import Path
+from typing import Iterable, List, Optional
+from .catalog import CATALOG_NAME
+from .cache import CACHE_DIR
+from .checkpoint import CHECKPOINT_DIR
+
+logger = logging.getLogger(__name__)
+
+# Layout della cartella del dataset (es. public/parquet):
+#   CURRENT          nome della versione pubblicata
+#   versions/vNNNNNN una versione completa (tabelle, dimensioni, catalogo, indici, manifest)
+#   _resume/         file tenuti fuori dalla versione pubblicata per un parse --resume
+SNAPSHOTS_DIR = "versions"
+CURRENT_NAME = "CURRENT"
+RESUME_DIR = "_resume"
+# Lock condiviso tenuto dai lettori di una versione, esclusivo per rimuoverla
+LOCK_NAME = ".lock"
+# Lock esclusivo di chi prepara una nuova versione (parse, compact)
+WRITER_LOCK = ".writer.lock"
+# Non collegati nella nuova versione: il catalogo DuckDB viene riscritto sul posto,
+# cache e checkpoint valgono solo per la versione in cui sono stati creati
+NOT_LINKED = {CATALOG_NAME, CATALOG_NAME + ".wal", CACHE_DIR, CHECKPOINT_DIR, LOCK_NAME}
+# Tentativi di lease quando la versione corrente cambia mentre la si apre
+LEASE_ATTEMPTS = 10
+
+def current_version(root) -> Optional[str]:
+    """Nome della versione pubblicata, None se il dataset non è versionato"""
+    try:
+        return (Path(root) / CURRENT_NAME).read_text().strip() or None
+    except FileNotFoundError:
+        return None
+
+def version_path(root, name: str) -> Path:
+    return Path(root) / SNAPSHOTS_DIR / name
+
+def resolve_data_dir(root) -> Path:
+    """Cartella della versione pubblicata; root stesso per i dataset non versionati"""
+    name = current_version(root)
+    return version_path(root, name) if name else Path(root)
+
+def _versions(root) -> List[str]:
+    directory = Path(root) / SNAPSHOTS_DIR
+    if not directory.exists():
+        return []
+    return sorted(p.name for p in directory.iterdir() if p.is_dir() and p.name.startswith("v"))
+
+def _number(name: Optional[str]) -> int:
+    return int(name[1:]) if name else 0
+
+class Snapshot:
+    """
+    Lease di lettura su una versione del dataset (la corrente se version è
+    None): finché è aperto la versione non viene rimossa, anche se nel
+    frattempo ne viene pubblicata una nuova. path è la cartella da leggere.
+    Per un dataset non versionato path è root e non c'è alcun lock.
+    """
+    def __init__(self, root, version: str = None):
+        self.root = Path(root)
+        self.version = None
+        self.path = self.root
+        self._lock = None
+        for _ in range(LEASE_ATTEMPTS):
+            name = version or current_version(self.root)
+            if name is None:
+                return
+            if self._acquire(name):
+                self.version = name
+                self.path = version_path(self.root, name)
+                return
+            if version:
+                break
+        raise RuntimeError(f"Could not open a version of {self.root}")
+
+    def _acquire(self, name: str) -> bool:
+        lock = version_path(self.root, name) / LOCK_NAME
+        try:
+            f = open(lock, "rb")
+        except FileNotFoundError:
+            return False
+        fcntl.flock(f, fcntl.LOCK_SH)
+        # La versione può essere stata rimossa tra open() e flock(): il lock va ricontrollato
+        try:
+            same = os.stat(lock).st_ino == os.fstat(f.fileno()).st_ino
+        except FileNotFoundError:
+            same = False
+        if not same:
+            f.close()
+            return False
+        self._lock = f
+        return True
+
+    def close(self):
+        if self._lock is not None:
+            self._lock.close()
+            self._lock = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+def _link_tree(src: Path, dst: Path, skip: Iterable[str] = ()):
+    """
+    Copia src in dst con hard link: nessun byte duplicato. È sicuro perché i
+    file del dataset non vengono mai modificati sul posto, solo creati con un
+    nuovo nome o sostituiti con os.replace (nuovo inode).
+    """
+    skip = set(skip)
+    for entry in src.iterdir():
+        if entry.name in skip:
+            continue
+        target = dst / entry.name
+        if entry.is_dir():
+            target.mkdir(exist_ok=True)
+            _link_tree(entry, target)
+        else:
+            try:
+                os.link(entry, target)
+            except OSError:
+                shutil.copy2(entry, target)
+
+def _move_tree(src: Path, dst: Path):
+    """Sposta il contenuto di src in dst unendo le cartelle (rename sullo stesso filesystem)"""
+    for entry in src.iterdir():
+        target = dst / entry.name
+        if entry.is_dir() and target.is_dir():
+            _move_tree(entry, target)
+            entry.rmdir()
+        else:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(entry, target)
+
+def collect_garbage(root) -> List[str]:
+    """
+    Rimuove le versioni non più in uso: tutte tranne la corrente, quelle con un
+    lease aperto e quelle più recenti in preparazione (lock del writer tenuto).
+    Restituisce le versioni rimosse.
+    """
+    root = Path(root)
+    current = current_version(root)
+    removed = []
+    for name in _versions(root):
+        if name == current:
+            continue
+        path = version_path(root, name)
+        try:
+            f = open(path / LOCK_NAME, "rb")
+        except FileNotFoundError:
+            f = None
+        try:
+            if f is not None:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+            # Rename prima della rimozione: chi apre il lock da ora non trova più la versione
+            trash = path.with_name(f".trash-{name}")
+            os.replace(path, trash)
+            shutil.rmtree(trash, ignore_errors=True)
+            removed.append(name)
+        finally:
+            if f is not None:
+                f.close()
+    for trash in (root / SNAPSHOTS_DIR).glob(".trash-*") if (root / SNAPSHOTS_DIR).exists() else ():
+        shutil.rmtree(trash, ignore_errors=True)
+    if removed:
+        logger.info(f"Removed unused dataset versions: {', '.join(removed)}")
+    return removed
+
+class StagedVersion:
+    """
+    Nuova versione del dataset, preparata accanto a quella pubblicata e resa
+    visibile ai lettori con publish() in un solo passo (os.replace di CURRENT).
+
+    La versione parte dagli hard link di quella corrente (vuota con fresh),
+    così un parse incrementale o una compattazione la modificano senza toccare
+    i file letti dalle query in corso. Con resume si riprende la versione non
+    pubblicata lasciata da un parse interrotto, oppure si recuperano i file
+    tenuti da parte (hold) dall'ultima pubblicazione; con discard_held quei
+    file vengono invece scartati (compact li lascia al prossimo parse).
+    Un solo writer alla volta.
+    """
+    def __init__(self, root, fresh: bool = False, resume: bool = False, discard_held: bool = True):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._writer = open(self.root / WRITER_LOCK, "a")
+        try:
+            fcntl.flock(self._writer, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._writer.close()
+            raise RuntimeError(f"Another process is writing a new version of {self.root}")
+
+        base = current_version(self.root)
+        unpublished = [v for v in _versions(self.root) if _number(v) > _number(base)]
+        resume_dir = self.root / RESUME_DIR
+        # Versione da pubblicare anche senza modifiche: vuota, con il lavoro di un parse
+        # interrotto, oppure prima versione di un dataset non versionato
+        self.must_publish = fresh or base is None
+        if resume and unpublished and not fresh:
+            self.name = unpublished[-1]
+            self.must_publish = True
+            logger.info(f"Resuming unpublished version {self.name}")
+        else:
+            self.name = self._create(base, fresh)
+            if resume and resume_dir.exists() and not fresh:
+                _move_tree(resume_dir, version_path(self.root, self.name))
+                self.must_publish = True
+        if resume or discard_held or fresh:
+            shutil.rmtree(resume_dir, ignore_errors=True)
+        self.path = version_path(self.root, self.name)
+        self.lease = Snapshot(self.root, self.name)
+        self.published = False
+
+    def _create(self, base: Optional[str], fresh: bool) -> str:
+        number = max([_number(v) for v in _versions(self.root)] + [_number(base)]) + 1
+        name = f"v{number:06d}"
+        path = version_path(self.root, name)
+        path.mkdir(parents=True)
+        (path / LOCK_NAME).touch()
+        if fresh:
+            return name
+        if base is not None:
+            _link_tree(version_path(self.root, base), path, NOT_LINKED)
+        else:
+            # Dataset non versionato (layout precedente): i file in root diventano la prima versione
+            _link_tree(self.root, path, NOT_LINKED | {SNAPSHOTS_DIR, CURRENT_NAME, WRITER_LOCK, RESUME_DIR})
+        return name
+
+    def publish(self, hold: Iterable[str] = ()):
+        """
+        Pubblica la versione. hold sono file (relativi alla versione) da tenere
+        fuori dalla versione pubblicata e da restituire al prossimo parse --resume.
+        """
+        for rel in hold:
+            src = self.path / rel
+            if src.exists():
+                dst = self.root / RESUME_DIR / rel
+                dst.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(src, dst)
+        tmp = self.root / f"{CURRENT_NAME}.tmp"
+        tmp.write_text(self.name + "\n")
+        os.replace(tmp, self.root / CURRENT_NAME)
+        self.published = True
+        logger.info(f"Published dataset version {self.name}")
+        _remove_legacy_layout(self.root)
+        collect_garbage(self.root)
+
+    def discard(self):
+        """Scarta la versione senza pubblicarla (niente da cambiare rispetto alla corrente)"""
+        trash = self.path.with_name(f".trash-{self.name}")
+        os.replace(self.path, trash)
+        shutil.rmtree(trash, ignore_errors=True)
+        logger.info(f"Discarded dataset version {self.name}, nothing changed")
+
+    def close(self):
+        self.lease.close()
+        self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+def _remove_legacy_layout(root: Path):
+    """Dopo la prima pubblicazione i file del layout non versionato in root non servono più"""
+    for entry in root.iterdir():
+        if entry.name in (SNAPSHOTS_DIR, CURRENT_NAME, WRITER_LOCK, RESUME_DIR) or entry.name.endswith(".tmp"):
+            continue
+        if entry.is_dir():
+            shutil.rmtree(entry, ignore_errors=True)
+        else:
+            entry.unlink(missing_ok=True)
@@ -0,0 +1,312 @@
+import os
+import re
+import gzip
+import zipfile
+import logging
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:  # dipendenza opzionale, necessaria solo per gli archivi .zst
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# Estensioni accettate in input: XML in chiaro o archivi compressi
+ARCHIVE_SUFFIXES = ('.zip', '.gz', '.zst')
+XML_SUFFIX = '.xml'
+# Espansione massima di deflate su dati incomprimibili: intestazione gzip (con nome file)
+# e trailer, più circa lo 0,1% dei dati (blocchi non compressi)
+GZIP_OVERHEAD = 1024
+GZIP_EXPANSION = 0.001
+# Input riconosciuti nelle cartelle: XML, archivi zip e singoli XML compressi (non ogni .gz/.zst)
+INPUT_SUFFIXES = (XML_SUFFIX, '.zip', '.xml.gz', '.xml.zst')
+
+# Pattern per individuare i confini degli elementi AIUTO direttamente sui byte del file
+AIUTO_START = re.compile(rb'<(?:[\w.-]+:)?AIUTO[\s>]')
+AIUTO_END = re.compile(rb'</(?:[\w.-]+:)?AIUTO\s*>')
+SCAN_BLOCK_SIZE = 1 << 20
+
+def _find_aiuto_start(f, offset: int) -> int:
+    """Restituisce l'offset del primo tag <AIUTO> a partire da offset, oppure -1"""
+    f.seek(offset)
+    carry = b''
+    base = offset
+    while True:
+        block = f.read(SCAN_BLOCK_SIZE)
+        if not block:
+            return -1
+        data = carry + block
+        match = AIUTO_START.search(data)
+        if match:
+            return base + match.start()
+        # Manteniamo una coda per i tag spezzati tra due blocchi
+        keep = min(len(data), 64)
+        carry = data[-keep:]
+        base += len(data) - keep
+
+def find_aiuto_end(file_path: str, offset: int, count: int) -> int:
+    """
+    Offset subito dopo il count-esimo </AIUTO> a partire da offset (offset stesso
+    se count è 0). Usato dai checkpoint per trovare dove riprendere la lettura.
+    """
+    if count <= 0:
+        return offset
+    with open(file_path, 'rb') as f:
+        f.seek(offset)
+        data = b''
+        base = offset
+        while True:
+            block = f.read(SCAN_BLOCK_SIZE)
+            data += block
+            # Una coda di 64 byte resta per il blocco successivo: un tag spezzato non va perso
+            limit = len(data) if not block else max(0, len(data) - 64)
+            last_end = 0
+            for match in AIUTO_END.finditer(data, 0, limit):
+                count -= 1
+                if count == 0:
+                    return base + match.end()
+                last_end = match.end()
+            if not block:
+                raise ValueError(f"{file_path}: not enough </AIUTO> after offset {offset}")
+            cut = max(last_end, limit - 64, 0)
+            data = data[cut:]
+            base += cut
+
+def _read_prolog_epilog(f, size: int) -> Tuple[bytes, bytes]:
+    """
+    Legge il prologo (dichiarazione XML e tag radice, fino al primo <AIUTO>)
+    e l'epilogo (chiusura della radice, dopo l'ultimo </AIUTO>) del file.
+    """
+    first = _find_aiuto_start(f, 0)
+    f.seek(0)
+    prolog = f.read(first) if first > 0 else b''
+
+    epilog = b''
+    pos = size
+    tail = b''
+    while pos > 0:
+        step = min(SCAN_BLOCK_SIZE, pos)
+        pos -= step
+        f.seek(pos)
+        tail = f.read(step) + tail
+        matches = list(AIUTO_END.finditer(tail))
+        if matches:
+            epilog = tail[matches[-1].end():]
+            break
+    return prolog, epilog
+
+def split_file(file_path: str, chunk_size: int, max_chunks: int = None) -> List[Tuple[int, int]]:
+    """
+    Divide un file XML in intervalli di byte [start, end) allineati sull'inizio
+    degli elementi <AIUTO>, in modo che ogni intervallo possa essere processato
+    da un worker diverso. Con max_chunks gli intervalli sono al più max_chunks
+    (più grandi di chunk_size): ogni intervallo scrive i propri file Parquet.
+    """
+    size = os.path.getsize(file_path)
+    if chunk_size <= 0 or size <= chunk_size:
+        return [(0, size)]
+
+    num_chunks = -(-size // chunk_size)
+    if max_chunks:
+        num_chunks = max(1, min(num_chunks, max_chunks))
+    boundaries = [0]
+    with open(file_path, 'rb') as f:
+        first = _find_aiuto_start(f, 0)
+        if first < 0:
+            return [(0, size)]
+        for i in range(1, num_chunks):
+            boundary = _find_aiuto_start(f, max(first + 1, i * size // num_chunks))
+            if boundary < 0:
+                break
+            if boundary > boundaries[-1]:
+                boundaries.append(boundary)
+
+    return list(zip(boundaries, boundaries[1:] + [size]))
+
+class FileRangeReader:
+    """
+    Lettore file-like su un intervallo di byte [start, end) di un file XML.
+    Il prologo e l'epilogo del documento vengono aggiunti attorno all'intervallo
+    in modo che il frammento sia un documento XML valido.
+    """
+    def __init__(self, filename, start: int, end: int, prefix: bytes = b'', suffix: bytes = b''):
+        self.f = open(filename, 'rb')
+        self.f.seek(start)
+        self.remaining = end - start
+        self.pending = [prefix] if prefix else []
+        self.suffix = suffix
+
+    def read(self, size=-1):
+        if self.pending:
+            data = self.pending.pop(0)
+            if 0 <= size < len(data):
+                self.pending.insert(0, data[size:])
+                data = data[:size]
+            return data
+        if self.remaining > 0:
+            want = self.remaining if size < 0 else min(size, self.remaining)
+            data = self.f.read(want)
+            if data:
+                self.remaining -= len(data)
+                return data
+            self.remaining = 0
+        if self.suffix:
+            self.pending.append(self.suffix)
+            self.suffix = b''
+            return self.read(size)
+        return b''
+
+    def close(self):
+        self.f.close()
+
+def _open_range(path: Path, start: int = None, end: int = None):
+    """Apre il file intero oppure solo l'intervallo [start, end) con prologo/epilogo"""
+    if start is None and end is None:
+        return str(path)
+
+    size = path.stat().st_size
+    start = start or 0
+    end = size if end is None else end
+    if start == 0 and end >= size:
+        return str(path)
+
+    with open(path, 'rb') as f:
+        prolog, epilog = _read_prolog_epilog(f, size)
+    return FileRangeReader(
+        str(path), start, end,
+        prefix=prolog if start > 0 else b'',
+        suffix=epilog if end < size else b''
+    )
+
+class ZipMemberReader:
+    """Stream decompresso di un membro di un archivio zip, chiude anche l'archivio"""
+    def __init__(self, path: str, member: str):
+        self.archive = zipfile.ZipFile(path)
+        self.f = self.archive.open(member)
+
+    def read(self, size=-1):
+        return self.f.read(size)
+
+    def close(self):
+        self.f.close()
+        self.archive.close()
+
+class ZstdReader:
+    """Stream decompresso di un file .zst"""
+    def __init__(self, path: str):
+        if zstandard is None:
+            raise RuntimeError(f"Reading {path} requires the optional 'zstandard' package")
+        self.raw = open(path, 'rb')
+        self.f = zstandard.ZstdDecompressor().stream_reader(self.raw)
+
+    def read(self, size=-1):
+        return self.f.read(size)
+
+    def close(self):
+        self.f.close()
+        self.raw.close()
+
+@dataclass(frozen=True)
+class WorkUnit:
+    """
+    Unità di lavoro assegnata a un worker: un file XML intero, un suo intervallo
+    di byte allineato sugli elementi <AIUTO>, oppure un membro di un archivio.
+    size è la quantità di XML (non compresso, stimata per gli archivi) che l'unità
+    produce: serve a ordinare il lavoro e a misurare l'avanzamento in byte.
+    """
+    path: str
+    member: Optional[str] = None
+    start: Optional[int] = None
+    end: Optional[int] = None
+    size: int = 0
+
+    @property
+    def label(self) -> str:
+        return f"{self.path}!{self.member}" if self.member else self.path
+
+def _uncompressed_size(path: str) -> int:
+    """Stima della dimensione decompressa di un file .gz o .zst"""
+    compressed = os.path.getsize(path)
+    if path.lower().endswith('.gz'):
+        # ISIZE (ultimi 4 byte) è la dimensione modulo 2^32
+        with open(path, 'rb') as f:
+            f.seek(-4, os.SEEK_END)
+            size = int.from_bytes(f.read(4), 'little')
+        # ISIZE sotto la dimensione compressa oltre l'espansione massima: il file supera 4 GiB
+        smallest = compressed - GZIP_OVERHEAD - int(compressed * GZIP_EXPANSION)
+        while size < smallest:
+            size += 2 ** 32
+        return size
+    if zstandard is not None:
+        with open(path, 'rb') as f:
+            try:
+                size = zstandard.frame_content_size(f.read(18))
+            except zstandard.ZstdError:
+                size = -1
+        if size > 0:
+            return size
+    return compressed
+
+def is_archive(path) -> bool:
+    return Path(path).suffix.lower() in ARCHIVE_SUFFIXES
+
+def is_supported(path) -> bool:
+    return Path(path).name.lower().endswith(INPUT_SUFFIXES)
+
+def source_name(path, member: str = None) -> str:
+    """Nome del file XML originale, usato per FILE_SOURCE"""
+    if member:
+        return Path(member).name
+    p = Path(path)
+    return p.stem if is_archive(p) else p.name
+
+def discover_inputs(input_path: Path) -> List[str]:
+    """Elenca i file XML e gli archivi compressi sotto input_path"""
+    if input_path.is_file():
+        return [str(input_path)]
+    return sorted(str(p) for p in input_path.rglob("*") if p.is_file() and is_supported(p))
+
+def build_work_units(files: List[str], chunk_size: int, max_ranges: int = None) -> List[WorkUnit]:
+    """
+    Trasforma i file di input in unità di lavoro: ogni membro XML di uno zip è
+    un'unità, i file .gz/.zst sono un'unità ciascuno (non sono indicizzabili per
+    byte), i file XML in chiaro vengono divisi in intervalli con split_file.
+    max_ranges limita gli intervalli per file (di norma uno per worker): ogni
+    unità ha un proprio writer, quindi meno intervalli contigui più grandi
+    producono meno file per partizione.
+    """
+    units = []
+    for f in files:
+        suffix = Path(f).suffix.lower()
+        if suffix == '.zip':
+            with zipfile.ZipFile(f) as archive:
+                for info in archive.infolist():
+                    if not info.is_dir() and info.filename.lower().endswith(XML_SUFFIX):
+                        units.append(WorkUnit(f, member=info.filename, size=info.file_size))
+        elif suffix in ARCHIVE_SUFFIXES:
+            units.append(WorkUnit(f, size=_uncompressed_size(f)))
+        else:
+            for start, end in split_file(f, chunk_size, max_ranges):
+                units.append(WorkUnit(f, start=start, end=end, size=end - start))
+    return units
+
+def open_source(path, member: str = None, start: int = None, end: int = None):
+    """
+    Restituisce la sorgente XML da passare a CleanFileInputStream: un percorso
+    oppure uno stream binario (intervallo di byte o archivio decompresso al volo,
+    senza file temporanei).
+    """
+    path = Path(path)
+    suffix = path.suffix.lower()
+    if suffix == '.zip':
+        if member is None:
+            raise ValueError(f"{path} is a zip archive: a member name is required")
+        return ZipMemberReader(str(path), member)
+    if suffix == '.gz':
+        return gzip.open(path, 'rb')
+    if suffix == '.zst':
+        return ZstdReader(str(path))
+    return _open_range(path, start, end)
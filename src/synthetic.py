@@ -0,0 +1,137 @@
+import random
+import logging
+from pathlib import Path
+from typing import Tuple
+from xml.sax.saxutils import escape
+from .parser import NS
+
+logger = logging.getLogger(__name__)
+
+XMLNS = NS.strip("{}")
+
+# Vocabolario per titoli e descrizioni: parole italiane, anche accentate, come nei dati reali
+WORDS = ("progetto impresa sviluppo innovazione digitale energia efficientamento impianto fotovoltaico "
+         "ricerca formazione personale investimento macchinari attività città sostenibilità qualità "
+         "produzione export internazionalizzazione turismo agricoltura filiera servizi software rete "
+         "competitività occupazione giovani donne territorio montano ambientale acquisto sede").split()
+REGIONI = ("Lazio", "Lombardia", "Campania", "Sicilia", "Piemonte", "Veneto", "Puglia", "Toscana",
+           "Emilia-Romagna", "Calabria", "Sardegna", "Liguria", "Marche", "Abruzzo", "Umbria")
+TIPI_MISURA = ("Regime di aiuti", "Aiuto ad hoc", "Aiuto individuale")
+TIPI_BENEFICIARIO = ("PMI", "Grande impresa", "Persona fisica")
+PROCEDIMENTI = {"1": "Automatico", "2": "Valutativo a sportello", "3": "Valutativo a graduatoria", "4": "Negoziale"}
+REGOLAMENTI = {f"SA.{40000 + i}": f"Regolamento di esenzione {i}" for i in range(20)}
+OBIETTIVI = {str(i): f"Obiettivo {i}" for i in range(1, 16)}
+STRUMENTI = {"1.1": "Sovvenzione/Contributo in conto interessi", "1.2": "Prestito / Anticipo rimborsabile",
+             "1.3": "Garanzia", "1.4": "Agevolazione fiscale o esenzione fiscale", "1.5": "Altro"}
+SETTORI = ("01.11", "10.71", "25.62", "41.20", "47.11", "55.10", "62.01", "70.22", "72.19", "86.90")
+
+# Chiavi degli aiuti: ogni coppia (seed, file_index) ha un proprio intervallo di COR e di CAR,
+# così più file sintetici non ripetono gli stessi aiuti
+KEYS_PER_FILE = 10 ** 7
+FILES_PER_SEED = 1000
+MISURE_PER_FILE = 5000
+
+# Byte di controllo non validi in XML 1.0, inseriti grezzi o come entità numeriche
+INVALID_CHARS = ("\x01", "\x0b", "\x1f", "&#1;", "&#x1F;")
+
+def _text(rng: random.Random, length: int) -> str:
+    """Testo di circa length caratteri"""
+    words = []
+    size = 0
+    while size < length:
+        word = rng.choice(WORDS)
+        words.append(word)
+        size += len(word) + 1
+    return " ".join(words).capitalize()
+
+def _field(tag: str, value, rng: random.Random, invalid_rate: float) -> str:
+    text = escape(str(value))
+    if invalid_rate and rng.random() < invalid_rate:
+        pos = rng.randint(0, len(text))
+        text = text[:pos] + rng.choice(INVALID_CHARS) + text[pos:]
+    return f"<{tag}>{text}</{tag}>"
+
+def _aiuto(rng: random.Random, i: int, file_key: int, components: Tuple[int, int],
+           instruments: Tuple[int, int], years: Tuple[int, int], text_length: int, invalid_rate: float) -> str:
+    def f(tag, value):
+        return _field(tag, value, rng, invalid_rate)
+
+    year = rng.randint(*years)
+    cor = 100000 + file_key * KEYS_PER_FILE + i
+    parts = [
+        "<AIUTO>",
+        f("CAR", 10000 + file_key * MISURE_PER_FILE + i % MISURE_PER_FILE),
+        f("TITOLO_MISURA", _text(rng, 40)),
+        f("DES_TIPO_MISURA", rng.choice(TIPI_MISURA)),
+        f("BASE_GIURIDICA_NAZIONALE", f"Legge {rng.randint(1, 999)}/{rng.randint(1990, year)}"),
+        f("CODICE_FISCALE_BENEFICIARIO", f"{rng.randrange(10 ** 11):011d}"),
+        f("DENOMINAZIONE_BENEFICIARIO", f"{_text(rng, 15).upper()} SRL"),
+        f("TITOLO_PROGETTO", _text(rng, text_length // 4)),
+        f("DESCRIZIONE_PROGETTO", _text(rng, text_length)),
+        f("CUP", f"J{rng.randrange(10 ** 14):014d}"),
+        f("REGIONE_BENEFICIARIO", rng.choice(REGIONI)),
+        f("DES_TIPO_BENEFICIARIO", rng.choice(TIPI_BENEFICIARIO)),
+        f("COR", cor),
+        f("DATA_CONCESSIONE", f"{year}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"),
+        "<COMPONENTI_AIUTO>",
+    ]
+    for c in range(rng.randint(*components)):
+        procedimento = rng.choice(list(PROCEDIMENTI))
+        regolamento = rng.choice(list(REGOLAMENTI))
+        obiettivo = rng.choice(list(OBIETTIVI))
+        parts += [
+            "<COMPONENTE_AIUTO>",
+            f("ID_COMPONENTE_AIUTO", f"{cor}-{c}"),
+            f("COD_PROCEDIMENTO", procedimento), f("DES_PROCEDIMENTO", PROCEDIMENTI[procedimento]),
+            f("COD_REGOLAMENTO", regolamento), f("DES_REGOLAMENTO", REGOLAMENTI[regolamento]),
+            f("COD_OBIETTIVO", obiettivo), f("DES_OBIETTIVO", OBIETTIVI[obiettivo]),
+            f("SETTORE_ATTIVITA", rng.choice(SETTORI)),
+            "<STRUMENTI_AIUTO>",
+        ]
+        for _ in range(rng.randint(*instruments)):
+            strumento = rng.choice(list(STRUMENTI))
+            importo = round(rng.lognormvariate(10, 1.5), 2)
+            parts += [
+                "<STRUMENTO_AIUTO>",
+                f("COD_STRUMENTO", strumento), f("DES_STRUMENTO", STRUMENTI[strumento]),
+                f("ELEMENTO_DI_AIUTO", round(importo * rng.uniform(0.05, 1), 2)),
+                f("IMPORTO_NOMINALE", importo),
+                "</STRUMENTO_AIUTO>",
+            ]
+        parts += ["</STRUMENTI_AIUTO>", "</COMPONENTE_AIUTO>"]
+    parts += ["</COMPONENTI_AIUTO>", "</AIUTO>\n"]
+    return "".join(parts)
+
+def generate_xml(path, aiuti: int = None, size_mb: float = None, components: Tuple[int, int] = (1, 3),
+                 instruments: Tuple[int, int] = (1, 2), years: Tuple[int, int] = (2018, 2023),
+                 text_length: int = 300, invalid_rate: float = 0.0, seed: int = 0,
+                 file_index: int = 0) -> int:
+    """
+    Scrive un file XML sintetico con lo schema RNA (LISTA_AIUTI/AIUTO con
+    componenti e strumenti) di aiuti AIUTO oppure di circa size_mb MB.
+    components e instruments sono gli intervalli (min, max) di componenti per
+    aiuto e di strumenti per componente; years l'intervallo degli anni di
+    concessione; text_length la lunghezza di DESCRIZIONE_PROGETTO; invalid_rate
+    la probabilità che un campo contenga un carattere di controllo non valido.
+    Stesso seed, stesso file; file_index distingue i file generati con lo
+    stesso seed, che hanno chiavi CAR/COR diverse. Restituisce il numero di AIUTO scritti.
+    """
+    if aiuti is None and size_mb is None:
+        raise ValueError("Specify aiuti or size_mb")
+    if not 0 <= file_index < FILES_PER_SEED:
+        raise ValueError(f"file_index must be between 0 and {FILES_PER_SEED - 1}")
+    file_key = seed * FILES_PER_SEED + file_index
+    rng = random.Random(file_key)
+    limit = int(size_mb * 1024 * 1024) if size_mb is not None else None
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    count = 0
+    with open(path, "wb") as f:
+        size = f.write(f'<?xml version="1.0" encoding="UTF-8"?>\n<LISTA_AIUTI xmlns="{XMLNS}">\n'.encode())
+        while (aiuti is None or count < aiuti) and (limit is None or size < limit):
+            aiuto = _aiuto(rng, count, file_key, components, instruments, years, text_length, invalid_rate)
+            size += f.write(aiuto.encode())
+            count += 1
+        f.write(b"</LISTA_AIUTI>\n")
+    logger.info(f"Generated {count} aids in {path} ({path.stat().st_size / 1024 / 1024:.1f} MB)")
+    return count
@@ -0,0 +1,137 @@
+import uuid
+import logging
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+logger = logging.getLogger(__name__)
+
+PARTITION_COL = 'ANNO'
+
+# Dimensione obiettivo dei file Parquet prima di passare al file successivo
+TARGET_FILE_SIZE = 256 * 1024 * 1024
+# Righe accumulate per partizione prima di scrivere un row group
+ROW_GROUP_SIZE = 128 * 1024
+
+class PartitionedParquetWriter:
+    """
+    Mantiene aperto un ParquetWriter per ogni coppia (tabella, ANNO) e vi accoda
+    row group ad ogni flush, invece di creare un nuovo file per ogni batch.
+    Quando un file supera target_file_size viene chiuso e se ne apre uno nuovo.
+    Con max_pending_bytes, se i dati in attesa di formare un row group superano
+    il limite vengono scritti subito, dalla partizione più grande (row group
+    più piccoli, ma memoria limitata anche con molti anni aperti).
+    Il layout su disco resta quello Hive: {output_dir}/{tabella}/ANNO=YYYY/*.parquet
+    """
+    def __init__(self, output_dir: str, schemas: Dict[str, pa.Schema],
+                 target_file_size: int = TARGET_FILE_SIZE,
+                 row_group_size: int = ROW_GROUP_SIZE,
+                 compression: str = 'snappy',
+                 dictionary_columns: Iterable[str] = (),
+                 max_pending_bytes: int = None,
+                 prefix: str = None, first_seq: int = 0):
+        self.base_path = Path(output_dir)
+        self.schemas = schemas
+        self.target_file_size = target_file_size
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.dictionary_columns = set(dictionary_columns)
+        self.max_pending_bytes = max_pending_bytes
+        # Prefisso univoco: più worker scrivono in parallelo nelle stesse partizioni.
+        # Una ripresa da checkpoint riusa prefisso e numerazione del tentativo precedente
+        self.prefix = prefix or uuid.uuid4().hex[:16]
+
+        self._writers: Dict[Tuple[str, int], Tuple[pq.ParquetWriter, pa.NativeFile]] = {}
+        self._pending: Dict[Tuple[str, int], List[pa.Table]] = {}
+        self._pending_rows: Dict[Tuple[str, int], int] = {}
+        self._pending_bytes: Dict[Tuple[str, int], int] = {}
+        self._seq = first_seq
+        self.files: List[str] = []
+
+    def _file_schema(self, table_name: str) -> pa.Schema:
+        schema = self.schemas[table_name]
+        return schema.remove(schema.get_field_index(PARTITION_COL))
+
+    def write(self, table_name: str, table: pa.Table):
+        """Accoda una tabella Arrow (con colonna ANNO) alle partizioni corrispondenti"""
+        if table.num_rows == 0:
+            return
+        schema = self.schemas[table_name]
+        table = table.select(schema.names).cast(schema)
+
+        years = pc.unique(table[PARTITION_COL]).to_pylist()
+        for year in years:
+            if len(years) == 1:
+                part = table
+            else:
+                part = table.filter(pc.equal(table[PARTITION_COL], year))
+            part = part.drop_columns([PARTITION_COL])
+
+            key = (table_name, year)
+            self._pending.setdefault(key, []).append(part)
+            self._pending_rows[key] = self._pending_rows.get(key, 0) + part.num_rows
+            self._pending_bytes[key] = self._pending_bytes.get(key, 0) + part.nbytes
+            if self._pending_rows[key] >= self.row_group_size:
+                self._write_pending(key)
+
+        if self.max_pending_bytes is not None:
+            while self._pending_bytes and sum(self._pending_bytes.values()) > self.max_pending_bytes:
+                self._write_pending(max(self._pending_bytes, key=self._pending_bytes.get))
+
+    def _write_pending(self, key: Tuple[str, int]):
+        parts = self._pending.pop(key, None)
+        self._pending_rows.pop(key, None)
+        self._pending_bytes.pop(key, None)
+        if not parts:
+            return
+        data = pa.concat_tables(parts) if len(parts) > 1 else parts[0]
+
+        writer, sink = self._writers.get(key) or self._open(key)
+        writer.write_table(data, row_group_size=self.row_group_size)
+
+        # Rollover: chiude il file corrente quando raggiunge la dimensione obiettivo
+        if sink.tell() >= self.target_file_size:
+            self._close_writer(key)
+
+    def _open(self, key: Tuple[str, int]):
+        table_name, year = key
+        part_dir = self.base_path / table_name / f"{PARTITION_COL}={year}"
+        part_dir.mkdir(parents=True, exist_ok=True)
+
+        path = part_dir / f"{self.prefix}-{self._seq:05d}.parquet"
+        self._seq += 1
+        sink = pa.OSFile(str(path), 'wb')
+        schema = self._file_schema(table_name)
+        # Dictionary encoding solo sulle colonne a bassa cardinalità, se indicate
+        use_dictionary = [n for n in schema.names if n in self.dictionary_columns] if self.dictionary_columns else True
+        writer = pq.ParquetWriter(sink, schema, compression=self.compression, use_dictionary=use_dictionary)
+        self._writers[key] = (writer, sink)
+        self.files.append(str(path.relative_to(self.base_path)))
+        return writer, sink
+
+    def _close_writer(self, key: Tuple[str, int]):
+        writer, sink = self._writers.pop(key)
+        writer.close()
+        sink.close()
+
+    @property
+    def seq(self) -> int:
+        return self._seq
+
+    def close(self):
+        """
+        Scrive i dati rimasti in buffer e chiude tutti i file aperti. Il writer
+        resta utilizzabile: le scritture successive aprono nuovi file.
+        """
+        for key in list(self._pending):
+            self._write_pending(key)
+        for key in list(self._writers):
+            self._close_writer(key)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,83 @@
+import pyarrow as pa
+from unittest.mock import patch
+from src.parser import process_file
+from src.catalog import QuerySession, arrow_reader
+from src.cache import ResultCache, normalize_sql, CACHE_DIR
+from tests.test_catalog import dataset  # noqa: F401
+from tests.test_parser import _multi_aiuto_xml
+
+def _run(cache, sql, data_dir):
+    reader = cache.get(sql)
+    if reader is not None:
+        return reader.read_all(), True
+    with QuerySession(data_dir) as session:
+        reader = cache.store(sql, arrow_reader(session.execute(sql)))
+        return reader.read_all(), False
+
+def test_normalize_sql_keeps_literals():
+    assert normalize_sql("SELECT  *\n FROM aiuti WHERE CAR = 'a  b';") == "SELECT * FROM aiuti WHERE CAR = 'a  b'"
+
+def test_cache_hits_and_invalidates_on_new_data(dataset, tmp_path):
+    sql = "SELECT ANNO, count(*) AS n FROM aiuti GROUP BY ANNO ORDER BY ANNO"
+    first, hit = _run(ResultCache(dataset), sql, dataset)
+    assert not hit and first.column("n").to_pylist() == [3, 3, 3]
+    again, hit = _run(ResultCache(dataset), " ".join(sql.split(" ")) + ";", dataset)
+    assert hit and again.equals(first)
+
+    # Nuovi file nel dataset: nuova versione, i risultati precedenti vengono scartati
+    p = tmp_path / "more.xml"
+    p.write_text(_multi_aiuto_xml(3))
+    process_file(str(p), str(dataset))
+    cache = ResultCache(dataset)
+    fresh, hit = _run(cache, sql, dataset)
+    assert not hit and fresh.column("n").to_pylist() == [4, 4, 4]
+    assert all(f.name.startswith(cache.version) for f in (dataset / CACHE_DIR).iterdir())
+
+    assert cache.store("SELECT random()", pa.RecordBatchReader.from_batches(fresh.schema, [])) is not None
+    assert cache.get("SELECT random()") is None
+
+def test_partial_reads_are_not_cached_and_lru_evicts(dataset):
+    cache = ResultCache(dataset)
+    with QuerySession(dataset) as session:
+        reader = cache.store("SELECT * FROM aiuti", arrow_reader(session.execute("SELECT * FROM aiuti"), 2))
+        next(iter(reader))
+        del reader
+        assert cache.get("SELECT * FROM aiuti") is None
+
+        for n in range(3):
+            sql = f"SELECT * FROM aiuti LIMIT {n + 1}"
+            cache.store(sql, arrow_reader(session.execute(sql))).read_all()
+    sizes = sorted(f.stat().st_size for f in (dataset / CACHE_DIR).glob("*.parquet"))
+    with patch.object(cache, "max_bytes", sum(sizes[1:])):
+        assert cache.get("SELECT * FROM aiuti LIMIT 1") is not None  # usato di recente
+        cache.evict()
+    assert cache.get("SELECT * FROM aiuti LIMIT 1") is not None
+    assert cache.get("SELECT * FROM aiuti LIMIT 2") is None
+
+def test_only_selects_over_catalog_views_are_cached(dataset, tmp_path):
+    cache = ResultCache(dataset)
+    assert cache.cacheable("WITH t AS (SELECT * FROM aiuti) SELECT * FROM t JOIN dim_tipo_misura USING (COD_TIPO_MISURA)")
+    assert cache.cacheable("SELECT * FROM main.aiuti_completi, range(3)")
+    ext = tmp_path / "ext.csv"
+    for sql in [f"COPY (SELECT 1) TO '{tmp_path / 'x.csv'}'", "SET threads = 1", f"ATTACH '{tmp_path / 'x.db'}'",
+                "INSTALL httpfs", f"SELECT * FROM read_csv('{ext}')", f"SELECT * FROM '{ext}'",
+                f"SELECT * FROM aiuti WHERE CAR IN (SELECT a FROM read_csv('{ext}'))", "SELECT 1; SELECT 2",
+                "SELECT * FROM duckdb_settings()"]:
+        assert not cache.cacheable(sql), sql
+
+    # Un file esterno modificato non deve restituire il risultato precedente
+    ext.write_text("a\n1\n")
+    sql = f"SELECT * FROM read_csv('{ext}')"
+    first, hit = _run(cache, sql, dataset)
+    ext.write_text("a\n2\n")
+    second, hit = _run(cache, sql, dataset)
+    assert not hit and second.column("a").to_pylist() == [2]
+
+def test_published_version_names_the_cache(dataset):
+    sql = "SELECT count(*) AS n FROM aiuti"
+    # Con il nome della versione i file del dataset non vengono elencati
+    with patch("src.cache.dataset_version", side_effect=AssertionError("dataset scanned")):
+        first, hit = _run(ResultCache(dataset, version="v000001"), sql, dataset)
+        again, hit = _run(ResultCache(dataset, version="v000001"), sql, dataset)
+    assert hit and again.equals(first)
+    assert [f.name.split("-")[0] for f in (dataset / CACHE_DIR).iterdir()] == ["v000001"]
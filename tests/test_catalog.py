@@ -0,0 +1,63 @@
+import pytest
+from src.parser import process_file
+from src.catalog import QuerySession, CATALOG_NAME, run_script, arrow_table
+from tests.test_parser import _multi_aiuto_xml
+
+@pytest.fixture
+def dataset(tmp_path):
+    p = tmp_path / "aiuti.xml"
+    p.write_text(_multi_aiuto_xml(9))
+    out = tmp_path / "parquet"
+    process_file(str(p), str(out))
+    return out
+
+def test_session_exposes_tables_by_name(dataset):
+    with QuerySession(dataset, threads=2, memory_limit="1GB") as session:
+        assert {"aiuti", "componenti", "strumenti", "aiuti_completi"} <= set(session.tables())
+        rows = session.execute("SELECT ANNO, count(*) FROM aiuti GROUP BY ANNO ORDER BY ANNO").fetchall()
+        assert rows == [(2020, 3), (2021, 3), (2022, 3)]
+        total = session.execute("SELECT sum(IMPORTO_NOMINALE) FROM aiuti_completi").fetchone()[0]
+        assert total == pytest.approx(sum(i + 0.5 for i in range(9)))
+    assert (dataset / CATALOG_NAME).exists()
+
+def test_build_query_wraps_bare_conditions(dataset):
+    with QuerySession(dataset) as session:
+        assert session.build_query("aiuti", "SELECT 1") == "SELECT 1"
+        q = session.build_query("aiuti", "ANNO = 2021 AND CAR LIKE '%1%'", limit=5)
+        assert q == "SELECT * FROM aiuti WHERE ANNO = 2021 AND CAR LIKE '%1%' LIMIT 5"
+        assert arrow_table(session.execute(q)).column("CAR").to_pylist() == ["1"]
+
+def test_script_runs_on_one_connection(dataset, capsys):
+    with QuerySession(dataset) as session:
+        run_script(session, "CREATE TEMP TABLE t AS SELECT CAR FROM aiuti; SELECT count(*) AS n FROM t;")
+    assert "9" in capsys.readouterr().out
+
+@pytest.mark.parametrize("ext", ["parquet", "csv", "ndjson"])
+def test_query_streams_result_to_file(dataset, tmp_path, ext):
+    import polars as pl
+    from unittest.mock import patch
+    from src.exporter import run_query
+
+    out = tmp_path / f"result.{ext}"
+    with patch("src.exporter.DATA_DIR", dataset), patch("src.exporter.BATCH_ROWS", 2):
+        run_query("aiuti", "SELECT CAR, ANNO FROM aiuti ORDER BY CAR::INT", output=str(out))
+
+    reader = {"parquet": pl.read_parquet, "csv": pl.read_csv, "ndjson": pl.read_ndjson}[ext]
+    df = reader(out)
+    assert df.height == 9
+    assert df["ANNO"].to_list()[:3] == [2020, 2021, 2022]
+
+def test_query_pages_terminal_output(dataset, capsys):
+    from unittest.mock import patch
+    from src.exporter import run_query
+
+    pages = []
+    def wait():
+        pages.append(1)
+        return len(pages) < 2
+
+    with patch("src.exporter.DATA_DIR", dataset):
+        run_query("aiuti", "SELECT CAR FROM aiuti", page_size=4, wait=wait)
+    # Dopo la seconda pausa l'utente interrompe: due pagine stampate
+    assert len(pages) == 2
+    assert capsys.readouterr().out.count("shape: (4, 1)") == 2
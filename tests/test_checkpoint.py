@@ -0,0 +1,114 @@
+import gzip
+import itertools
+import pytest
+import pyarrow.parquet as pq
+from unittest.mock import patch
+from src.parser import process_file
+from src.sources import find_aiuto_end, build_work_units
+from src.checkpoint import Checkpointer, CHECKPOINT_DIR, prepare_checkpoints, unit_key, load_checkpoint
+from src.dimensions import merge_dimensions
+from src.models import surrogate_key
+from tests.test_parser import _multi_aiuto_xml
+
+class Crash(BaseException):
+    """Simula un worker terminato: non viene intercettata dal parser"""
+
+def _crash_after(commits):
+    commit = Checkpointer.commit
+    calls = itertools.count(1)
+
+    def crashing_commit(self, *args, **kwargs):
+        if next(calls) > commits:
+            raise Crash()
+        return commit(self, *args, **kwargs)
+    return crashing_commit
+
+def _every(n):
+    ticks = itertools.count(1)
+    return lambda self: next(ticks) % n == 0
+
+def test_find_aiuto_end(tmp_path):
+    p = tmp_path / "a.xml"
+    text = _multi_aiuto_xml(5)
+    p.write_text(text)
+    ends = [i + len("</AIUTO>") for i in range(len(text)) if text.startswith("</AIUTO>", i)]
+    assert find_aiuto_end(str(p), 0, 0) == 0
+    assert find_aiuto_end(str(p), 0, 2) == ends[1]
+    assert find_aiuto_end(str(p), ends[1], 3) == ends[4]
+    with pytest.raises(ValueError):
+        find_aiuto_end(str(p), ends[1], 4)
+
+@pytest.mark.parametrize("name", ["aiuti.xml", "aiuti.xml.gz"])
+def test_resume_after_crash_has_no_duplicates(tmp_path, name):
+    p = tmp_path / name
+    xml = _multi_aiuto_xml(40).encode()
+    p.write_bytes(gzip.compress(xml) if name.endswith(".gz") else xml)
+    out = tmp_path / "out"
+
+    with patch.object(Checkpointer, "due", _every(7)), patch.object(Checkpointer, "commit", _crash_after(3)):
+        with pytest.raises(Crash):
+            process_file(str(p), str(out), checkpoint_interval=1)
+    state = load_checkpoint(out, unit_key(str(p)))
+    assert state["elements"] == 21 and not state["complete"]
+    # Il quarto commit è fallito dopo aver chiuso i file: restano output non registrati
+    written = {str(f.relative_to(out)) for f in out.glob("*/ANNO=*/*.parquet")}
+    assert written > set(state["outputs"])
+
+    with patch.object(Checkpointer, "due", _every(7)):
+        stats = process_file(str(p), str(out), checkpoint_interval=1, resume=True)
+    assert (stats["aiuti"], stats["componenti"], stats["strumenti"]) == (40, 40, 40)
+    assert sorted(stats["outputs"]) == sorted(str(f.relative_to(out)) for f in out.glob("*/ANNO=*/*.parquet"))
+    cars = pq.read_table(out / "aiuti").column("CAR").to_pylist()
+    assert sorted(cars, key=int) == [str(i) for i in range(40)]
+    assert pq.read_table(out / "strumenti").num_rows == 40
+
+    # Unità completata: una nuova ripresa non rilegge il file
+    again = process_file(str(p), str(out), checkpoint_interval=1, resume=True)
+    assert again["aiuti"] == 40 and sorted(again["outputs"]) == sorted(stats["outputs"])
+
+def test_failed_unit_keeps_committed_outputs(tmp_path):
+    p = tmp_path / "aiuti.xml"
+    p.write_text(_multi_aiuto_xml(20))
+    out = tmp_path / "out"
+    unit, = build_work_units([str(p)], 0)
+    commit = Checkpointer.commit
+
+    def failing_commit(self, elements, writer, stats, complete=False):
+        if complete:
+            raise OSError("disk full")
+        return commit(self, elements, writer, stats)
+
+    with patch.object(Checkpointer, "due", _every(5)), patch.object(Checkpointer, "commit", failing_commit):
+        stats = process_file(unit.path, str(out), unit.start, unit.end, checkpoint_interval=1)
+    assert stats["error"] == 1 and stats["committed"]
+    assert not set(stats["outputs"]) & set(stats["committed"])
+
+    # Senza --resume il checkpoint viene scartato insieme a tutti i file del tentativo
+    assert prepare_checkpoints(out, [unit], resume=True) == 1
+    assert prepare_checkpoints(out, [unit], resume=False) == 0
+    assert not list(out.glob("*/ANNO=*/*.parquet")) and not list((out / CHECKPOINT_DIR).iterdir())
+
+def test_resumed_dimensions_keep_integer_codes(tmp_path):
+    p = tmp_path / "aiuti.xml"
+    tipi = ("Regime di aiuti", "Aiuto ad hoc")
+    xml = _multi_aiuto_xml(20)
+    for i in range(20):
+        xml = xml.replace(f"<COR>COR{i}</COR>",
+                          f"<COR>COR{i}</COR><DES_TIPO_MISURA>{tipi[i % 2]}</DES_TIPO_MISURA>")
+    p.write_text(xml)
+    out = tmp_path / "out"
+
+    with patch.object(Checkpointer, "due", _every(5)), patch.object(Checkpointer, "commit", _crash_after(2)):
+        with pytest.raises(Crash):
+            process_file(str(p), str(out), checkpoint_interval=1)
+    with patch.object(Checkpointer, "due", _every(5)):
+        stats = process_file(str(p), str(out), checkpoint_interval=1, resume=True)
+    # I codici salvati nel checkpoint tornano interi come quelli letti dopo la ripresa
+    expected = {surrogate_key(t): t for t in tipi}
+    assert stats["dimensions"]["tipo_misura"] == expected
+
+    again = process_file(str(p), str(out), checkpoint_interval=1, resume=True)
+    assert again["dimensions"]["tipo_misura"] == expected
+    merge_dimensions(out, again["dimensions"])
+    table = pq.read_table(out / "dimensioni" / "tipo_misura.parquet")
+    assert table.column("COD_TIPO_MISURA").to_pylist() == sorted(expected)
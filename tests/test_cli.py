@@ -0,0 +1,127 @@
+import os
+import json
+import logging
+from unittest.mock import patch
+import pyarrow.parquet as pq
+from click.testing import CliRunner
+from src.cli import cli
+from src.snapshots import resolve_data_dir, current_version
+from tests.test_parser import XML_CONTENT, _multi_aiuto_xml
+
+def _parse(input_dir, output_dir, *args):
+    result = CliRunner().invoke(cli, ["parse", "-i", str(input_dir), "-o", str(output_dir), "-w", "2", *args])
+    assert result.exit_code == 0, result.output
+    return result
+
+def test_incremental_parse_skips_unchanged_and_replaces_changed(tmp_path):
+    data = tmp_path / "data"
+    data.mkdir()
+    (data / "a.xml").write_text(XML_CONTENT)
+    (data / "b.xml").write_text(_multi_aiuto_xml(4))
+    out = tmp_path / "parquet"
+
+    _parse(data, out)
+    assert pq.read_table(resolve_data_dir(out) / "aiuti").num_rows == 5
+    manifest = json.loads((resolve_data_dir(out) / "_manifest.json").read_text())
+    assert len(manifest["sources"]) == 2
+
+    # Un file modificato viene riprocessato e i suoi vecchi output sostituiti
+    (data / "b.xml").write_text(_multi_aiuto_xml(6))
+    unchanged_outputs = manifest["sources"][str((data / "a.xml").resolve())]["outputs"]
+    _parse(data, out)
+    assert pq.read_table(resolve_data_dir(out) / "aiuti").num_rows == 7
+    manifest = json.loads((resolve_data_dir(out) / "_manifest.json").read_text())
+    assert manifest["sources"][str((data / "a.xml").resolve())]["outputs"] == unchanged_outputs
+
+    # Stesso contenuto con un nuovo mtime: invariato; stessa dimensione ma contenuto diverso: riprocessato
+    os.utime(data / "a.xml")
+    _parse(data, out)
+    manifest = json.loads((resolve_data_dir(out) / "_manifest.json").read_text())
+    assert manifest["sources"][str((data / "a.xml").resolve())]["outputs"] == unchanged_outputs
+    # Nessuna modifica: nessuna nuova versione
+    version = current_version(out)
+    _parse(data, out)
+    assert current_version(out) == version
+    assert [p.name for p in (out / "versions").iterdir()] == [version]
+    (data / "a.xml").write_text(XML_CONTENT.replace("12345", "54321"))
+    _parse(data, out)
+    cars = pq.read_table(resolve_data_dir(out) / "aiuti").column("CAR").to_pylist()
+    assert "54321" in cars and "12345" not in cars
+
+    # Un file rimosso dall'input perde i suoi output
+    (data / "a.xml").unlink()
+    _parse(data, out)
+    assert pq.read_table(resolve_data_dir(out) / "aiuti").num_rows == 6
+
+def test_compact_merges_files_per_source_and_is_repeatable(tmp_path):
+    import zipfile
+    data = tmp_path / "data"
+    data.mkdir()
+    # Due membri dello stesso archivio: più file per partizione della stessa sorgente
+    with zipfile.ZipFile(data / "aiuti.zip", "w") as zf:
+        zf.writestr("m1.xml", _multi_aiuto_xml(20))
+        zf.writestr("m2.xml", _multi_aiuto_xml(20))
+    out = tmp_path / "parquet"
+    _parse(data, out)
+    before = pq.read_table(resolve_data_dir(out) / "aiuti").num_rows
+    assert len(list((resolve_data_dir(out) / "aiuti" / "ANNO=2020").glob("*.parquet"))) == 2
+
+    runner = CliRunner()
+    for _ in range(2):
+        result = runner.invoke(cli, ["compact", "-o", str(out)])
+        assert result.exit_code == 0, result.output
+
+    current = resolve_data_dir(out)
+    for part in (current / "aiuti").glob("ANNO=*"):
+        files = list(part.glob("*.parquet"))
+        assert len(files) == 1 and files[0].name.startswith("c-")
+        assert pq.ParquetFile(files[0]).metadata.row_group(0).column(0).compression == "ZSTD"
+
+    assert pq.read_table(current / "aiuti").num_rows == before
+    for f in (current / "componenti").glob("ANNO=*/*.parquet"):
+        keys = pq.read_table(f).column("AIUTO_SK").to_pylist()
+        assert keys == sorted(keys)
+    manifest = json.loads((current / "_manifest.json").read_text())
+    outputs = next(iter(manifest["sources"].values()))["outputs"]
+    assert all((current / o).exists() for o in outputs)
+    assert all(o.split("/")[-1].startswith("c-") for o in outputs)
+
+def test_parse_moves_descriptions_to_dimension_tables(tmp_path, caplog):
+    from src.catalog import QuerySession, arrow_table
+    data = tmp_path / "data"
+    data.mkdir()
+    xml = XML_CONTENT.replace(
+        "<TITOLO_MISURA>Misura Test</TITOLO_MISURA>",
+        "<TITOLO_MISURA>Misura Test</TITOLO_MISURA><DES_TIPO_MISURA>Regime di aiuto</DES_TIPO_MISURA>",
+    ).replace(
+        "<ID_COMPONENTE_AIUTO>999</ID_COMPONENTE_AIUTO>",
+        "<ID_COMPONENTE_AIUTO>999</ID_COMPONENTE_AIUTO>"
+        "<COD_REGOLAMENTO>R1</COD_REGOLAMENTO><DES_REGOLAMENTO>De minimis</DES_REGOLAMENTO>",
+    )
+    (data / "a.xml").write_text(xml)
+    (data / "b.xml").write_text(xml.replace("12345", "67890").replace("De minimis", "Altro testo"))
+    out = tmp_path / "parquet"
+    with caplog.at_level(logging.WARNING, logger="src.dimensions"):
+        _parse(data, out)
+    current = resolve_data_dir(out)
+
+    componenti = pq.read_table(current / "componenti")
+    assert "DES_REGOLAMENTO" not in componenti.column_names
+    # Stesso codice con descrizioni diverse: vince la sorgente successiva nell'ordine del manifest
+    regolamento = pq.read_table(current / "dimensioni" / "regolamento.parquet").to_pylist()
+    assert regolamento == [{"COD_REGOLAMENTO": "R1", "DES_REGOLAMENTO": "Altro testo"}]
+    assert "Dimension regolamento: 1 codes with a different description" in caplog.text
+    assert pq.read_table(current / "dimensioni" / "tipo_misura.parquet").column("DES_TIPO_MISURA").to_pylist() == ["Regime di aiuto"]
+
+    with QuerySession(current) as session:
+        rows = arrow_table(session.execute(
+            "SELECT DES_TIPO_MISURA, DES_REGOLAMENTO FROM aiuti_completi"
+        )).to_pylist()
+    assert len(rows) == 2 and {r["DES_TIPO_MISURA"] for r in rows} == {"Regime di aiuto"}
+    assert rows[0]["DES_REGOLAMENTO"] == rows[1]["DES_REGOLAMENTO"] == regolamento[0]["DES_REGOLAMENTO"]
+
+    export = tmp_path / "componenti.csv"
+    with patch("src.exporter.DATA_DIR", out):
+        result = CliRunner().invoke(cli, ["export", "-t", "componenti", "-o", str(export), "-c", "ID_COMPONENTE_AIUTO,DES_REGOLAMENTO"])
+    assert result.exit_code == 0, result.output
+    assert export.read_text().splitlines()[1] == f"999,{regolamento[0]['DES_REGOLAMENTO']}"
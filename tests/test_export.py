@@ -0,0 +1,99 @@
+import pytest
+import polars as pl
+from unittest.mock import patch
+from src.parser import process_file
+from src.exporter import export_dataset, parse_years, scan_table
+from tests.test_parser import _multi_aiuto_xml
+
+@pytest.fixture
+def dataset(tmp_path):
+    p = tmp_path / "aiuti.xml"
+    p.write_text(_multi_aiuto_xml(9))
+    out = tmp_path / "parquet"
+    process_file(str(p), str(out))
+    return out
+
+def test_parse_years():
+    assert parse_years("2022") == [2022]
+    assert parse_years("2021, 2019") == [2019, 2021]
+    assert parse_years("2020-2022,2024") == [2020, 2021, 2022, 2024]
+
+def test_export_slice(dataset, tmp_path):
+    out = tmp_path / "slice.csv"
+    with patch("src.exporter.DATA_DIR", dataset):
+        export_dataset("strumenti", "csv", str(out), ";", years=[2021, 2022],
+                       columns=["ANNO", "IMPORTO_NOMINALE"], where="IMPORTO_NOMINALE > 3")
+    df = pl.read_csv(out, separator=";")
+    assert df.columns == ["ANNO", "IMPORTO_NOMINALE"]
+    # i = 4, 5, 7, 8 (anno 2020 escluso: i = 3, 6)
+    assert sorted(df["IMPORTO_NOMINALE"].to_list()) == [4.5, 5.5, 7.5, 8.5]
+    assert set(df["ANNO"].to_list()) == {2021, 2022}
+
+def test_scan_reads_only_requested_partitions(dataset):
+    with patch("src.exporter.DATA_DIR", dataset):
+        plan = scan_table("aiuti", years=[2021], columns=["CAR"]).explain()
+        assert "ANNO=2020" not in plan and "ANNO=2022" not in plan
+        assert scan_table("aiuti", years=[2021]).collect()["CAR"].to_list() == ["1", "4", "7"]
+        with pytest.raises(FileNotFoundError):
+            scan_table("aiuti", years=[1999])
+
+@pytest.mark.parametrize("memory_budget", [None, 1])
+def test_export_aggregated_years_in_parallel(dataset, tmp_path, memory_budget):
+    from src.exporter import export_aggregated_dataset
+
+    with patch("src.exporter.DATA_DIR", dataset):
+        export_aggregated_dataset(str(tmp_path / "agg.csv"), jobs=3, memory_budget=memory_budget)
+    for year in (2020, 2021, 2022):
+        df = pl.read_csv(tmp_path / f"agg_{year}.csv", schema_overrides={"CAR": pl.String})
+        assert df.height == 3
+        assert df["NUM_COMPONENTI"].to_list() == [1, 1, 1]
+        expected = {str(i): i + 0.5 for i in range(9) if 2020 + i % 3 == year}
+        assert dict(zip(df["CAR"], df["IMPORTO_NOMINALE_TOTALE"])) == expected
+
+ROLLUP_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<LISTA_AIUTI xmlns="http://www.rna.it/RNA_aiuto/schema">
+    <AIUTO>
+        <CAR>1</CAR><COR>A</COR><DATA_CONCESSIONE>2023-03-01</DATA_CONCESSIONE>
+        <COMPONENTI_AIUTO>
+            <COMPONENTE_AIUTO>
+                <ID_COMPONENTE_AIUTO>C1</ID_COMPONENTE_AIUTO><SETTORE_ATTIVITA>A.1</SETTORE_ATTIVITA>
+                <STRUMENTI_AIUTO>
+                    <STRUMENTO_AIUTO><COD_STRUMENTO>S1</COD_STRUMENTO><IMPORTO_NOMINALE>100</IMPORTO_NOMINALE><ELEMENTO_DI_AIUTO>10</ELEMENTO_DI_AIUTO></STRUMENTO_AIUTO>
+                    <STRUMENTO_AIUTO><COD_STRUMENTO>S2</COD_STRUMENTO><IMPORTO_NOMINALE>200</IMPORTO_NOMINALE><ELEMENTO_DI_AIUTO>n.d.</ELEMENTO_DI_AIUTO></STRUMENTO_AIUTO>
+                </STRUMENTI_AIUTO>
+            </COMPONENTE_AIUTO>
+            <COMPONENTE_AIUTO>
+                <ID_COMPONENTE_AIUTO>C2</ID_COMPONENTE_AIUTO><SETTORE_ATTIVITA>B.2</SETTORE_ATTIVITA>
+                <STRUMENTI_AIUTO>
+                    <STRUMENTO_AIUTO><COD_STRUMENTO>S1</COD_STRUMENTO><IMPORTO_NOMINALE>50</IMPORTO_NOMINALE><ELEMENTO_DI_AIUTO>5</ELEMENTO_DI_AIUTO></STRUMENTO_AIUTO>
+                </STRUMENTI_AIUTO>
+            </COMPONENTE_AIUTO>
+        </COMPONENTI_AIUTO>
+    </AIUTO>
+    <AIUTO>
+        <CAR>2</CAR><COR>B</COR><DATA_CONCESSIONE>2023-04-01</DATA_CONCESSIONE>
+    </AIUTO>
+</LISTA_AIUTI>
+"""
+
+def test_parser_rollup_matches_join(tmp_path):
+    from src.exporter import aggregate_aiuti, AGGREGATED_COLUMNS
+
+    p = tmp_path / "rollup.xml"
+    p.write_text(ROLLUP_XML)
+    out = tmp_path / "parquet"
+    process_file(str(p), str(out))
+
+    part = "ANNO=2023/*.parquet"
+    columns = ["CAR", "COR"] + AGGREGATED_COLUMNS
+    materialized = pl.read_parquet(out / "aiuti_aggregati" / part).select(columns).sort("CAR")
+    with patch("src.exporter.DATA_DIR", out):
+        joined = aggregate_aiuti(*(str(out / t / part) for t in ("aiuti", "componenti", "strumenti"))).collect()
+    joined = joined.select(columns).sort("CAR")
+
+    row = materialized.row(0, named=True)
+    assert row["IMPORTO_NOMINALE_TOTALE"] == 350.0 and row["ELEMENTO_DI_AIUTO_TOTALE"] == 15.0
+    assert (row["NUM_COMPONENTI"], row["NUM_STRUMENTI"]) == (2, 3)
+    assert (row["COD_STRUMENTI"], row["SETTORI_ATTIVITA"]) == ("S1|S2", "A.1|B.2")
+    assert materialized.row(1, named=True)["NUM_COMPONENTI"] == 0
+    assert materialized.cast(joined.schema).equals(joined)
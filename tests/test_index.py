@@ -0,0 +1,57 @@
+import re
+from pathlib import Path
+import pyarrow.parquet as pq
+from src.parser import process_file
+from src.compactor import compact_dataset
+from src.index import update_index, lookup, INDEX_NAME
+from tests.test_parser import _multi_aiuto_xml
+
+def _dataset(tmp_path, n=24):
+    # Un codice fiscale ogni 6 aiuti consecutivi, quindi su tutti e tre gli anni
+    xml = re.sub(r"<COR>COR(\d+)</COR>",
+                 lambda m: f"<COR>COR{m.group(1)}</COR><CODICE_FISCALE_BENEFICIARIO>CF{int(m.group(1)) // 6}</CODICE_FISCALE_BENEFICIARIO>"
+                           f"<CUP>CUP{m.group(1)}</CUP>",
+                 _multi_aiuto_xml(n))
+    p = tmp_path / "aiuti.xml"
+    p.write_text(xml)
+    out = tmp_path / "parquet"
+    process_file(str(p), str(out))
+    return out
+
+def test_lookup_reads_only_indexed_row_groups(tmp_path):
+    out = _dataset(tmp_path)
+    # Row group da 2 righe: ogni CF si trova in un solo row group per file
+    for f in (out / "aiuti").glob("ANNO=*/*.parquet"):
+        pq.write_table(pq.read_table(f), f, row_group_size=2)
+    update_index(out)
+    cf1 = pq.read_table(out / INDEX_NAME, filters=[("KEY_TYPE", "==", "CF"), ("KEY", "==", "CF1")])
+    assert cf1.num_rows == 3 and cf1["ROW_GROUP"].to_pylist() == [1, 1, 1]
+    assert all(pq.ParquetFile(out / f).num_row_groups == 4 for f in cf1["FILE"].to_pylist())
+
+    result = lookup(out, "CF", "CF1")
+    cars = sorted(int(c) for c in result["aiuti"]["CAR"])
+    assert cars == [6, 7, 8, 9, 10, 11]
+    assert sorted(int(c[1:]) for c in result["componenti"]["ID_COMPONENTE_AIUTO"]) == cars
+    assert sorted(result["strumenti"]["IMPORTO_NOMINALE"].to_list()) == [c + 0.5 for c in cars]
+
+    assert lookup(out, "CUP", "CUP7")["aiuti"]["CAR"].to_list() == ["7"]
+    assert lookup(out, "CF", "MISSING") == {}
+
+def test_update_index_is_incremental(tmp_path):
+    out = _dataset(tmp_path, n=6)
+    assert update_index(out) == 9  # CF0 in 3 file + 6 CUP
+    mtime = (out / INDEX_NAME).stat().st_mtime_ns
+    assert update_index(out) == 9
+    assert (out / INDEX_NAME).stat().st_mtime_ns == mtime
+
+    # Un file rimosso perde le sue voci
+    next((out / "aiuti").glob("ANNO=2020/*.parquet")).unlink()
+    assert update_index(out) == 6
+
+def test_compact_refreshes_index(tmp_path):
+    out = _dataset(tmp_path, n=6)
+    update_index(out)
+    compact_dataset(str(out))
+    files = set(pq.read_table(out / INDEX_NAME)["FILE"].to_pylist())
+    assert files and all(Path(f).name.startswith("c-") for f in files)
+    assert lookup(out, "CUP", "CUP4")["aiuti"]["CAR"].to_list() == ["4"]
@@ -0,0 +1,33 @@
+import time
+from src.parser import process_file
+from src.metrics import StageTimer, PARSE_STAGES, build_report, chrome_trace
+from tests.test_parser import _multi_aiuto_xml
+
+def test_nested_stages_are_counted_once():
+    timer = StageTimer()
+    timer.start("outer")
+    time.sleep(0.01)
+    timer.start("inner")
+    time.sleep(0.1)
+    timer.stop()
+    timer.stop()
+    assert timer.seconds["inner"] >= 0.1
+    # Margine ampio per i ritardi dello scheduler: senza esclusione outer varrebbe >= 0.11
+    assert 0.01 <= timer.seconds["outer"] < 0.1
+    assert list(timer.iterate("next", [1, 2])) == [1, 2] and timer.calls["next"] == 3
+
+def test_process_file_profile(tmp_path):
+    p = tmp_path / "aiuti.xml"
+    p.write_text(_multi_aiuto_xml(30))
+    stats = process_file(str(p), str(tmp_path / "out"), profile=True, trace=True)
+    profile = stats["profile"]
+    assert set(profile["seconds"]) == set(PARSE_STAGES)
+    assert profile["bytes_in"] == p.stat().st_size
+    assert profile["bytes_out"] > 0 and profile["records"] == 90 and profile["peak_rss"] > 0
+
+    report = build_report([profile], elapsed=1.0, workers=1)
+    assert abs(sum(s["share"] for s in report["stages"].values()) - 1) < 1e-9
+    assert "events" not in report["units"][0]
+    assert chrome_trace([profile])["traceEvents"][0]["name"] == "aiuti.xml"
+
+    assert "profile" not in process_file(str(p), str(tmp_path / "plain"))
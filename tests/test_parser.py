@@ -1,6 +1,10 @@
 import pytest
 import os
-from src.parser import process_file
+import io
+from src.parser import process_file, CleanFileInputStream
+from src.sources import split_file, build_work_units
+from src.manifest import unit_digest
+import pyarrow as pa
 import pyarrow.parquet as pq
 from pathlib import Path
 
@@ -48,3 +52,231 @@ def test_process_file(sample_xml, tmp_path):
     
     # Check partition year=2022
     assert (output_dir / "aiuti" / "ANNO=2022").exists()
+
+def _multi_aiuto_xml(n):
+    aiuti = []
+    for i in range(n):
+        aiuti.append(f"""    <AIUTO>
+        <CAR>{i}</CAR>
+        <COR>COR{i}</COR>
+        <DATA_CONCESSIONE>{2020 + i % 3}-05-01</DATA_CONCESSIONE>
+        <COMPONENTI_AIUTO>
+            <COMPONENTE_AIUTO>
+                <ID_COMPONENTE_AIUTO>C{i}</ID_COMPONENTE_AIUTO>
+                <STRUMENTI_AIUTO>
+                    <STRUMENTO_AIUTO>
+                        <IMPORTO_NOMINALE>{i}.50</IMPORTO_NOMINALE>
+                    </STRUMENTO_AIUTO>
+                </STRUMENTI_AIUTO>
+            </COMPONENTE_AIUTO>
+        </COMPONENTI_AIUTO>
+    </AIUTO>
+""")
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<LISTA_AIUTI xmlns="http://www.rna.it/RNA_aiuto/schema">\n'
+            + "".join(aiuti) + "</LISTA_AIUTI>\n")
+
+def test_process_file_byte_ranges(tmp_path):
+    p = tmp_path / "big.xml"
+    p.write_text(_multi_aiuto_xml(50))
+    output_dir = tmp_path / "output"
+
+    ranges = split_file(str(p), 2048)
+    assert len(ranges) > 1
+    assert ranges[0][0] == 0 and ranges[-1][1] == p.stat().st_size
+
+    totals = {"aiuti": 0, "componenti": 0, "strumenti": 0}
+    for start, end in ranges:
+        stats = process_file(str(p), str(output_dir), start, end)
+        assert "error" not in stats
+        assert stats["digest"] == unit_digest(str(p), None, start, end)
+        for k in totals:
+            totals[k] += stats[k]
+
+    assert totals == {"aiuti": 50, "componenti": 50, "strumenti": 50}
+    cars = pq.read_table(output_dir / "aiuti").column("CAR").to_pylist()
+    assert sorted(cars, key=int) == [str(i) for i in range(50)]
+
+def test_output_uses_model_schema(sample_xml, tmp_path):
+    output_dir = tmp_path / "output"
+    process_file(sample_xml, str(output_dir))
+
+    f = next((output_dir / "aiuti" / "ANNO=2022").glob("*.parquet"))
+    pf = pq.ParquetFile(f)
+    schema = pf.schema_arrow
+    assert schema.field("DATA_CONCESSIONE").type == pa.date32()
+    # Colonne assenti nell'XML mantengono comunque il tipo dello schema
+    assert schema.field("CUP").type == pa.string()
+
+    stats = pf.metadata.row_group(0).column(schema.get_field_index("DATA_CONCESSIONE")).statistics
+    assert stats.has_min_max and str(stats.min) == "2022-01-01"
+
+def test_strumenti_amounts_are_parsed_in_bulk(tmp_path):
+    p = tmp_path / "importi.xml"
+    p.write_text(XML_CONTENT.replace(
+        "<IMPORTO_NOMINALE>1000.00</IMPORTO_NOMINALE>",
+        "<IMPORTO_NOMINALE>1000.00</IMPORTO_NOMINALE></STRUMENTO_AIUTO>"
+        "<STRUMENTO_AIUTO><COD_STRUMENTO>S2</COD_STRUMENTO><IMPORTO_NOMINALE>n/d</IMPORTO_NOMINALE>"
+    ))
+    output_dir = tmp_path / "output"
+    stats = process_file(str(p), str(output_dir))
+    assert stats["strumenti"] == 2
+
+    t = pq.read_table(output_dir / "strumenti").sort_by("IMPORTO_NOMINALE")
+    # Valori non numerici o mancanti valgono 0.0
+    assert t.column("IMPORTO_NOMINALE").to_pylist() == [0.0, 1000.0]
+    assert t.column("ELEMENTO_DI_AIUTO").to_pylist() == [0.0, 0.0]
+    assert t.column("ID_COMPONENTE_AIUTO").to_pylist() == ["999", "999"]
+    assert t.column("COD_STRUMENTO").to_pylist() == ["S2", None]
+
+@pytest.mark.parametrize("buffer_size", [1, 3, 5, 7, 4096])
+def test_clean_stream_strips_entities_split_across_reads(buffer_size):
+    raw = b"<A>ok&#x1F;x&#31;y\x01z&#x0B;&#232;&amp;\x0c</A>"
+    stream = CleanFileInputStream(io.BytesIO(raw), buffer_size=buffer_size)
+    out = b""
+    while True:
+        chunk = stream.read(2)
+        if not chunk:
+            break
+        out += chunk
+    assert out == b"<A>okxyz&#232;&amp;</A>"
+    assert stream.bytes_stripped == len(raw) - len(out)
+
+def test_process_file_reports_stripped_bytes(tmp_path):
+    p = tmp_path / "dirty.xml"
+    p.write_bytes(XML_CONTENT.replace("Misura Test", "Misura\x1f&#x1F;Test").encode())
+    stats = process_file(str(p), str(tmp_path / "output"))
+    assert stats["aiuti"] == 1
+    assert stats["bytes_stripped"] == 7
+
+def test_process_compressed_archives(tmp_path):
+    import gzip, zipfile
+    zip_path = tmp_path / "OpenData_Aiuti.zip"
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("2022/OpenData_Aiuti_2022_01.xml", XML_CONTENT)
+        zf.writestr("2022/OpenData_Aiuti_2022_02.xml", _multi_aiuto_xml(3))
+        zf.writestr("LEGGIMI.txt", "non xml")
+    gz_path = tmp_path / "OpenData_Aiuti_2022_03.xml.gz"
+    gz_path.write_bytes(gzip.compress(_multi_aiuto_xml(2).encode()))
+
+    units = build_work_units([str(zip_path), str(gz_path)], 0)
+    assert [u.member for u in units] == ["2022/OpenData_Aiuti_2022_01.xml", "2022/OpenData_Aiuti_2022_02.xml", None]
+
+    output_dir = tmp_path / "output"
+    total = 0
+    for u in units:
+        stats = process_file(u.path, str(output_dir), u.start, u.end, u.member)
+        assert "error" not in stats
+        # L'hash calcolato durante lo streaming è quello che il manifest ricalcola sull'unità
+        assert stats["digest"] == unit_digest(u.path, u.member, u.start, u.end)
+        total += stats["aiuti"]
+    assert total == 6
+
+    sources = set(pq.read_table(output_dir / "aiuti").column("FILE_SOURCE").to_pylist())
+    assert sources == {"OpenData_Aiuti_2022_01.xml", "OpenData_Aiuti_2022_02.xml", "OpenData_Aiuti_2022_03.xml"}
+
+def test_surrogate_keys_are_stable_and_scoped(tmp_path):
+    from src.models import surrogate_key
+    # Stesso ID_COMPONENTE_AIUTO in due AIUTI diversi: le chiavi surrogate li distinguono
+    xml = _multi_aiuto_xml(2).replace("<ID_COMPONENTE_AIUTO>C1</ID_COMPONENTE_AIUTO>",
+                                      "<ID_COMPONENTE_AIUTO>C0</ID_COMPONENTE_AIUTO>")
+    p = tmp_path / "dup.xml"
+    p.write_text(xml)
+    runs = []
+    for run in ("a", "b"):
+        process_file(str(p), str(tmp_path / run))
+        comp = pq.read_table(tmp_path / run / "componenti").sort_by("CAR_AIUTO")
+        strum = pq.read_table(tmp_path / run / "strumenti").sort_by("IMPORTO_NOMINALE")
+        runs.append((comp.column("COMPONENTE_SK").to_pylist(), strum.column("COMPONENTE_SK").to_pylist()))
+
+    comp_sk, strum_sk = runs[0]
+    assert runs[0] == runs[1]
+    assert len(set(comp_sk)) == 2 and strum_sk == comp_sk
+    aiuti = pq.read_table(tmp_path / "a" / "aiuti").sort_by("CAR")
+    assert aiuti.column("AIUTO_SK").to_pylist() == [surrogate_key("0", "COR0"), surrogate_key("1", "COR1")]
+
+def test_flush_follows_memory_budget(tmp_path):
+    from unittest.mock import patch
+    from src import parser
+
+    p = tmp_path / "aiuti.xml"
+    p.write_text(_multi_aiuto_xml(60))
+    calls = []
+    flush = parser.flush_batches
+
+    def counting_flush(batches, *args):
+        calls.append(sum(b.nbytes for b in batches.values()))
+        return flush(batches, *args)
+
+    with patch.object(parser, "flush_batches", counting_flush):
+        stats = process_file(str(p), str(tmp_path / "small"), memory_per_worker=64 * 1024)
+    budget = 64 * 1024 * parser.BATCH_MEMORY_FRACTION
+    assert stats["aiuti"] == 60 and len(calls) > 2
+    # Ogni flush parte appena superato il budget (al massimo un AIUTO oltre)
+    assert all(c >= budget for c in calls[:-1]) and max(calls) < 2 * budget
+    assert pq.read_table(tmp_path / "small" / "strumenti").num_rows == 60
+
+    calls.clear()
+    with patch.object(parser, "flush_batches", counting_flush):
+        process_file(str(p), str(tmp_path / "default"))
+    assert len(calls) == 1
+
+def test_split_file_caps_ranges(tmp_path):
+    p = tmp_path / "big.xml"
+    p.write_text(_multi_aiuto_xml(50))
+    assert len(split_file(str(p), 2048)) > 3
+    ranges = split_file(str(p), 2048, max_chunks=3)
+    assert len(ranges) == 3
+    assert ranges[0][0] == 0 and ranges[-1][1] == p.stat().st_size
+    assert all(a[1] == b[0] for a, b in zip(ranges, ranges[1:]))
+
+def test_write_errors_fail_the_unit(tmp_path):
+    from unittest.mock import patch
+    p = tmp_path / "a.xml"
+    p.write_text(_multi_aiuto_xml(5))
+    with patch("src.parser.PartitionedParquetWriter.write", side_effect=OSError("disk full")):
+        stats = process_file(str(p), str(tmp_path / "output"))
+    assert stats["error"] == 1 and stats["aiuti"] == 0
+
+def test_dimensions_do_not_depend_on_ranges(tmp_path, caplog):
+    import logging
+    from src.dimensions import combine_dimensions, merge_dimensions
+    xml = _multi_aiuto_xml(60)
+    for i in range(60):
+        xml = xml.replace(f"<ID_COMPONENTE_AIUTO>C{i}</ID_COMPONENTE_AIUTO>",
+                          f"<ID_COMPONENTE_AIUTO>C{i}</ID_COMPONENTE_AIUTO><COD_PROCEDIMENTO>1</COD_PROCEDIMENTO>"
+                          f"<DES_PROCEDIMENTO>{'OLD' if i < 45 else 'NEW'}</DES_PROCEDIMENTO>")
+    p = tmp_path / "procedimenti.xml"
+    p.write_text(xml)
+
+    tables = []
+    for n in (1, 2):
+        out = tmp_path / f"ranges-{n}"
+        ranges = split_file(str(p), 2048, max_chunks=n) if n > 1 else [(None, None)]
+        assert len(ranges) == n
+        with caplog.at_level(logging.WARNING, logger="src.dimensions"):
+            caplog.clear()
+            parts = [process_file(str(p), str(out), start, end)["dimensions"] for start, end in ranges]
+            merge_dimensions(out, combine_dimensions(parts))
+        # Il conflitto viene segnalato sia dentro un'unità sia tra unità
+        assert "Dimension procedimento: 1 codes with a different description" in caplog.text
+        tables.append(pq.read_table(out / "dimensioni" / "procedimento.parquet").to_pylist())
+    assert tables[0] == tables[1] == [{"COD_PROCEDIMENTO": "1", "DES_PROCEDIMENTO": "NEW"}]
+
+def test_discover_inputs_skips_other_compressed_files(tmp_path):
+    import gzip
+    from src.sources import discover_inputs
+    (tmp_path / "a.xml").write_text(XML_CONTENT)
+    (tmp_path / "b.xml.gz").write_bytes(gzip.compress(XML_CONTENT.encode()))
+    (tmp_path / "c.zip").write_bytes(b"")
+    (tmp_path / "data.csv.gz").write_bytes(gzip.compress(b"a,b\n1,2\n"))
+    (tmp_path / "notes.zst").write_bytes(b"")
+    assert [Path(f).name for f in discover_inputs(tmp_path)] == ["a.xml", "b.xml.gz", "c.zip"]
+
+def test_tiny_gzip_size_is_not_wrapped(tmp_path):
+    import gzip
+    p = tmp_path / "tiny.xml.gz"
+    # Dati incomprimibili: il file compresso è più grande del contenuto
+    p.write_bytes(gzip.compress(b"<A/>\n" + os.urandom(64)))
+    unit, = build_work_units([str(p)], 0)
+    assert p.stat().st_size > 69 and unit.size == 69
@@ -0,0 +1,23 @@
+import os
+from src.sources import WorkUnit
+from src.scheduler import order_largest_first, run_work_units, effective_workers
+
+def _work(path, size):
+    return {"path": path, "size": size, "pid": os.getpid()}
+
+def test_units_are_scheduled_largest_first():
+    units = [WorkUnit("a", size=10), WorkUnit("b", size=300), WorkUnit("c", size=50)]
+    assert [u.path for u in order_largest_first(units)] == ["b", "c", "a"]
+
+def test_run_work_units_returns_every_result():
+    units = [WorkUnit(str(i), size=i) for i in range(8)]
+    results = list(run_work_units(units, _work, lambda u: (u.path, u.size), workers=2))
+    assert sorted(r["path"] for _, r, _ in results) == [str(i) for i in range(8)]
+    assert all(err is None for _, _, err in results)
+    # Con un solo worker l'ordine di completamento è esattamente LPT
+    serial = [u.path for u, _, _ in run_work_units(units, _work, lambda u: (u.path, u.size), workers=1)]
+    assert serial == [str(i) for i in range(7, -1, -1)]
+
+def test_workers_are_capped_by_memory():
+    assert effective_workers(4, memory_per_worker=2 ** 62) == 1
+    assert effective_workers(3, memory_per_worker=1) == 3
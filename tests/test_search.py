@@ -0,0 +1,66 @@
+import os
+import pytest
+from pathlib import Path
+from src.parser import process_file
+from src.search import tokenize, update_search_index, search, SEARCH_DIR
+
+SEARCH_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<LISTA_AIUTI xmlns="http://www.rna.it/RNA_aiuto/schema">
+{}
+</LISTA_AIUTI>
+"""
+
+def _aiuto(car, year, titolo, descrizione=""):
+    return (f"<AIUTO><CAR>{car}</CAR><COR>COR{car}</COR><DATA_CONCESSIONE>{year}-01-01</DATA_CONCESSIONE>"
+            f"<TITOLO_PROGETTO>{titolo}</TITOLO_PROGETTO><DESCRIZIONE_PROGETTO>{descrizione}</DESCRIZIONE_PROGETTO></AIUTO>")
+
+def _write(path, *aiuti):
+    path.write_text(SEARCH_XML.format("\n".join(aiuti)))
+
+def test_tokenize_folds_accents_and_drops_stopwords():
+    assert tokenize("Attività dell'Impresa e PERCHÉ la Città") == ["attivita", "impresa", "citta"]
+
+def test_search_ranks_and_updates_incrementally(tmp_path):
+    out = tmp_path / "parquet"
+    _write(tmp_path / "a.xml",
+           _aiuto(1, 2021, "Efficientamento energetico", "impianto fotovoltaico per l'efficienza energetica"),
+           _aiuto(2, 2021, "Digitalizzazione dell'impresa", "software gestionale"),
+           _aiuto(3, 2022, "Impianto fotovoltaico", "pannelli fotovoltaici e accumulo"))
+    process_file(str(tmp_path / "a.xml"), str(out))
+    assert update_search_index(out) == 3
+
+    results = search(out, "fotovoltaico")
+    assert results["CAR"].to_list() == ["3", "1"]
+    assert results["SCORE"][0] > results["SCORE"][1] > 0
+    assert results["ANNO"].to_list() == [2022, 2021]
+    assert search(out, "digitalizzazione IMPRESA")["CAR"].to_list() == ["2"]
+    assert search(out, "della e per").is_empty()
+
+    # Un nuovo file aggiunge solo il suo segmento
+    segments = set((out / SEARCH_DIR).glob("*.parquet"))
+    _write(tmp_path / "b.xml", _aiuto(4, 2023, "Città digitale"))
+    process_file(str(tmp_path / "b.xml"), str(out))
+    assert update_search_index(out) == 4
+    assert segments < set((out / SEARCH_DIR).glob("*.parquet"))
+    assert search(out, "citta")["CAR"].to_list() == ["4"]
+
+def test_rebuilt_segments_do_not_touch_linked_versions(tmp_path):
+    from unittest.mock import patch
+    from src import search as search_module
+    out = tmp_path / "v1"
+    _write(tmp_path / "a.xml", _aiuto(1, 2021, "Impianto fotovoltaico"))
+    process_file(str(tmp_path / "a.xml"), str(out))
+    update_search_index(out)
+
+    # Nuova versione con hard link (come StagedVersion) e indice da ricostruire
+    linked = tmp_path / "v2"
+    for f in out.rglob("*"):
+        if f.is_file():
+            (linked / f.relative_to(out)).parent.mkdir(parents=True, exist_ok=True)
+            os.link(f, linked / f.relative_to(out))
+    segment, = (out / SEARCH_DIR).glob("*.parquet")
+    before = segment.read_bytes()
+    with patch.object(search_module, "SEARCH_VERSION", search_module.SEARCH_VERSION + 1):
+        assert update_search_index(linked) == 1
+    assert segment.read_bytes() == before
+    assert (linked / SEARCH_DIR / segment.name).stat().st_ino != segment.stat().st_ino
@@ -0,0 +1,128 @@
+import json
+import asyncio
+import threading
+import http.client
+import pytest
+import pyarrow as pa
+from src.server import QueryService
+from tests.test_catalog import dataset  # noqa: F401
+
+@pytest.fixture
+def server(dataset):
+    service = QueryService(dataset, connections=2)
+    loop = asyncio.new_event_loop()
+    srv = loop.run_until_complete(service.start("127.0.0.1", 0))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield srv.sockets[0].getsockname()[1]
+    # I job del pool (anche quelli di download interrotti) terminano con l'event loop attivo
+    service.executor.shutdown(wait=True)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    srv.close()
+
+    async def cancel_pending():
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    loop.run_until_complete(cancel_pending())
+    loop.close()
+    service.close()
+
+def _get(conn, path):
+    conn.request("GET", path)
+    response = conn.getresponse()
+    return response.status, response.getheader("Content-Type"), response.read()
+
+def test_query_streams_ndjson_and_arrow_on_one_connection(server):
+    conn = http.client.HTTPConnection("127.0.0.1", server, timeout=10)
+    status, ctype, body = _get(conn, "/query?q=ANNO%20%3D%202021&limit=5")
+    assert status == 200 and ctype == "application/x-ndjson"
+    rows = [json.loads(line) for line in body.splitlines()]
+    assert sorted(r["CAR"] for r in rows) == ["1", "4", "7"]
+
+    # Stessa connessione (keep-alive), risultato in Arrow IPC
+    status, ctype, body = _get(conn, "/export?table=aiuti&years=2020,2022&columns=CAR,ANNO&format=arrow")
+    assert status == 200
+    table = pa.ipc.open_stream(body).read_all()
+    assert table.column_names == ["CAR", "ANNO"]
+    assert sorted(set(table.column("ANNO").to_pylist())) == [2020, 2022]
+    assert table.num_rows == 6
+
+    status, _, body = _get(conn, "/query?table=nope")
+    assert status == 400 and "Unknown table" in json.loads(body)["error"]
+    status, _, body = _get(conn, "/query?q=SELECT%20*%20FROM%20missing")
+    assert status == 400
+    conn.close()
+
+def test_concurrent_requests_share_the_pool(server):
+    results = []
+
+    def fetch():
+        conn = http.client.HTTPConnection("127.0.0.1", server, timeout=10)
+        results.append(_get(conn, "/export?table=componenti&format=csv"))
+        conn.close()
+
+    threads = [threading.Thread(target=fetch) for _ in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert [status for status, _, _ in results] == [200] * 6
+    assert len({body for _, _, body in results}) == 1
+
+def test_aborted_downloads_release_the_pool(server):
+    import socket
+    from urllib.parse import quote
+    big = quote("SELECT range AS n, repeat('x', 100) AS pad FROM range(3000000)")
+    # Più download interrotti che cursori: ognuno deve restituire thread e cursore
+    for _ in range(3):
+        with socket.create_connection(("127.0.0.1", server), timeout=10) as s:
+            s.sendall(f"GET /query?q={big}&cache=false HTTP/1.1\r\nHost: x\r\n\r\n".encode())
+            assert s.recv(65536).startswith(b"HTTP/1.1 200")
+    conn = http.client.HTTPConnection("127.0.0.1", server, timeout=10)
+    status, _, body = _get(conn, "/query?q=ANNO%20%3D%202021&limit=5")
+    assert status == 200 and len(body.splitlines()) == 3
+    status, _, body = _get(conn, "/health")
+    assert json.loads(body) == {"status": "ok", "version": None}
+    conn.close()
+
+def test_only_dataset_selects_are_served(server, tmp_path):
+    from urllib.parse import quote
+    conn = http.client.HTTPConnection("127.0.0.1", server, timeout=10)
+    target = tmp_path / "pwn.csv"
+    for sql in (f"COPY (SELECT 42) TO '{target}'", "SELECT content FROM read_text('/etc/passwd')",
+                "SELECT * FROM aiuti; SELECT 1", "SET threads = 1"):
+        status, _, body = _get(conn, f"/query?q={quote(sql)}")
+        assert status == 400, sql
+    assert not target.exists()
+
+    # where è una sola espressione: niente UNION o commenti per uscire dalla condizione
+    escape = quote("1=1) UNION ALL SELECT content FROM read_text('/etc/passwd') --")
+    status, _, _ = _get(conn, f"/export?table=aiuti&columns=CAR&where={escape}")
+    assert status == 400
+    subquery = quote("CAR IN (SELECT content FROM read_text('/etc/passwd'))")
+    status, _, _ = _get(conn, f"/export?table=aiuti&where={subquery}")
+    assert status == 400
+    status, _, body = _get(conn, f"/export?table=aiuti&columns=CAR&format=ndjson&where={quote('ANNO = 2021')}")
+    assert status == 200 and len(body.splitlines()) == 3
+
+    # Corpo JSON che non è un oggetto: risposta 400, la connessione resta usabile
+    conn.request("POST", "/query", body=b"[1]", headers={"Content-Type": "application/json"})
+    response = conn.getresponse()
+    assert response.status == 400 and "JSON object" in json.loads(response.read())["error"]
+    conn.request("POST", "/query", body=json.dumps({"q": "ANNO = 2021", "limit": 5, "cache": False}))
+    response = conn.getresponse()
+    assert response.status == 200 and len(response.read().splitlines()) == 3
+    conn.close()
+
+def test_cache_hits_do_not_scan_the_dataset(server):
+    from unittest.mock import patch
+    conn = http.client.HTTPConnection("127.0.0.1", server, timeout=10)
+    with patch("src.cache.dataset_version", side_effect=AssertionError("dataset scanned")):
+        for _ in range(2):
+            status, _, body = _get(conn, "/query?q=ANNO%20%3D%202021&limit=5")
+            assert status == 200 and len(body.splitlines()) == 3
+    conn.close()
@@ -0,0 +1,83 @@
+import itertools
+import pytest
+import pyarrow.parquet as pq
+from unittest.mock import patch
+from src.checkpoint import Checkpointer, CHECKPOINT_DIR
+from src.models import surrogate_key
+from src.snapshots import (StagedVersion, Snapshot, collect_garbage, current_version, resolve_data_dir,
+                           version_path, RESUME_DIR)
+from tests.test_cli import _parse
+from tests.test_parser import XML_CONTENT, _multi_aiuto_xml
+
+def test_staged_version_is_invisible_until_published(tmp_path):
+    root = tmp_path / "parquet"
+    with StagedVersion(root) as first:
+        (first.path / "aiuti").mkdir()
+        (first.path / "aiuti" / "a.parquet").write_text("v1")
+        assert current_version(root) is None
+        first.publish()
+    assert resolve_data_dir(root) == first.path
+
+    with StagedVersion(root) as second:
+        with pytest.raises(RuntimeError):
+            StagedVersion(root)
+        # La nuova versione parte dagli hard link della corrente
+        assert (second.path / "aiuti" / "a.parquet").stat().st_ino == (first.path / "aiuti" / "a.parquet").stat().st_ino
+        (second.path / "aiuti" / "a.parquet").unlink()
+        (second.path / "aiuti" / "b.parquet").write_text("v2")
+        assert (resolve_data_dir(root) / "aiuti" / "a.parquet").read_text() == "v1"
+        second.publish()
+    assert sorted(f.name for f in (resolve_data_dir(root) / "aiuti").iterdir()) == ["b.parquet"]
+    assert not first.path.exists()
+
+def test_old_version_is_kept_while_a_reader_holds_it(tmp_path):
+    data = tmp_path / "data"
+    data.mkdir()
+    (data / "a.xml").write_text(XML_CONTENT)
+    out = tmp_path / "parquet"
+    _parse(data, out)
+
+    with Snapshot(out) as reader:
+        (data / "b.xml").write_text(_multi_aiuto_xml(4))
+        _parse(data, out)
+        assert current_version(out) != reader.version
+        # La versione letta resta intatta fino alla chiusura del lease
+        assert pq.read_table(reader.path / "aiuti").num_rows == 1
+        assert pq.read_table(resolve_data_dir(out) / "aiuti").num_rows == 5
+    assert collect_garbage(out) == [reader.version]
+    assert not reader.path.exists()
+
+def test_failed_source_is_held_out_and_resumed(tmp_path):
+    data = tmp_path / "data"
+    data.mkdir()
+    (data / "a.xml").write_text(XML_CONTENT)
+    # Codici interi (COD_TIPO_MISURA) nel checkpoint di b.xml
+    (data / "b.xml").write_text(_multi_aiuto_xml(20).replace(
+        "<COR>COR7</COR>", "<COR>COR7</COR><DES_TIPO_MISURA>Aiuto ad hoc</DES_TIPO_MISURA>"))
+    out = tmp_path / "parquet"
+    commit = Checkpointer.commit
+    ticks = itertools.count(1)
+
+    def failing_commit(self, elements, writer, stats, complete=False):
+        if complete and self.path.endswith("b.xml"):
+            raise OSError("disk full")
+        return commit(self, elements, writer, stats)
+
+    # I worker sono processi fork: le patch sulla classe valgono anche per loro
+    with patch.object(Checkpointer, "due", lambda self: next(ticks) % 5 == 0), \
+            patch.object(Checkpointer, "commit", failing_commit):
+        _parse(data, out)
+    published = resolve_data_dir(out)
+    assert pq.read_table(published / "aiuti").num_rows == 1
+    assert not list((published / CHECKPOINT_DIR).glob("*.json"))
+    assert list((out / RESUME_DIR / CHECKPOINT_DIR).glob("*.json"))
+
+    _parse(data, out, "--resume")
+    cars = pq.read_table(resolve_data_dir(out) / "aiuti").column("CAR").to_pylist()
+    assert sorted(cars) == sorted(["12345"] + [str(i) for i in range(20)])
+    tipi = pq.read_table(resolve_data_dir(out) / "dimensioni" / "tipo_misura.parquet").to_pylist()
+    assert tipi == [{"COD_TIPO_MISURA": surrogate_key("Aiuto ad hoc"), "DES_TIPO_MISURA": "Aiuto ad hoc"}]
+    assert not (out / RESUME_DIR).exists()
+    assert not list((resolve_data_dir(out) / CHECKPOINT_DIR).glob("*.json"))
+    assert [p.name for p in (out / "versions").iterdir()] == [current_version(out)]
+    assert version_path(out, current_version(out)) == resolve_data_dir(out)
@@ -0,0 +1,43 @@
+import pytest
+import pyarrow.parquet as pq
+from src.parser import process_file
+from src.synthetic import generate_xml
+from benchmarks.run import compare, stage_query
+
+def test_generated_xml_parses_with_configured_shape(tmp_path):
+    xml = tmp_path / "synthetic.xml"
+    n = generate_xml(xml, aiuti=40, components=(2, 2), instruments=(1, 3), years=(2020, 2021),
+                     invalid_rate=0.05, seed=7)
+    assert n == 40
+    stats = process_file(str(xml), str(tmp_path / "out"))
+    assert stats["aiuti"] == 40 and stats["componenti"] == 80
+    assert 80 <= stats["strumenti"] <= 240
+    assert stats["bytes_stripped"] > 0
+    assert {p.name for p in (tmp_path / "out" / "aiuti").iterdir()} <= {"ANNO=2020", "ANNO=2021"}
+
+    # Stesso seed, stesso file; con size_mb la dimensione è quella richiesta
+    generate_xml(tmp_path / "again.xml", aiuti=40, components=(2, 2), instruments=(1, 3),
+                 years=(2020, 2021), invalid_rate=0.05, seed=7)
+    assert (tmp_path / "again.xml").read_bytes() == xml.read_bytes()
+    generate_xml(tmp_path / "sized.xml", size_mb=0.5)
+    assert 0.5 <= (tmp_path / "sized.xml").stat().st_size / 1024 / 1024 < 0.52
+
+def test_compare_flags_only_worse_metrics():
+    baseline = {"stages": {"parse": {"mb_s": 100.0, "seconds": 10.0, "peak_rss_mb": 500.0, "aiuti": 10}}}
+    current = {"stages": {"parse": {"mb_s": 80.0, "seconds": 9.0, "peak_rss_mb": 540.0, "aiuti": 99}}}
+    assert compare(current, baseline, threshold=0.1) == [("parse", "mb_s", 100.0, 80.0)]
+
+def test_files_have_distinct_aid_keys(tmp_path):
+    keys = []
+    for seed, file_index in ((0, 0), (0, 1), (1, 0)):
+        xml = tmp_path / f"s{seed}-{file_index}.xml"
+        generate_xml(xml, aiuti=30, seed=seed, file_index=file_index)
+        out = tmp_path / f"out-{seed}-{file_index}"
+        process_file(str(xml), str(out))
+        keys.append(set(pq.read_table(out / "aiuti").column("AIUTO_SK").to_pylist()))
+    assert all(len(k) == 30 for k in keys)
+    assert not (keys[0] & keys[1]) and not (keys[0] & keys[2]) and not (keys[1] & keys[2])
+
+def test_query_stage_fails_on_query_errors(tmp_path):
+    with pytest.raises(Exception):
+        stage_query(tmp_path / "missing.xml", tmp_path)
@@ -0,0 +1,48 @@
+import pyarrow as pa
+import pyarrow.parquet as pq
+from src.writer import PartitionedParquetWriter
+
+SCHEMA = pa.schema([
+    ('ID', pa.string()),
+    ('VALORE', pa.float64()),
+    ('ANNO', pa.int32()),
+])
+
+def _batch(start, n, anni):
+    return pa.table({
+        "ID": [str(i) for i in range(start, start + n)],
+        "VALORE": [float(i) for i in range(start, start + n)],
+        "ANNO": [anni[i % len(anni)] for i in range(n)],
+    })
+
+def test_writer_appends_row_groups_to_one_file_per_partition(tmp_path):
+    with PartitionedParquetWriter(str(tmp_path), {"t": SCHEMA}, row_group_size=100) as writer:
+        for b in range(10):
+            writer.write("t", _batch(b * 50, 50, [2021, 2022]))
+
+    files_2021 = list((tmp_path / "t" / "ANNO=2021").glob("*.parquet"))
+    assert len(files_2021) == 1
+    pf = pq.ParquetFile(files_2021[0])
+    assert pf.metadata.num_rows == 250
+    assert pf.metadata.num_row_groups > 1
+    # La colonna di partizione vive solo nel percorso
+    assert "ANNO" not in pf.schema_arrow.names
+    assert len(writer.files) == 2
+
+def test_writer_rolls_over_at_target_size(tmp_path):
+    with PartitionedParquetWriter(str(tmp_path), {"t": SCHEMA}, row_group_size=10, target_file_size=1) as writer:
+        for b in range(3):
+            writer.write("t", _batch(b * 10, 10, [2020]))
+
+    files = sorted((tmp_path / "t" / "ANNO=2020").glob("*.parquet"))
+    assert len(files) == 3
+    assert pq.read_table(tmp_path / "t").num_rows == 30
+
+def test_writer_bounds_pending_bytes(tmp_path):
+    batch = _batch(0, 50, [2020, 2021, 2022])
+    with PartitionedParquetWriter(str(tmp_path), {"t": SCHEMA}, row_group_size=10_000,
+                                  max_pending_bytes=batch.nbytes) as writer:
+        for b in range(6):
+            writer.write("t", _batch(b * 50, 50, [2020, 2021, 2022]))
+            assert sum(writer._pending_bytes.values()) <= batch.nbytes
+    assert pq.read_table(tmp_path / "t").num_rows == 300